@@ -0,0 +1,114 @@
+"""Shared helpers for lens training benchmarks."""
+
+import os
+
+import json
+
+import time
+
+import jax
+
+import numpy as np
+
+import pandas as pd
+
+from pkg_resources import resource_filename
+
+from contextual_lenses.contextual_lenses import reduce_fn_name_to_fn
+
+from contextual_lenses.encoders import encoder_fn_name_to_fn
+
+from contextual_lenses.train_utils import create_representation_model
+
+from contextual_lenses.pfam_utils import PFAM_NUM_CATEGORIES, \
+PFAM_MAX_SEQUENCE_LENGTH, get_residue_lookup_table
+
+
+def create_synthetic_pfam_df(num_sequences,
+                             num_families=100,
+                             mean_log_length=5.0,
+                             std_log_length=0.6,
+                             seed=0):
+    """Random Pfam-like featurized dataframe with log-normally distributed lengths.
+
+    The default length distribution has a median of about 150 residues,
+    roughly matching Pfam seed domains.
+    """
+
+    rng = np.random.RandomState(seed)
+    lookup_table, pad_ind, dtype = get_residue_lookup_table()
+    residue_inds = lookup_table[np.frombuffer(b'ACDEFGHIKLMNPQRSTVWY',
+                                              dtype=np.uint8)]
+
+    lengths = np.clip(
+        np.round(rng.lognormal(mean_log_length, std_log_length,
+                               num_sequences)), 1,
+        PFAM_MAX_SEQUENCE_LENGTH).astype(np.int64)
+
+    one_hot_inds = np.full((num_sequences, PFAM_MAX_SEQUENCE_LENGTH),
+                           pad_ind,
+                           dtype=dtype)
+    for i, length in enumerate(lengths):
+        one_hot_inds[i, :length] = rng.choice(residue_inds, size=length)
+
+    pfam_df = pd.DataFrame({
+        'index': rng.randint(0, num_families, size=num_sequences),
+        'sequence_length': lengths,
+        'one_hot_inds': list(one_hot_inds)
+    })
+
+    return pfam_df
+
+
+def load_kwargs_resource(resource_dir, kwargs_path):
+    """Loads encoder_fn or reduce_fn kwargs from the package resources."""
+
+    kwargs = json.load(
+        open(
+            resource_filename('contextual_lenses.resources',
+                              os.path.join(resource_dir,
+                                           kwargs_path + '.json'))))
+
+    return kwargs
+
+
+def create_benchmark_model(encoder_fn_name,
+                           encoder_fn_kwargs_path,
+                           reduce_fn_name,
+                           reduce_fn_kwargs_path,
+                           output_features,
+                           **model_kwargs):
+    """Creates a non-transformer representation model from resource names."""
+
+    model = create_representation_model(
+        encoder_fn=encoder_fn_name_to_fn(encoder_fn_name),
+        encoder_fn_kwargs=load_kwargs_resource('encoder_fn_kwargs_resources',
+                                               encoder_fn_kwargs_path),
+        reduce_fn=reduce_fn_name_to_fn(reduce_fn_name),
+        reduce_fn_kwargs=load_kwargs_resource('reduce_fn_kwargs_resources',
+                                              reduce_fn_kwargs_path),
+        num_categories=PFAM_NUM_CATEGORIES,
+        output_features=output_features,
+        **model_kwargs)
+
+    return model
+
+
+def block_until_ready(tree):
+    """Waits for all device arrays in a pytree to be computed."""
+
+    for leaf in jax.tree_leaves(tree):
+        if hasattr(leaf, 'block_until_ready'):
+            leaf.block_until_ready()
+
+    return tree
+
+
+def time_fn(fn, *args, **kwargs):
+    """Returns the output of fn and its wall time in seconds, waiting for device results."""
+
+    start = time.time()
+    output = block_until_ready(fn(*args, **kwargs))
+    duration = time.time() - start
+
+    return output, duration
@@ -0,0 +1,146 @@
+"""Benchmarks data-parallel lens training throughput across host devices.
+
+Splits the host CPU into forced host platform devices (8 unless XLA_FLAGS
+is already set), trains the same lens on the same batches with pmap over
+increasing numbers of devices and checks the trained parameters against a
+single-device run.
+
+Example usage:
+XLA_FLAGS=--xla_force_host_platform_device_count=8 \
+python benchmarks/data_parallel_benchmark.py \
+--num_sequences=8192 \
+--batch_size=64 \
+--num_devices=1,2,4,8
+"""
+
+import os
+
+# Forced host devices must be configured before jax is imported.
+os.environ.setdefault('XLA_FLAGS',
+                      '--xla_force_host_platform_device_count=8')
+
+import sys
+sys.path.insert(1, 'google_research/')
+
+import jax
+
+import numpy as np
+
+import pandas as pd
+
+from absl import app, flags
+
+from contextual_lenses.train_utils import train, create_data_iterator
+
+from contextual_lenses.loss_fns import cross_entropy_loss
+
+from benchmark_utils import create_synthetic_pfam_df, create_benchmark_model, \
+time_fn
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('num_sequences', 8192, 'Number of synthetic sequences.')
+flags.DEFINE_integer('num_families', 1000, 'Number of synthetic families.')
+flags.DEFINE_integer('batch_size', 64, 'Global lens training batch size.')
+flags.DEFINE_list('num_devices', ['1', '2', '4', '8'],
+                  'Numbers of devices to train across.')
+flags.DEFINE_float('tolerance', 1e-3,
+                   'Largest allowed parameter difference to single device.')
+flags.DEFINE_string('encoder_fn_name', 'cnn_one_hot', 'Encoder to benchmark.')
+flags.DEFINE_string('encoder_fn_kwargs_path', '1-layer_cnn_kwargs',
+                    'Encoder kwargs resource.')
+flags.DEFINE_string('reduce_fn_name', 'linear_max_pool', 'Lens to benchmark.')
+flags.DEFINE_string('reduce_fn_kwargs_path', 'linear_pool_1024',
+                    'Lens kwargs resource.')
+flags.DEFINE_string('output_path', None,
+                    'Optional CSV file to write benchmark results to.')
+
+
+def max_param_difference(params, other_params):
+    """Largest absolute difference between two parameter pytrees."""
+
+    differences = jax.tree_multimap(
+        lambda x, y: np.max(np.abs(np.asarray(x) - np.asarray(y))), params,
+        other_params)
+
+    return max(jax.tree_leaves(differences))
+
+
+def benchmark(model, pfam_df, num_devices):
+    """Times one compile epoch and one steady-state epoch of lens training."""
+
+    def run_epoch(seed):
+        batches = create_data_iterator(df=pfam_df,
+                                       input_col='one_hot_inds',
+                                       output_col='index',
+                                       batch_size=FLAGS.batch_size,
+                                       seed=seed,
+                                       drop_remainder=True)
+        optimizer = train(model=model,
+                          train_data=batches,
+                          loss_fn=cross_entropy_loss,
+                          loss_fn_kwargs={'num_classes': FLAGS.num_families},
+                          learning_rate=1e-3,
+                          weight_decay=0.,
+                          use_pmap=num_devices is not None,
+                          devices=jax.local_devices()[:num_devices]
+                          if num_devices is not None else None)
+        return optimizer.target.params
+
+    # The first epoch includes compilation.
+    _, compile_time = time_fn(run_epoch, 0)
+    params, epoch_time = time_fn(run_epoch, 1)
+
+    num_sequences = len(pfam_df) // FLAGS.batch_size * FLAGS.batch_size
+
+    result = {
+        'num_devices': num_devices if num_devices is not None else 'jit',
+        'first_epoch_seconds': compile_time,
+        'epoch_seconds': epoch_time,
+        'sequences_per_second': num_sequences / epoch_time
+    }
+
+    return result, params
+
+
+def main(_):
+
+    pfam_df = create_synthetic_pfam_df(num_sequences=FLAGS.num_sequences,
+                                       num_families=FLAGS.num_families)
+
+    model = create_benchmark_model(FLAGS.encoder_fn_name,
+                                   FLAGS.encoder_fn_kwargs_path,
+                                   FLAGS.reduce_fn_name,
+                                   FLAGS.reduce_fn_kwargs_path,
+                                   output_features=FLAGS.num_families)
+
+    result, expected_params = benchmark(model, pfam_df, None)
+    results = [result]
+
+    for num_devices in FLAGS.num_devices:
+        num_devices = int(num_devices)
+        assert num_devices <= jax.local_device_count(
+        ), 'Only %d devices available!' % jax.local_device_count()
+        assert FLAGS.batch_size % num_devices == 0, \
+        'Number of devices must divide batch_size!'
+
+        result, params = benchmark(model, pfam_df, num_devices)
+        result['max_param_difference'] = max_param_difference(
+            params, expected_params)
+        results.append(result)
+
+    results_df = pd.DataFrame(results)
+    results_df['speedup'] = results_df['sequences_per_second'] / results_df[
+        'sequences_per_second'].values[0]
+
+    print(results_df.to_string(index=False))
+
+    if FLAGS.output_path is not None:
+        results_df.to_csv(FLAGS.output_path, index=False)
+
+    assert (results_df['max_param_difference'].dropna() <= FLAGS.tolerance).all(
+    ), 'Data-parallel training diverged from single-device training!'
+
+
+if __name__ == '__main__':
+    app.run(main)
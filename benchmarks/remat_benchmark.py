@@ -0,0 +1,215 @@
+"""Benchmarks peak memory and step time of encoder fine-tuning with rematerialization.
+
+Every remat policy and batch size is run in a fresh subprocess, so that the
+peak memory of one configuration is not hidden by an earlier one. Peak
+memory is read from the device allocator where jax reports it and is
+otherwise the peak resident memory of the process.
+
+For transformer encoders, blocks recomputes the self-attention of each
+layer.
+
+Example usage:
+python benchmarks/remat_benchmark.py \
+--encoder_fn_name=cnn_one_hot \
+--encoder_fn_kwargs_path=2-layer_cnn_kwargs \
+--batch_sizes=8,16,32 \
+--remat=none,blocks
+
+python benchmarks/remat_benchmark.py \
+--encoder_fn_name=transformer \
+--encoder_fn_kwargs_path=medium_transformer_kwargs \
+--batch_sizes=8,16,32 \
+--remat=none,blocks
+
+python benchmarks/remat_benchmark.py \
+--encoder_fn_name=transformer \
+--encoder_fn_kwargs_path=large_transformer_kwargs \
+--batch_sizes=4,8,16 \
+--remat=none,blocks
+"""
+
+import os
+
+import sys
+sys.path.insert(1, 'google_research/')
+
+import json
+
+import resource
+
+import subprocess
+
+import jax
+
+import numpy as np
+
+import pandas as pd
+
+from absl import app, flags
+
+from contextual_lenses.contextual_lenses import reduce_fn_name_to_fn, \
+gated_conv
+
+from contextual_lenses.encoders import encoder_fn_name_to_fn, \
+cnn_one_hot_encoder
+
+from contextual_lenses.train_utils import create_optimizer, train_step, \
+create_data_iterator, create_representation_model, \
+create_transformer_representation_model
+
+from contextual_lenses.loss_fns import cross_entropy_loss
+
+from contextual_lenses.pfam_utils import PFAM_NUM_CATEGORIES
+
+from benchmark_utils import create_synthetic_pfam_df, load_kwargs_resource, \
+time_fn
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('num_families', 1000, 'Number of synthetic families.')
+flags.DEFINE_integer('steps', 10, 'Number of timed training steps.')
+flags.DEFINE_list('batch_sizes', ['8', '16', '32'],
+                  'Encoder fine-tuning batch sizes.')
+flags.DEFINE_list('remat', ['none', 'blocks'],
+                  'Remat policies to benchmark (see pfam_experiment).')
+flags.DEFINE_string('encoder_fn_name', 'cnn_one_hot', 'Encoder to benchmark.')
+flags.DEFINE_string('encoder_fn_kwargs_path', '2-layer_cnn_kwargs',
+                    'Encoder kwargs resource.')
+flags.DEFINE_string('reduce_fn_name', 'linear_max_pool', 'Lens to benchmark.')
+flags.DEFINE_string('reduce_fn_kwargs_path', 'linear_pool_1024',
+                    'Lens kwargs resource.')
+flags.DEFINE_string('output_path', None,
+                    'Optional CSV file to write benchmark results to.')
+flags.DEFINE_string(
+    'run_config', None,
+    'Internal: runs a single remat,batch_size configuration and prints its result.'
+)
+
+
+def peak_memory_bytes():
+    """Peak device memory in use if jax reports it, else peak resident memory of the process."""
+
+    device = jax.local_devices()[0]
+    if hasattr(device, 'memory_stats'):
+        memory_stats = device.memory_stats()
+        if memory_stats is not None and 'peak_bytes_in_use' in memory_stats:
+            return memory_stats['peak_bytes_in_use']
+
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def create_model(remat):
+    """Fine-tuning model whose encoder is rematerialized according to remat."""
+
+    encoder_fn_kwargs = load_kwargs_resource('encoder_fn_kwargs_resources',
+                                             FLAGS.encoder_fn_kwargs_path)
+    reduce_fn = reduce_fn_name_to_fn(FLAGS.reduce_fn_name)
+    reduce_fn_kwargs = load_kwargs_resource('reduce_fn_kwargs_resources',
+                                            FLAGS.reduce_fn_kwargs_path)
+
+    if FLAGS.encoder_fn_name == 'transformer':
+        return create_transformer_representation_model(
+            transformer_kwargs=encoder_fn_kwargs,
+            reduce_fn=reduce_fn,
+            reduce_fn_kwargs=reduce_fn_kwargs,
+            num_categories=PFAM_NUM_CATEGORIES,
+            output_features=FLAGS.num_families,
+            remat=remat == 'blocks')
+
+    encoder_fn = encoder_fn_name_to_fn(FLAGS.encoder_fn_name)
+    if remat == 'blocks':
+        if encoder_fn is cnn_one_hot_encoder:
+            encoder_fn_kwargs = dict(encoder_fn_kwargs, remat=True)
+        if reduce_fn is gated_conv:
+            reduce_fn_kwargs = dict(reduce_fn_kwargs, remat=True)
+
+    return create_representation_model(encoder_fn=encoder_fn,
+                                       encoder_fn_kwargs=encoder_fn_kwargs,
+                                       reduce_fn=reduce_fn,
+                                       reduce_fn_kwargs=reduce_fn_kwargs,
+                                       num_categories=PFAM_NUM_CATEGORIES,
+                                       output_features=FLAGS.num_families)
+
+
+def run_config(remat, batch_size):
+    """Peak memory and mean step time of fine-tuning all layers for FLAGS.steps steps."""
+
+    pfam_df = create_synthetic_pfam_df(num_sequences=batch_size *
+                                       (FLAGS.steps + 1),
+                                       num_families=FLAGS.num_families)
+    batches = list(
+        create_data_iterator(df=pfam_df,
+                             input_col='one_hot_inds',
+                             output_col='index',
+                             batch_size=batch_size,
+                             drop_remainder=True))
+
+    optimizer = create_optimizer(create_model(remat),
+                                 learning_rate=1e-4,
+                                 weight_decay=0.)
+    loss_fn_kwargs = {'num_classes': FLAGS.num_families}
+
+    # The first step includes compilation.
+    X, Y = batches[0]
+    optimizer, compile_time = time_fn(train_step, optimizer, X, Y,
+                                      cross_entropy_loss, loss_fn_kwargs)
+
+    step_times = []
+    for X, Y in batches[1:]:
+        optimizer, step_time = time_fn(train_step, optimizer, X, Y,
+                                       cross_entropy_loss, loss_fn_kwargs)
+        step_times.append(step_time)
+
+    result = {
+        'remat': remat,
+        'batch_size': batch_size,
+        'compile_seconds': compile_time,
+        'step_seconds': float(np.mean(step_times)),
+        'peak_memory_gb': peak_memory_bytes() / 2**30
+    }
+
+    return result
+
+
+def main(_):
+
+    if FLAGS.run_config is not None:
+        remat, batch_size = FLAGS.run_config.split(',')
+        print(json.dumps(run_config(remat, int(batch_size))))
+        return
+
+    results = []
+    for batch_size in FLAGS.batch_sizes:
+        for remat in FLAGS.remat:
+            flag_args = [
+                arg for arg in sys.argv[1:]
+                if not arg.startswith('--run_config')
+            ]
+            process = subprocess.run(
+                [sys.executable, __file__] + flag_args +
+                ['--run_config=%s,%s' % (remat, batch_size)],
+                stdout=subprocess.PIPE,
+                universal_newlines=True)
+            if process.returncode != 0:
+                # Typically out of memory.
+                results.append({
+                    'remat': remat,
+                    'batch_size': int(batch_size),
+                    'failed': True
+                })
+                continue
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+            result['failed'] = False
+            results.append(result)
+
+    results_df = pd.DataFrame(results)
+
+    print(results_df.to_string(index=False))
+
+    if FLAGS.output_path is not None:
+        results_df.to_csv(FLAGS.output_path, index=False)
+
+
+if __name__ == '__main__':
+    app.run(main)
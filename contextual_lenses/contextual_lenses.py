@@ -18,8 +18,39 @@ import numpy as np
 from operator import itemgetter
 
 
-def max_pool(x, padding_mask=None, pad_constant=1e8):
-    """Apply padding, take maximum over sequence length axis."""
+def segment_mask(segment_ids, max_segments):
+    """One-hot encodes segment ids 1 to max_segments, dropping padding (segment id 0)."""
+
+    mask = jnp.expand_dims(segment_ids, axis=-1) == jnp.arange(
+        1, max_segments + 1)
+
+    return mask.astype(jnp.float32)
+
+
+def max_pool(x,
+             padding_mask=None,
+             pad_constant=1e8,
+             segment_ids=None,
+             max_segments=None,
+             dtype=jnp.float32):
+    """Apply padding, take maximum over sequence length axis in float32.
+
+    dtype is accepted like for the other lenses but unused, since the
+    maximum is float32 for every compute dtype. For packed sequences (see
+    PackedBatches), the maximum is taken over each of the max_segments
+    segments of every row instead, giving a (batch * max_segments, features)
+    representation that is 0 for empty segments.
+    """
+
+    x = x.astype(jnp.float32)
+
+    if segment_ids is not None:
+        # (..., segments, positions, 1) mask, reduced over positions at once.
+        mask = segment_mask(segment_ids, max_segments)
+        mask = jnp.expand_dims(jnp.swapaxes(mask, -1, -2), axis=-1)
+        x = jnp.expand_dims(x, axis=-3) * mask - pad_constant * (1 - mask)
+        rep = jnp.max(x, axis=-2) * jnp.max(mask, axis=-2)
+        return rep.reshape((-1, rep.shape[-1]))
 
     if padding_mask is not None:
         x = x * padding_mask
@@ -31,8 +62,24 @@ def max_pool(x, padding_mask=None, pad_constant=1e8):
     return rep
 
 
-def mean_pool(x, padding_mask=None):
-    """Apply padding, take mean over sequence length axis."""
+def mean_pool(x,
+              padding_mask=None,
+              segment_ids=None,
+              max_segments=None,
+              dtype=jnp.float32):
+    """Apply padding, take mean over sequence length axis in float32.
+
+    For packed sequences, the mean is taken over each segment as in max_pool,
+    and dtype is likewise unused.
+    """
+
+    x = x.astype(jnp.float32)
+
+    if segment_ids is not None:
+        mask = segment_mask(segment_ids, max_segments)
+        rep = jnp.einsum('...ls,...ld->...sd', mask, x) / jnp.maximum(
+            jnp.expand_dims(jnp.sum(mask, axis=-2), axis=-1), 1)
+        return rep.reshape((-1, rep.shape[-1]))
 
     if padding_mask is not None:
         x = x * padding_mask
@@ -43,7 +90,12 @@ def mean_pool(x, padding_mask=None):
     return rep
 
 
-def linear_max_pool(x, rep_size, padding_mask=None):
+def linear_max_pool(x,
+                    rep_size,
+                    padding_mask=None,
+                    dtype=jnp.float32,
+                    segment_ids=None,
+                    max_segments=None):
     """Apply linear transformation + ReLU, apply padding,
      take maximum over sequence length.
   """
@@ -51,16 +103,25 @@ def linear_max_pool(x, rep_size, padding_mask=None):
     x = nn.Dense(x,
                  rep_size,
                  kernel_init=nn.initializers.xavier_uniform(),
-                 bias_init=nn.initializers.normal(stddev=1e-6))
+                 bias_init=nn.initializers.normal(stddev=1e-6),
+                 dtype=dtype)
 
     x = nn.relu(x)
 
-    rep = max_pool(x, padding_mask=padding_mask)
+    rep = max_pool(x,
+                   padding_mask=padding_mask,
+                   segment_ids=segment_ids,
+                   max_segments=max_segments)
 
     return rep
 
 
-def linear_mean_pool(x, rep_size, padding_mask=None):
+def linear_mean_pool(x,
+                     rep_size,
+                     padding_mask=None,
+                     dtype=jnp.float32,
+                     segment_ids=None,
+                     max_segments=None):
     """Apply linear transformation + ReLU, apply padding,
      take mean over sequence length.
   """
@@ -68,11 +129,15 @@ def linear_mean_pool(x, rep_size, padding_mask=None):
     x = nn.Dense(x,
                  rep_size,
                  kernel_init=nn.initializers.xavier_uniform(),
-                 bias_init=nn.initializers.normal(stddev=1e-6))
+                 bias_init=nn.initializers.normal(stddev=1e-6),
+                 dtype=dtype)
 
     x = nn.relu(x)
 
-    rep = mean_pool(x, padding_mask=padding_mask)
+    rep = mean_pool(x,
+                    padding_mask=padding_mask,
+                    segment_ids=segment_ids,
+                    max_segments=max_segments)
 
     return rep
 
@@ -80,6 +145,13 @@ def linear_mean_pool(x, rep_size, padding_mask=None):
 class GatedConv(nn.Module):
     """Gated Convolutional lens followed by max pooling,
      see original paper for details.
+
+     For packed sequences, convolution inputs are zeroed outside of
+     segments, so segments separated by enough padding do not interact.
+     With mask_padding, they are zeroed at padding of unpacked sequences
+     too, which then match the same sequences packed.
+     With remat, the activations of each convolutional layer are
+     recomputed in the backward pass (jax.checkpoint) instead of stored.
   """
     def apply(self,
               x,
@@ -88,12 +160,27 @@ class GatedConv(nn.Module):
               m_features,
               m_kernel_sizes,
               conv_rep_size,
-              padding_mask=None):
-
-        H_0 = nn.relu(nn.Dense(x, conv_rep_size))
-        G_0 = nn.relu(nn.Dense(x, conv_rep_size))
+              padding_mask=None,
+              dtype=jnp.float32,
+              segment_ids=None,
+              max_segments=None,
+              remat=False,
+              mask_padding=False):
+
+        H_0 = nn.relu(nn.Dense(x, conv_rep_size, dtype=dtype))
+        G_0 = nn.relu(nn.Dense(x, conv_rep_size, dtype=dtype))
         H, G = jnp.expand_dims(H_0, axis=2), jnp.expand_dims(G_0, axis=2)
 
+        if segment_ids is not None:
+            conv_padding_mask = (segment_ids > 0)[:, :, jnp.newaxis]
+        elif mask_padding:
+            conv_padding_mask = padding_mask
+        else:
+            conv_padding_mask = None
+        if conv_padding_mask is not None:
+            conv_padding_mask = conv_padding_mask[:, :, jnp.newaxis].astype(
+                dtype)
+
         for layer in range(1, m_layers + 1):
 
             if layer < m_layers:
@@ -103,21 +190,44 @@ class GatedConv(nn.Module):
 
             H_kernel_size, G_kernel_size = m_kernel_sizes[layer - 1]
 
-            H = nn.Conv(H, features=H_features, kernel_size=(H_kernel_size, 1))
-            G = nn.Conv(G, features=G_features, kernel_size=(G_kernel_size, 1))
-
-            if layer < m_layers:
-                H = nn.relu(H)
-                G = nn.relu(G)
-            else:
-                H = nn.tanh(H)
-                G = nn.sigmoid(G)
+            if conv_padding_mask is not None:
+                H = H * conv_padding_mask
+                G = G * conv_padding_mask
+
+            def conv_layer(H, G):
+                H = nn.Conv(H,
+                            features=H_features,
+                            kernel_size=(H_kernel_size, 1),
+                            dtype=dtype)
+                G = nn.Conv(G,
+                            features=G_features,
+                            kernel_size=(G_kernel_size, 1),
+                            dtype=dtype)
+
+                if layer < m_layers:
+                    H = nn.relu(H)
+                    G = nn.relu(G)
+                else:
+                    H = nn.tanh(H)
+                    G = nn.sigmoid(G)
+
+                return H, G
+
+            # Parameters are created outside of jax.checkpoint.
+            if remat and not self.is_initializing():
+                conv_layer = jax.checkpoint(conv_layer)
+            H, G = conv_layer(H, G)
 
         H, G = jnp.squeeze(H, axis=2), jnp.squeeze(G, axis=2)
 
         F = H * G + G_0
 
-        rep = linear_max_pool(F, padding_mask=padding_mask, rep_size=rep_size)
+        rep = linear_max_pool(F,
+                              padding_mask=padding_mask,
+                              rep_size=rep_size,
+                              dtype=dtype,
+                              segment_ids=segment_ids,
+                              max_segments=max_segments)
 
         return rep
 
@@ -128,7 +238,12 @@ def gated_conv(x,
                m_features,
                m_kernel_sizes,
                conv_rep_size,
-               padding_mask=None):
+               padding_mask=None,
+               dtype=jnp.float32,
+               segment_ids=None,
+               max_segments=None,
+               remat=False,
+               mask_padding=False):
     """Calls GatedConv method for use as a lens."""
 
     rep = GatedConv(x,
@@ -137,7 +252,12 @@ def gated_conv(x,
                     m_layers=m_layers,
                     m_kernel_sizes=m_kernel_sizes,
                     conv_rep_size=conv_rep_size,
-                    padding_mask=padding_mask)
+                    padding_mask=padding_mask,
+                    dtype=dtype,
+                    segment_ids=segment_ids,
+                    max_segments=max_segments,
+                    remat=remat,
+                    mask_padding=mask_padding)
 
     return rep
 
@@ -0,0 +1,305 @@
+"""Encoder cache
+
+On-disk cache of the per-residue outputs of frozen encoders, so that lens and
+predictor configurations sharing an encoder share a single encoder pass.
+"""
+
+import os
+
+import json
+
+import uuid
+
+import shutil
+
+import hashlib
+
+from flax import serialization
+
+import jax
+
+import numpy as np
+
+ENCODER_CACHE_VERSION = 2
+
+
+def encoder_cache_key(encoder_fn_name, encoder_fn_kwargs, encoder_params):
+    """Hash identifying an encoder by name, kwargs and parameter values."""
+
+    key = hashlib.sha1()
+    key.update(
+        json.dumps([ENCODER_CACHE_VERSION, encoder_fn_name, encoder_fn_kwargs],
+                   sort_keys=True).encode())
+    if encoder_params is not None:
+        key.update(serialization.to_bytes(encoder_params))
+
+    return key.hexdigest()
+
+
+def token_lengths(one_hot_inds, pad_ind):
+    """Number of non-padding tokens in each row of one_hot_inds."""
+
+    return np.sum(np.asarray(one_hot_inds) < pad_ind, axis=1)
+
+
+def splitmix64(x):
+    """SplitMix64 finalizer of a uint64 array, wrapping on overflow."""
+
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+
+    return x ^ (x >> np.uint64(31))
+
+
+def sequence_ids(one_hot_inds, lengths, chunk_size=4096):
+    """64-bit content hash of each row of one_hot_inds truncated to its length.
+
+    Ids only depend on the tokens of a sequence, so they are shared across
+    partitions, samples and the CSV, streaming and token store loaders.
+    Every (position, token) pair within length is hashed independently and
+    the sum is mixed with the length, chunk_size rows at a time.
+    """
+
+    one_hot_inds = np.asarray(one_hot_inds)
+    lengths = np.asarray(lengths)
+    positions = np.arange(one_hot_inds.shape[1], dtype=np.uint64)
+
+    ids = np.empty(len(lengths), dtype=np.int64)
+    with np.errstate(over='ignore'):
+        for start in range(0, len(lengths), chunk_size):
+            rows = one_hot_inds[start:start + chunk_size].astype(np.uint64)
+            row_lengths = lengths[start:start + chunk_size]
+            hashes = splitmix64((positions << np.uint64(32)) | rows)
+            hashes[positions >= row_lengths[:, np.newaxis].astype(np.uint64)] = 0
+            ids[start:start + chunk_size] = splitmix64(
+                splitmix64(hashes.sum(axis=1, dtype=np.uint64)) ^
+                row_lengths.astype(np.uint64)).view(np.int64)
+
+    return ids
+
+
+class EncoderFeatureCache(object):
+    """Per-residue encoder outputs stored on disk as float16, ragged by sequence length.
+
+    Every fill writes a new shard directory atomically, so concurrent runs
+    sharing a cache directory never see partial writes. Shards are
+    memory-mapped and looked up through a sorted index of sequence ids.
+    """
+    def __init__(self, cache_dir, key):
+
+        self.cache_dir = os.path.join(cache_dir, key)
+        self.key = key
+        self.load()
+
+    def load(self):
+        """Memory-maps all shards and rebuilds the sequence id index."""
+
+        self.shards = []
+        self.feature_size = None
+
+        shard_dirs = []
+        if os.path.exists(self.cache_dir):
+            shard_dirs = sorted(
+                name for name in os.listdir(self.cache_dir)
+                if name.startswith('shard_') and not name.endswith('.tmp'))
+
+        ids, shard_inds, rows = [], [], []
+        for shard_dir in shard_dirs:
+            shard_dir = os.path.join(self.cache_dir, shard_dir)
+            with open(os.path.join(shard_dir, 'metadata.json'), 'r') as f:
+                metadata = json.load(f)
+            if metadata['version'] != ENCODER_CACHE_VERSION:
+                continue
+            shard = {
+                name: np.load(os.path.join(shard_dir, name + '.npy'),
+                              mmap_mode='r')
+                for name in ['ids', 'offsets', 'features']
+            }
+            self.shards.append(shard)
+            self.feature_size = metadata['feature_size']
+            ids.append(np.asarray(shard['ids']))
+            shard_inds.append(np.full(len(shard['ids']),
+                                      len(self.shards) - 1))
+            rows.append(np.arange(len(shard['ids'])))
+
+        if len(ids) > 0:
+            ids = np.concatenate(ids)
+            order = np.argsort(ids, kind='stable')
+            self.ids = ids[order]
+            self.shard_inds = np.concatenate(shard_inds)[order]
+            self.rows = np.concatenate(rows)[order]
+        else:
+            self.ids = np.zeros(0, dtype=np.int64)
+            self.shard_inds = np.zeros(0, dtype=np.int64)
+            self.rows = np.zeros(0, dtype=np.int64)
+
+    def lookup(self, ids):
+        """Positions of ids in the index and whether each id is cached."""
+
+        positions = np.minimum(np.searchsorted(self.ids, ids),
+                               max(len(self.ids) - 1, 0))
+        if len(self.ids) == 0:
+            return positions, np.zeros(len(ids), dtype=bool)
+
+        return positions, self.ids[positions] == ids
+
+    def contains(self, ids):
+        """Whether or not each id is cached."""
+
+        return self.lookup(ids)[1]
+
+    def add(self, ids, features):
+        """Writes the ragged (length, feature_size) features of each uncached id as a new shard."""
+
+        ids = np.asarray(ids, dtype=np.int64)
+        ids, first = np.unique(ids, return_index=True)
+        new = ~self.contains(ids)
+        if not new.any():
+            return
+
+        ids, inds = ids[new], first[new]
+        lengths = [len(features[ind]) for ind in inds]
+        offsets = np.append(0, np.cumsum(lengths)).astype(np.int64)
+        features = np.concatenate(
+            [np.asarray(features[ind], dtype=np.float16) for ind in inds])
+
+        metadata = {
+            'version': ENCODER_CACHE_VERSION,
+            'key': self.key,
+            'num_sequences': len(ids),
+            'feature_size': int(features.shape[-1])
+        }
+
+        shard_dir = os.path.join(self.cache_dir, 'shard_' + uuid.uuid4().hex)
+        tmp_shard_dir = shard_dir + '.tmp'
+        os.makedirs(tmp_shard_dir)
+        np.save(os.path.join(tmp_shard_dir, 'ids.npy'), ids)
+        np.save(os.path.join(tmp_shard_dir, 'offsets.npy'), offsets)
+        np.save(os.path.join(tmp_shard_dir, 'features.npy'), features)
+        with open(os.path.join(tmp_shard_dir, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+        os.rename(tmp_shard_dir, shard_dir)
+
+        self.load()
+
+    def get(self, ids, length, dtype=np.float32):
+        """Features of ids zero-padded to length, raises KeyError for uncached ids."""
+
+        positions, cached = self.lookup(ids)
+        if not cached.all():
+            raise KeyError('%d sequences are missing from encoder cache %s!' %
+                           (np.sum(~cached), self.key))
+
+        features = np.zeros((len(ids), length, self.feature_size), dtype=dtype)
+        shard_inds = self.shard_inds[positions]
+        for shard_ind in np.unique(shard_inds):
+            shard = self.shards[shard_ind]
+            inds = np.where(shard_inds == shard_ind)[0]
+            rows = self.rows[positions[inds]]
+            offsets = np.asarray(shard['offsets'])
+            starts = offsets[rows]
+            lengths = np.minimum(offsets[rows + 1] - starts, length)
+
+            # One gather of the stored tokens of all ids in this shard.
+            seqs, tokens = np.nonzero(
+                np.arange(length) < lengths[:, np.newaxis])
+            features[inds[seqs], tokens] = shard['features'][starts[seqs] +
+                                                             tokens]
+
+        return features
+
+    def clear(self):
+        """Deletes all shards of this cache."""
+
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        self.load()
+
+
+def fill_encoder_cache(encoder,
+                       cache,
+                       one_hot_inds,
+                       pad_ind,
+                       batch_size=64,
+                       shard_size=10000):
+    """Runs encoder on the rows of one_hot_inds missing from cache and adds their outputs.
+
+    Outputs are written every shard_size sequences, so host memory holds at
+    most one shard of ragged float16 features. Batches are padded to
+    batch_size rows, so the encoder is only compiled once.
+    """
+
+    one_hot_inds = np.asarray(one_hot_inds)
+    lengths = token_lengths(one_hot_inds, pad_ind)
+    ids = sequence_ids(one_hot_inds, lengths)
+
+    # Encode every uncached sequence once, even if it is repeated.
+    uncached = np.where(~cache.contains(ids))[0]
+    missing = uncached[np.sort(np.unique(ids[uncached], return_index=True)[1])]
+    if len(missing) == 0:
+        return cache
+
+    encode = jax.jit(lambda encoder, X: encoder(X))
+
+    for shard_start in range(0, len(missing), shard_size):
+        shard_inds = missing[shard_start:shard_start + shard_size]
+        features = []
+        for start in range(0, len(shard_inds), batch_size):
+            inds = shard_inds[start:start + batch_size]
+            # The last batch is padded by repeating its last sequence.
+            padded_inds = np.append(
+                inds, np.repeat(inds[-1:], batch_size - len(inds)))
+            X_encoded = np.asarray(encode(
+                encoder, one_hot_inds[padded_inds]))[:len(inds)]
+            for x, length in zip(X_encoded, lengths[inds]):
+                features.append(x[:length].astype(np.float16))
+        cache.add(ids[shard_inds], features)
+
+    return cache
+
+
+class EncoderFeatureBatches(object):
+    """Iterable replacing the token inputs of batches with cached encoder features.
+
+    Yields ({'x': features, 'padding_mask': padding_mask}, Y) for every
+    (X, Y) of batches, for a model built by
+    create_cached_encoder_representation_model. Features are zero past the
+    length of every sequence, so they only match the encoder's outputs for
+    lenses ignoring padding, such as gated_conv with mask_padding and
+    pooling lenses. Convolutional encoders must mask padding too (see
+    cnn_one_hot_encoder), as outputs within sequences otherwise depend on
+    the padded width of their rows. Sequence ids are taken from
+    inputs X = {'x': X, 'ids': ids} (see create_pfam_batches) and are
+    otherwise hashed for every batch. Positions of saved iteration states
+    are those of the wrapped batches.
+    """
+    def __init__(self, batches, cache, pad_ind, dtype=np.float32):
+
+        self.batches = batches
+        self.cache = cache
+        self.pad_ind = pad_ind
+        self.dtype = dtype
+
+    def __len__(self):
+
+        return len(self.batches)
+
+    def __getattr__(self, name):
+
+        # Delegates state_dict and load_state_dict to resumable batches.
+        if name in ['state_dict', 'load_state_dict']:
+            return getattr(self.batches, name)
+
+        raise AttributeError(name)
+
+    def __iter__(self):
+
+        for X, Y in iter(self.batches):
+            if isinstance(X, dict):
+                X, ids = X['x'], X['ids']
+            else:
+                ids = sequence_ids(X, token_lengths(X, self.pad_ind))
+            features = self.cache.get(ids, X.shape[1], dtype=self.dtype)
+            padding_mask = np.expand_dims(X < self.pad_ind,
+                                          axis=2).astype(np.int32)
+            yield {'x': features, 'padding_mask': padding_mask}, Y
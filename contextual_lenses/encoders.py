@@ -18,18 +18,33 @@ import numpy as np
 from operator import itemgetter
 
 
-def one_hot_encoder(batch_inds, num_categories):
-    """Applies one-hot encoding from jax.nn."""
+def one_hot_encoder(batch_inds,
+                    num_categories,
+                    dtype=jnp.float32):
+    """Applies one-hot encoding from jax.nn, independently for every position."""
 
-    one_hots = jax.nn.one_hot(batch_inds, num_classes=num_categories)
+    one_hots = jax.nn.one_hot(batch_inds, num_classes=num_categories, dtype=dtype)
 
     return one_hots
 
 
 class CNN(nn.Module):
-    """A simple 1D CNN model."""
-    def apply(self, x, n_layers, n_features, n_kernel_sizes,
-              n_kernel_dilations):
+    """A simple 1D CNN model.
+
+    With a padding_mask, convolution inputs are zeroed where it is 0, so
+    packed segments separated by enough padding do not interact. With remat,
+    the activations of each layer are recomputed in the backward pass
+    (jax.checkpoint) instead of being stored.
+    """
+    def apply(self,
+              x,
+              n_layers,
+              n_features,
+              n_kernel_sizes,
+              n_kernel_dilations,
+              dtype=jnp.float32,
+              padding_mask=None,
+              remat=False):
 
         if n_kernel_dilations is None:
             n_kernel_dilations = [1] * n_layers
@@ -37,14 +52,25 @@ class CNN(nn.Module):
         x = jnp.expand_dims(x, axis=2)
 
         for layer in range(n_layers):
+            if padding_mask is not None:
+                x = x * padding_mask[:, :, jnp.newaxis,
+                                     jnp.newaxis].astype(x.dtype)
             features = n_features[layer]
             kernel_size = (n_kernel_sizes[layer], 1)
             kernel_dilation = (n_kernel_dilations[layer], 1)
-            x = nn.Conv(x,
-                        features=features,
-                        kernel_size=kernel_size,
-                        kernel_dilation=kernel_dilation)
-            x = nn.relu(x)
+
+            def conv_layer(x):
+                x = nn.Conv(x,
+                            features=features,
+                            kernel_size=kernel_size,
+                            kernel_dilation=kernel_dilation,
+                            dtype=dtype)
+                return nn.relu(x)
+
+            # Parameters are created outside of jax.checkpoint.
+            if remat and not self.is_initializing():
+                conv_layer = jax.checkpoint(conv_layer)
+            x = conv_layer(x)
 
         x = jnp.squeeze(x, axis=2)
 
@@ -56,12 +82,34 @@ def cnn_one_hot_encoder(batch_inds,
                         n_layers,
                         n_features,
                         n_kernel_sizes,
-                        n_kernel_dilations=None):
-    """Applies one-hot encoding followed by 1D CNN."""
-
-    one_hots = one_hot_encoder(batch_inds, num_categories)
-    cnn_one_hots = CNN(one_hots, n_layers, n_features, n_kernel_sizes,
-                       n_kernel_dilations)
+                        n_kernel_dilations=None,
+                        dtype=jnp.float32,
+                        segment_ids=None,
+                        remat=False,
+                        mask_padding=False):
+    """Applies one-hot encoding followed by 1D CNN.
+
+    Positions outside of segments are masked in the CNN. With mask_padding,
+    so are positions of the padding index num_categories - 1 of unpacked
+    sequences, which then match the same sequences packed.
+    """
+
+    if segment_ids is not None:
+        padding_mask = segment_ids > 0
+    elif mask_padding:
+        padding_mask = batch_inds < num_categories - 1
+    else:
+        padding_mask = None
+
+    one_hots = one_hot_encoder(batch_inds, num_categories, dtype=dtype)
+    cnn_one_hots = CNN(one_hots,
+                       n_layers,
+                       n_features,
+                       n_kernel_sizes,
+                       n_kernel_dilations,
+                       dtype=dtype,
+                       padding_mask=padding_mask,
+                       remat=remat)
 
     return cnn_one_hots
 
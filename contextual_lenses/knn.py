@@ -0,0 +1,310 @@
+"""Nearest neighbors
+
+Exact k-nearest neighbors classification by blocked matrix multiplication,
+with JAX on any backend and NumPy/BLAS on CPU.
+"""
+
+import functools
+
+import jax
+import jax.numpy as jnp
+from jax.config import config
+config.enable_omnistaging()
+
+import numpy as np
+
+KNN_METRICS = ['l2', 'cosine']
+
+
+def knn_block_sizes(num_test, num_train, k, memory_budget_bytes,
+                    itemsize=4):
+    """Test and train block sizes keeping a distance block and its top-k temporaries within memory_budget_bytes."""
+
+    # Distances, their partition and the merged candidates.
+    budget_elements = max(memory_budget_bytes // (3 * itemsize), 1)
+
+    test_block_size = max(min(num_test, 1024), 1)
+    train_block_size = max(budget_elements // test_block_size, k, 1)
+    train_block_size = min(train_block_size, max(num_train, 1))
+
+    return test_block_size, train_block_size
+
+
+def resolve_knn_backend(backend='auto'):
+    """Backend used for backend 'auto': jax unless the default jax device is a CPU."""
+
+    if backend == 'auto':
+        backend = 'numpy' if jax.devices()[0].platform == 'cpu' else 'jax'
+
+    return backend
+
+
+def normalize_rows(vectors):
+    """Scales rows to unit L2 norm, leaving zero rows at zero."""
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def numpy_block_distances(test_block, train_block, train_sq_norms, metric):
+    """Squared L2 or cosine distances between rows of test_block and train_block."""
+
+    products = test_block @ train_block.T
+
+    if metric == 'cosine':
+        return 1 - products
+
+    test_sq_norms = np.sum(np.square(test_block), axis=1)
+    distances = test_sq_norms[:, np.newaxis] - 2 * products + train_sq_norms
+
+    return np.maximum(distances, 0)
+
+
+def merge_top_k(distances, indices, k):
+    """k smallest distances of each row with their indices, ties broken by the smaller index."""
+
+    k = min(k, distances.shape[1])
+    if k < distances.shape[1]:
+        candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        kth = np.take_along_axis(distances, candidates, axis=1).max(axis=1)
+        # Rows with ties at the kth distance are fully sorted instead.
+        tied = np.sum(distances <= kth[:, np.newaxis], axis=1) > k
+        if tied.any():
+            candidates[tied] = np.lexsort(
+                (indices[tied], distances[tied]), axis=1)[:, :k]
+        distances = np.take_along_axis(distances, candidates, axis=1)
+        indices = np.take_along_axis(indices, candidates, axis=1)
+
+    order = np.lexsort((indices, distances), axis=1)
+
+    return (np.take_along_axis(distances, order, axis=1),
+            np.take_along_axis(indices, order, axis=1))
+
+
+def numpy_knn(train_vectors, test_vectors, k, metric, test_block_size,
+              train_block_size):
+    """Exact top-k squared L2 or cosine distances and train indices, in float64 like sklearn."""
+
+    train_vectors = np.asarray(train_vectors, dtype=np.float64)
+    test_vectors = np.asarray(test_vectors, dtype=np.float64)
+    if metric == 'cosine':
+        train_vectors = normalize_rows(train_vectors)
+        test_vectors = normalize_rows(test_vectors)
+    train_sq_norms = np.sum(np.square(train_vectors), axis=1)
+
+    k = min(k, len(train_vectors))
+    distances = np.zeros((len(test_vectors), k), dtype=np.float64)
+    indices = np.zeros((len(test_vectors), k), dtype=np.int64)
+
+    for test_start in range(0, len(test_vectors), test_block_size):
+        test_block = test_vectors[test_start:test_start + test_block_size]
+        top_distances = np.zeros((len(test_block), 0), dtype=np.float64)
+        top_indices = np.zeros((len(test_block), 0), dtype=np.int64)
+
+        for train_start in range(0, len(train_vectors), train_block_size):
+            train_end = min(train_start + train_block_size, len(train_vectors))
+            block_distances = numpy_block_distances(
+                test_block, train_vectors[train_start:train_end],
+                train_sq_norms[train_start:train_end], metric)
+            block_indices = np.broadcast_to(
+                np.arange(train_start, train_end, dtype=np.int64),
+                block_distances.shape)
+            top_distances, top_indices = merge_top_k(
+                np.concatenate([top_distances, block_distances], axis=1),
+                np.concatenate([top_indices, block_indices], axis=1), k)
+
+        distances[test_start:test_start + len(test_block)] = top_distances
+        indices[test_start:test_start + len(test_block)] = top_indices
+
+    return distances, indices
+
+
+@functools.partial(jax.jit, static_argnums=(6, 7))
+def jax_block_top_k(top_distances, top_indices, test_block, train_block,
+                    train_start, num_train, k, metric):
+    """Merges the top-k distances of a test block to a padded train block into the running top-k.
+
+    Candidates are ordered by train index before lax.top_k, which keeps
+    the first of equal elements, so ties go to the smaller index.
+    """
+
+    products = jnp.dot(test_block,
+                       train_block.T,
+                       precision=jax.lax.Precision.HIGHEST)
+    if metric == 'cosine':
+        distances = 1 - products
+    else:
+        distances = jnp.maximum(
+            jnp.sum(jnp.square(test_block), axis=1)[:, jnp.newaxis] -
+            2 * products + jnp.sum(jnp.square(train_block), axis=1), 0)
+
+    block_indices = train_start + jnp.arange(train_block.shape[0])
+    distances = jnp.where(block_indices < num_train, distances, jnp.inf)
+    block_indices = jnp.broadcast_to(block_indices, distances.shape)
+
+    distances = jnp.concatenate([top_distances, distances], axis=1)
+    indices = jnp.concatenate([top_indices, block_indices], axis=1)
+    top_distances, positions = jax.lax.top_k(-distances, k)
+
+    return -top_distances, jnp.take_along_axis(indices, positions, axis=1)
+
+
+def pad_block(block, rows):
+    """Pads block with zero rows to rows rows."""
+
+    if len(block) == rows:
+        return block
+
+    return np.concatenate(
+        [block, np.zeros((rows - len(block), ) + block.shape[1:], block.dtype)])
+
+
+def jax_knn(train_vectors, test_vectors, k, metric, test_block_size,
+            train_block_size):
+    """Exact top-k squared L2 or cosine distances and train indices, in float32 on the default device.
+
+    Blocks are padded to fixed shapes, so jax_block_top_k is compiled once.
+    """
+
+    train_vectors = np.asarray(train_vectors, dtype=np.float32)
+    test_vectors = np.asarray(test_vectors, dtype=np.float32)
+    if metric == 'cosine':
+        train_vectors = normalize_rows(train_vectors)
+        test_vectors = normalize_rows(test_vectors)
+
+    k = min(k, len(train_vectors))
+    train_blocks = [
+        jax.device_put(
+            pad_block(train_vectors[train_start:train_start + train_block_size],
+                      train_block_size))
+        for train_start in range(0, len(train_vectors), train_block_size)
+    ]
+
+    blocks = []
+    for test_start in range(0, len(test_vectors), test_block_size):
+        test_block = test_vectors[test_start:test_start + test_block_size]
+        num_rows = len(test_block)
+        test_block = jax.device_put(pad_block(test_block, test_block_size))
+
+        top_distances = jnp.full((test_block_size, k), jnp.inf)
+        top_indices = jnp.zeros((test_block_size, k), dtype=jnp.int32)
+        for i, train_block in enumerate(train_blocks):
+            top_distances, top_indices = jax_block_top_k(
+                top_distances, top_indices, test_block, train_block,
+                i * train_block_size, len(train_vectors), k, metric)
+
+        blocks.append((top_distances, top_indices, num_rows))
+
+    # Blocks are copied to host once all of them have been dispatched.
+    distances = np.concatenate([
+        np.asarray(top_distances)[:num_rows]
+        for top_distances, _, num_rows in blocks
+    ]).astype(np.float64)
+    indices = np.concatenate([
+        np.asarray(top_indices)[:num_rows]
+        for _, top_indices, num_rows in blocks
+    ]).astype(np.int64)
+
+    return distances, indices
+
+
+def knn_vote(neighbor_labels, neighbor_distances, weights='uniform'):
+    """Majority or inverse-distance weighted vote of each row of neighbor_labels.
+
+    Like sklearn, ties go to the smallest label, and with distance weights
+    neighbors at distance 0 outvote all others.
+    """
+
+    if neighbor_labels.shape[1] == 1:
+        return neighbor_labels[:, 0]
+
+    if weights == 'uniform':
+        neighbor_weights = np.ones(neighbor_distances.shape)
+    elif weights == 'distance':
+        with np.errstate(divide='ignore'):
+            neighbor_weights = 1. / neighbor_distances
+        exact = neighbor_distances == 0
+        exact_rows = exact.any(axis=1)
+        neighbor_weights[exact_rows] = exact[exact_rows]
+    else:
+        raise ValueError('Unknown weights %s!' % weights)
+
+    # Total weight of the label of every neighbor within its row.
+    same_label = neighbor_labels[:, :, np.newaxis] == neighbor_labels[:, np.newaxis, :]
+    scores = np.sum(same_label * neighbor_weights[:, np.newaxis, :], axis=2)
+
+    best = scores == scores.max(axis=1, keepdims=True)
+    candidates = np.where(best, neighbor_labels, np.iinfo(np.int64).max)
+
+    return neighbor_labels[np.arange(len(neighbor_labels)),
+                           np.argmin(candidates, axis=1)]
+
+
+class KNeighborsClassifier(object):
+    """Exact k-nearest neighbors classifier with the fit/kneighbors/predict interface of sklearn.
+
+    Distances between blocks of test and train vectors are computed by
+    matrix multiplication, with block sizes set by memory_budget_bytes, and
+    the top n_neighbors of each test vector are merged across train blocks.
+    backend 'numpy' uses BLAS in float64 like sklearn, 'jax' uses float32 on
+    the default jax device and 'auto' picks jax unless that device is a CPU.
+    """
+    def __init__(self,
+                 n_neighbors=1,
+                 weights='uniform',
+                 metric='l2',
+                 memory_budget_bytes=2**30,
+                 backend='auto'):
+
+        if metric == 'euclidean':
+            metric = 'l2'
+        if metric not in KNN_METRICS:
+            raise ValueError('Unknown metric %s!' % metric)
+        backend = resolve_knn_backend(backend)
+
+        self.n_neighbors = n_neighbors
+        self.weights = weights
+        self.metric = metric
+        self.memory_budget_bytes = memory_budget_bytes
+        self.backend = backend
+
+    def fit(self, X, y):
+
+        self.train_vectors = np.asarray(X)
+        # Labels are voted on as indexes of the sorted classes.
+        self.classes_, self.train_labels = np.unique(np.asarray(y),
+                                                      return_inverse=True)
+
+        return self
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        """Distances to and train indices of the nearest neighbors of each row of X, nearest first."""
+
+        if n_neighbors is None:
+            n_neighbors = self.n_neighbors
+        test_vectors = np.asarray(X)
+
+        itemsize = 8 if self.backend == 'numpy' else 4
+        test_block_size, train_block_size = knn_block_sizes(
+            len(test_vectors), len(self.train_vectors), n_neighbors,
+            self.memory_budget_bytes, itemsize)
+        knn_fn = numpy_knn if self.backend == 'numpy' else jax_knn
+        distances, indices = knn_fn(self.train_vectors, test_vectors,
+                                    n_neighbors, self.metric, test_block_size,
+                                    train_block_size)
+
+        if not return_distance:
+            return indices
+
+        if self.metric == 'l2':
+            distances = np.sqrt(distances)
+
+        return distances, indices
+
+    def predict(self, X):
+
+        distances, indices = self.kneighbors(X)
+        labels = knn_vote(self.train_labels[indices], distances, self.weights)
+
+        return self.classes_[labels]
@@ -12,6 +12,8 @@ config.enable_omnistaging()
 def mse_loss(Y, Y_hat):
     """Squeezes predictions and returns MSE loss."""
 
+    Y_hat = Y_hat.astype(jnp.float32)
+
     if len(Y_hat.shape) > 1:
         Y_hat = jnp.squeeze(Y_hat, axis=1)
 
@@ -22,10 +24,10 @@ def mse_loss(Y, Y_hat):
 
 def cross_entropy_loss(Y, Y_hat, num_classes):
     """Applies log-softmax to predictions and one-hot encodes true values
-       to compute and return cross-entropy loss.
+       to compute and return cross-entropy loss in float32.
     """
 
-    Y_hat = jax.nn.log_softmax(Y_hat)
+    Y_hat = jax.nn.log_softmax(Y_hat.astype(jnp.float32))
 
     Y = jax.nn.one_hot(Y, num_classes=num_classes)
 
@@ -2,13 +2,21 @@
 
 import os
 
+import json
+
+import shutil
+
+import functools
+
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
 import jax
 import jax.numpy as jnp
 
 import numpy as np
 
-import tensorflow as tf
-
 import pandas as pd
 
 import matplotlib.pyplot as plt
@@ -16,30 +24,61 @@ import matplotlib.pyplot as plt
 import scipy.stats
 
 import sklearn.metrics as metrics
-from sklearn.neighbors import KNeighborsClassifier as knn
 
 from pkg_resources import resource_filename
 
+from fs.osfs import OSFS
 from fs_gcsfs import GCSFS
 
 from google_research.protein_lm import domains
 
-from contextual_lenses.train_utils import create_data_iterator
+from contextual_lenses.train_utils import create_data_iterator, \
+DevicePrefetcher, PaddedBatches
 
 from contextual_lenses.loss_fns import cross_entropy_loss
 
+from contextual_lenses.knn import KNeighborsClassifier as knn
+
+from contextual_lenses.encoder_cache import fill_encoder_cache, \
+EncoderFeatureBatches, sequence_ids, token_lengths
+
 
 # Data preprocessing.
 # Original code source: https://www.kaggle.com/drewbryant/starter-pfam-seed-random-split.
-def read_all_shards(partition, data_dir, bucket_name):
-    """Combines different CSVs into a single dataframe."""
-
-    shards = []
-    gcsfs = GCSFS(bucket_name)
-    for fn in gcsfs.listdir(os.path.join(data_dir, partition)):
-        with gcsfs.open(os.path.join(data_dir, partition, fn)) as f:
-            shards.append(pd.read_csv(f, index_col=None))
-            
+def open_partition_fs(partition, data_dir, bucket_name):
+    """Opens a partition directory in a GCS bucket, or locally if bucket_name is None."""
+
+    partition_dir = os.path.join(data_dir, partition)
+
+    if bucket_name is None:
+        return OSFS(partition_dir)
+
+    return GCSFS(bucket_name, root_path=partition_dir)
+
+
+def read_shard(partition_fs, fn):
+    """Reads a single CSV shard into a dataframe."""
+
+    with partition_fs.open(fn) as f:
+        shard = pd.read_csv(f, index_col=None)
+
+    return shard
+
+
+def read_all_shards(partition, data_dir, bucket_name, num_workers=8):
+    """Combines different CSVs into a single dataframe.
+
+    Shards are fetched and parsed concurrently by up to num_workers threads
+    and concatenated in sorted file name order.
+    """
+
+    partition_fs = open_partition_fs(partition, data_dir, bucket_name)
+    fns = sorted(partition_fs.listdir('.'))
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        shards = list(
+            executor.map(functools.partial(read_shard, partition_fs), fns))
+
     return pd.concat(shards)
 
 
@@ -49,6 +88,10 @@ def mod_family_accession(family_accession):
     return family_accession[:family_accession.index('.')]
 
 
+# Maximum number of residues kept per sequence.
+PFAM_MAX_SEQUENCE_LENGTH = 512
+
+
 # Pfam protein_lm domain.
 PFAM_PROTEIN_DOMAIN = domains.VariableLengthDiscreteDomain(
     vocab=domains.ProteinVocab(include_anomalous_amino_acids=True,
@@ -56,7 +99,7 @@ PFAM_PROTEIN_DOMAIN = domains.VariableLengthDiscreteDomain(
                                include_eos=True,
                                include_pad=True,
                                include_mask=True),
-    length=512)
+    length=PFAM_MAX_SEQUENCE_LENGTH)
 
 
 # Number of categories for one-hot encoding.
@@ -93,32 +136,764 @@ def get_family_id_to_index():
     return family_id_to_index
 
 
-def create_pfam_df(family_accessions,
-                   test=False,
-                   samples=None,
-                   random_state=0,
-                   data_partitions_dirpath='random_split/',
-                   gcs_bucket='neuralblast_public'):
-    """Processes Pfam data into a featurized dataframe with samples many entries per family."""
+# Vectorized featurization.
+def mod_family_accessions(family_accessions):
+    """Applies mod_family_accession to a series of family accessions."""
+
+    return family_accessions.str.split('.', n=1).str[0]
+
+
+def family_ids_to_indexes(family_ids):
+    """Maps a series of family ids to indexes through its categories."""
 
     family_id_to_index = get_family_id_to_index()
-    
+
+    family_ids = family_ids.astype('category')
+    category_indexes = np.array(
+        [family_id_to_index[x] for x in family_ids.cat.categories],
+        dtype=np.int64)
+
+    return category_indexes[family_ids.cat.codes.values]
+
+
+@functools.lru_cache(maxsize=None)
+def get_residue_lookup_table():
+    """ASCII code to one hot index lookup table derived from PFAM_PROTEIN_DOMAIN.
+
+    Codes the domain cannot encode map to -1. Also returns the padding index
+    and dtype produced by residues_to_one_hot_inds.
+    """
+
+    reference_inds = residues_to_one_hot_inds('A')
+    pad_ind = reference_inds[-1]
+
+    lookup_table = np.full(128, -1, dtype=np.int64)
+    for code in range(128):
+        try:
+            lookup_table[code] = residues_to_one_hot_inds(chr(code))[0]
+        except (KeyError, ValueError, IndexError):
+            continue
+
+    return lookup_table, pad_ind, reference_inds.dtype
+
+
+def residues_to_one_hot_inds_matrix(seqs,
+                                    length=PFAM_MAX_SEQUENCE_LENGTH,
+                                    dtype=None,
+                                    chunk_size=65536):
+    """Converts a series of sequences to a padded matrix of one hot indices.
+
+    Row i equals residues_to_one_hot_inds(seqs[i][:length]). Sequences are
+    concatenated into a byte buffer and translated with a lookup table,
+    chunk_size sequences at a time to bound temporary memory.
+    """
+
+    lookup_table, pad_ind, inds_dtype = get_residue_lookup_table()
+    if dtype is None:
+        dtype = inds_dtype
+
+    seqs = pd.Series(seqs).reset_index(drop=True)
+    one_hot_inds = np.full((len(seqs), length), pad_ind, dtype=dtype)
+
+    for start in range(0, len(seqs), chunk_size):
+        chunk = seqs.iloc[start:start + chunk_size]
+
+        residues = np.frombuffer(''.join(chunk.values).encode('ascii'),
+                                 dtype=np.uint8)
+        seq_lengths = chunk.str.len().values
+        seq_starts = np.cumsum(seq_lengths) - seq_lengths
+
+        kept_lengths = np.minimum(seq_lengths, length)
+        kept_starts = np.cumsum(kept_lengths) - kept_lengths
+        positions = np.arange(kept_lengths.sum()) - np.repeat(
+            kept_starts, kept_lengths)
+
+        inds = lookup_table[residues[np.repeat(seq_starts, kept_lengths) +
+                                     positions]]
+        if (inds < 0).any():
+            raise ValueError('Sequences contain residues outside of vocab!')
+
+        rows = np.repeat(np.arange(start, start + len(chunk)), kept_lengths)
+        one_hot_inds[rows, positions] = inds
+
+    return one_hot_inds
+
+
+# Streaming featurization.
+# Columns of the Pfam CSV shards needed for featurization.
+PFAM_FEATURE_COLUMNS = ['family_id', 'family_accession', 'sequence']
+
+
+def read_shard_chunks(partition_fs, fn, chunk_size):
+    """Yields chunks of at most chunk_size rows of a CSV shard."""
+
+    with partition_fs.open(fn) as f:
+        for chunk in pd.read_csv(f,
+                                 index_col=None,
+                                 usecols=PFAM_FEATURE_COLUMNS,
+                                 chunksize=chunk_size):
+            yield chunk
+
+
+def stream_pfam_features(partition,
+                         family_accessions=None,
+                         chunk_size=100000,
+                         data_partitions_dirpath='random_split/',
+                         gcs_bucket='neuralblast_public'):
+    """Yields featurized chunks of a Pfam partition in shard order.
+
+    Each chunk is a dictionary of compact arrays (uint8 one hot indices,
+    lengths, family indexes and accessions) holding the rows of at most
+    chunk_size CSV rows that belong to family_accessions (all if None).
+    """
+
+    if family_accessions is not None:
+        family_accessions = pd.Index(family_accessions)
+
+    partition_fs = open_partition_fs(partition, data_partitions_dirpath,
+                                     gcs_bucket)
+
+    for fn in sorted(partition_fs.listdir('.')):
+        for chunk in read_shard_chunks(partition_fs, fn, chunk_size):
+
+            accessions = mod_family_accessions(chunk.family_accession)
+            if family_accessions is not None:
+                keep = accessions.isin(family_accessions).values
+                chunk = chunk[keep]
+                accessions = accessions[keep]
+
+            features = {
+                'one_hot_inds':
+                residues_to_one_hot_inds_matrix(chunk.sequence,
+                                                dtype=np.uint8),
+                'lengths':
+                np.minimum(chunk.sequence.str.len().values,
+                           PFAM_MAX_SEQUENCE_LENGTH).astype(np.int32),
+                'index':
+                family_ids_to_indexes(chunk.family_id).astype(np.int32),
+                'mod_family_accession':
+                accessions.values.astype('S')
+            }
+
+            yield features
+
+
+def concatenate_pfam_features(features_iterator):
+    """Appends featurized chunks into a single set of compact arrays."""
+
+    chunks = collections.defaultdict(list)
+    for features in features_iterator:
+        for name, array in features.items():
+            chunks[name].append(array)
+
+    features = {}
+    for name in ['one_hot_inds', 'lengths', 'index', 'mod_family_accession']:
+        features[name] = np.concatenate(chunks[name])
+
+    return features
+
+
+def sample_pfam_features(features_iterator, samples, random_state=0):
+    """One-pass per-family sampling of featurized chunks without a global shuffle.
+
+    Every row is given a uniform random key, drawn in stream order from a
+    generator seeded by random_state, and the samples rows with the smallest
+    keys are kept per family. The result is ordered by key and has a
+    sample_rank array giving each row's rank within its family, so rows with
+    sample_rank < k form the k-sample set for any k <= samples.
+    """
+
+    rng = np.random.RandomState(random_state)
+
+    kept = None
+    for features in features_iterator:
+        features = dict(features)
+        features['sample_key'] = rng.random_sample(
+            len(features['mod_family_accession']))
+
+        if kept is not None:
+            for name in features.keys():
+                features[name] = np.concatenate([kept[name], features[name]])
+
+        order, ranks = rank_within_families(features)
+        keep = order[ranks < samples]
+        kept = {name: array[keep] for name, array in features.items()}
+
+    if kept is None:
+        raise ValueError('No featurized chunks to sample from!')
+
+    order = np.argsort(kept['sample_key'], kind='stable')
+    kept = {name: array[order] for name, array in kept.items()}
+
+    family_order, ranks = rank_within_families(kept)
+    kept['sample_rank'] = np.empty_like(ranks)
+    kept['sample_rank'][family_order] = ranks
+
+    return kept
+
+
+def rank_within_families(features):
+    """Sorts rows by (family, sample_key) and ranks them within their family."""
+
+    families = features['mod_family_accession']
+    order = np.lexsort((features['sample_key'], families))
+
+    sorted_families = families[order]
+    is_start = np.ones(len(order), dtype=bool)
+    is_start[1:] = sorted_families[1:] != sorted_families[:-1]
+    starts = np.flatnonzero(is_start)
+    counts = np.diff(np.append(starts, len(order)))
+
+    ranks = np.arange(len(order)) - np.repeat(starts, counts)
+
+    return order, ranks
+
+
+def nested_pfam_samples(features, sample_sizes):
+    """Splits sample_pfam_features output into nested per-family samples."""
+
+    nested_features = {}
+    for samples in sample_sizes:
+        keep = features['sample_rank'] < samples
+        nested_features[samples] = {
+            name: array[keep]
+            for name, array in features.items()
+        }
+
+    return nested_features
+
+
+def pfam_features_to_df(features):
+    """Builds a featurized dataframe from compact arrays."""
+
+    pfam_df = pd.DataFrame({
+        'mod_family_accession':
+        features['mod_family_accession'].astype(str),
+        'index':
+        features['index'].astype(np.int64),
+        'sequence_length':
+        features['lengths']
+    })
+
+    if 'row_ids' in features:
+        pfam_df['row_id'] = features['row_ids']
+
+    pfam_df['one_hot_inds'] = list(features['one_hot_inds'])
+
+    return pfam_df
+
+
+# Pfam token store.
+# Rows are stored grouped by family, with a per-family row-offset index, so
+# that reading a set of families only touches the rows of those families.
+PFAM_TOKEN_STORE_VERSION = 2
+
+
+PFAM_TOKEN_STORE_ARRAYS = [
+    'one_hot_inds', 'lengths', 'index', 'mod_family_accession', 'row_ids',
+    'families', 'family_offsets'
+]
+
+
+def create_pfam_token_store(store_dir,
+                            partition,
+                            data_partitions_dirpath='random_split/',
+                            gcs_bucket='neuralblast_public',
+                            chunk_size=100000):
+    """Featurizes a Pfam partition once and saves it as memory-mappable arrays.
+
+    The partition is streamed chunk_size rows at a time, so peak memory is
+    bounded by the compact arrays rather than by the parsed CSVs.
+    """
+
+    features = concatenate_pfam_features(
+        stream_pfam_features(partition,
+                             chunk_size=chunk_size,
+                             data_partitions_dirpath=data_partitions_dirpath,
+                             gcs_bucket=gcs_bucket))
+
+    num_rows = len(features['index'])
+
+    # Stable sort keeps the original partition order within each family.
+    row_ids = np.argsort(features['mod_family_accession'], kind='stable')
+
+    arrays = {}
+    for name in list(features.keys()):
+        arrays[name] = features.pop(name)[row_ids]
+
+    families, family_starts = np.unique(arrays['mod_family_accession'],
+                                        return_index=True)
+
+    arrays['row_ids'] = row_ids.astype(np.int64)
+    arrays['families'] = families
+    arrays['family_offsets'] = np.append(family_starts,
+                                         num_rows).astype(np.int64)
+
+    metadata = {
+        'version': PFAM_TOKEN_STORE_VERSION,
+        'partition': partition,
+        'num_rows': num_rows,
+        'num_families': len(families),
+        'max_sequence_length': PFAM_MAX_SEQUENCE_LENGTH,
+        'data_partitions_dirpath': data_partitions_dirpath,
+        'gcs_bucket': gcs_bucket
+    }
+
+    # Write to a temporary directory first so an interrupted conversion
+    # never leaves a partially written store behind.
+    partition_dir = os.path.join(store_dir, partition)
+    tmp_partition_dir = partition_dir + '.tmp'
+    shutil.rmtree(tmp_partition_dir, ignore_errors=True)
+    os.makedirs(tmp_partition_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_partition_dir, name + '.npy'), array)
+    with open(os.path.join(tmp_partition_dir, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+    shutil.rmtree(partition_dir, ignore_errors=True)
+    os.rename(tmp_partition_dir, partition_dir)
+
+    return partition_dir
+
+
+def load_pfam_token_store(store_dir, partition):
+    """Memory-maps the arrays of a stored Pfam partition."""
+
+    partition_dir = os.path.join(store_dir, partition)
+
+    with open(os.path.join(partition_dir, 'metadata.json'), 'r') as f:
+        metadata = json.load(f)
+
+    assert (metadata['version'] == PFAM_TOKEN_STORE_VERSION
+            ), 'Pfam token store has an outdated version!'
+
+    store = {'metadata': metadata}
+    for name in PFAM_TOKEN_STORE_ARRAYS:
+        store[name] = np.load(os.path.join(partition_dir, name + '.npy'),
+                              mmap_mode='r')
+
+    return store
+
+
+def pfam_token_store_exists(store_dir, partition):
+    """Whether or not a current version store exists for a partition."""
+
+    metadata_path = os.path.join(store_dir, partition, 'metadata.json')
+    if not os.path.exists(metadata_path):
+        return False
+
+    with open(metadata_path, 'r') as f:
+        metadata = json.load(f)
+
+    return metadata['version'] == PFAM_TOKEN_STORE_VERSION
+
+
+def get_pfam_token_store(store_dir,
+                         partition,
+                         data_partitions_dirpath='random_split/',
+                         gcs_bucket='neuralblast_public'):
+    """Loads a stored Pfam partition, creating the store on first use."""
+
+    if not pfam_token_store_exists(store_dir, partition):
+        create_pfam_token_store(store_dir,
+                                partition,
+                                data_partitions_dirpath=data_partitions_dirpath,
+                                gcs_bucket=gcs_bucket)
+
+    return load_pfam_token_store(store_dir, partition)
+
+
+def get_pfam_token_store_rows(store, family_accessions):
+    """Store rows of the given families, in store order, using the family index."""
+
+    families = store['families']
+    family_offsets = store['family_offsets']
+
+    if len(families) == 0 or len(family_accessions) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    accessions = np.unique(np.asarray(family_accessions).astype('S'))
+    positions = np.minimum(np.searchsorted(families, accessions),
+                           len(families) - 1)
+    positions = positions[families[positions] == accessions]
+
+    starts = family_offsets[positions]
+    counts = family_offsets[positions + 1] - starts
+
+    rows = np.arange(counts.sum()) + np.repeat(
+        starts - (np.cumsum(counts) - counts), counts)
+
+    return rows
+
+
+def create_pfam_df_from_store(family_accessions,
+                              partition,
+                              store_dir,
+                              data_partitions_dirpath='random_split/',
+                              gcs_bucket='neuralblast_public'):
+    """Builds a featurized dataframe of the given families from a token store."""
+
+    store = get_pfam_token_store(store_dir,
+                                 partition,
+                                 data_partitions_dirpath=data_partitions_dirpath,
+                                 gcs_bucket=gcs_bucket)
+
+    rows = get_pfam_token_store_rows(store, family_accessions)
+
+    # Rows are put back into original partition order so sampling matches
+    # the CSV path.
+    rows = rows[np.argsort(store['row_ids'][rows], kind='stable')]
+
+    pfam_df = pfam_features_to_df(gather_pfam_token_store_rows(store, rows))
+
+    return pfam_df
+
+
+def gather_pfam_token_store_rows(store, rows):
+    """Reads the featurized arrays of store rows, in the order given."""
+
+    # Read in store order, which is contiguous per family, then reorder.
+    read_order = np.argsort(rows, kind='stable')
+    order = np.empty_like(read_order)
+    order[read_order] = np.arange(len(rows))
+    sorted_rows = rows[read_order]
+
+    features = {}
+    for name in [
+            'one_hot_inds', 'lengths', 'index', 'mod_family_accession',
+            'row_ids'
+    ]:
+        features[name] = np.asarray(store[name][sorted_rows])[order]
+
+    return features
+
+
+# In-process cache of featurized dataframes.
+class PfamDataFrameCache(object):
+    """LRU cache of featurized Pfam dataframes bounded by a memory budget.
+
+    Cached one hot index arrays are marked read-only and lookups return
+    copies of the cached dataframe, so callers cannot corrupt cached data.
+    """
+    def __init__(self, max_bytes):
+
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns a copy of the cached dataframe for key, or None."""
+
+        if key not in self.entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        pfam_df, _ = self.entries[key]
+
+        return pfam_df.copy()
+
+    def put(self, key, pfam_df):
+        """Caches pfam_df under key, evicting least recently used entries.
+
+        Only the one hot index arrays of dataframes that are cached are
+        marked read-only.
+        """
+
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+
+        if self.max_bytes <= 0:
+            return
+
+        one_hot_inds = pfam_df['one_hot_inds'].values
+        nbytes = int(pfam_df.memory_usage(index=True, deep=True).sum())
+        nbytes += sum(inds.nbytes for inds in one_hot_inds)
+
+        if nbytes > self.max_bytes:
+            return
+
+        for inds in one_hot_inds:
+            inds.flags.writeable = False
+
+        self.entries[key] = (pfam_df, nbytes)
+        self.nbytes += nbytes
+
+        self.evict()
+
+    def evict(self):
+        """Evicts least recently used entries until within the memory budget."""
+
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted_nbytes) = self.entries.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+
+    def clear(self):
+        """Empties the cache."""
+
+        self.entries.clear()
+        self.nbytes = 0
+
+
+# Disabled by default; pfam_experiment sizes it with --pfam_df_cache_gb.
+PFAM_DF_CACHE = PfamDataFrameCache(max_bytes=0)
+
+
+def set_pfam_df_cache_max_bytes(max_bytes):
+    """Sets the memory budget of the featurized dataframe cache (0 disables it)."""
+
+    PFAM_DF_CACHE.max_bytes = max_bytes
+    PFAM_DF_CACHE.evict()
+
+
+def load_pfam_df(family_accessions,
+                 test=False,
+                 data_partitions_dirpath='random_split/',
+                 gcs_bucket='neuralblast_public',
+                 store_dir=None,
+                 chunk_size=None):
+    """Loads a featurized dataframe of all entries of the given families.
+
+    If chunk_size is specified, the partition is streamed and featurized
+    chunk_size rows at a time instead of being materialized in full.
+    """
+
     if test:
-        pfam_df = read_all_shards(partition='test',
-                                  data_dir=data_partitions_dirpath,
-                                  bucket_name=gcs_bucket)
+        partition = 'test'
     else:
-        pfam_df = read_all_shards(partition='train',
+        partition = 'train'
+
+    if store_dir is not None:
+        pfam_df = create_pfam_df_from_store(
+            family_accessions,
+            partition=partition,
+            store_dir=store_dir,
+            data_partitions_dirpath=data_partitions_dirpath,
+            gcs_bucket=gcs_bucket)
+
+    elif chunk_size is not None:
+        pfam_df = pfam_features_to_df(
+            concatenate_pfam_features(
+                stream_pfam_features(
+                    partition,
+                    family_accessions=family_accessions,
+                    chunk_size=chunk_size,
+                    data_partitions_dirpath=data_partitions_dirpath,
+                    gcs_bucket=gcs_bucket)))
+
+    else:
+        pfam_df = read_all_shards(partition=partition,
                                   data_dir=data_partitions_dirpath,
                                   bucket_name=gcs_bucket)
 
-    pfam_df['mod_family_accession'] = pfam_df.family_accession.apply(
-        lambda x: mod_family_accession(x))
-    pfam_df = pfam_df[pfam_df.mod_family_accession.isin(family_accessions)]
-    pfam_df['index'] = pfam_df.family_id.apply(lambda x: family_id_to_index[x])
+        pfam_df['mod_family_accession'] = mod_family_accessions(
+            pfam_df.family_accession)
+        pfam_df = pfam_df[pfam_df.mod_family_accession.isin(
+            family_accessions)].copy()
+        pfam_df['index'] = family_ids_to_indexes(pfam_df.family_id)
+        pfam_df['sequence_length'] = np.minimum(
+            pfam_df.sequence.str.len().values, PFAM_MAX_SEQUENCE_LENGTH)
+
+        pfam_df['one_hot_inds'] = list(
+            residues_to_one_hot_inds_matrix(pfam_df.sequence))
+
+    return pfam_df
+
+
+def sample_pfam_df(family_accessions,
+                   sample_sizes,
+                   test=False,
+                   random_state=0,
+                   data_partitions_dirpath='random_split/',
+                   gcs_bucket='neuralblast_public',
+                   store_dir=None,
+                   chunk_size=None):
+    """Draws nested per-family samples of the given families in a single pass.
+
+    Returns a dictionary mapping each entry of sample_sizes to a featurized
+    dataframe, where smaller samples are subsets of larger ones. With a token
+    store only the family columns are scanned and the tokens of the sampled
+    rows are read.
+    """
+
+    if test:
+        partition = 'test'
+    else:
+        partition = 'train'
+
+    max_samples = max(sample_sizes)
+
+    if store_dir is not None:
+        store = get_pfam_token_store(
+            store_dir,
+            partition,
+            data_partitions_dirpath=data_partitions_dirpath,
+            gcs_bucket=gcs_bucket)
+
+        rows = get_pfam_token_store_rows(store, family_accessions)
+        rows = rows[np.argsort(store['row_ids'][rows], kind='stable')]
 
-    pfam_df['one_hot_inds'] = pfam_df.sequence.apply(
-        lambda x: residues_to_one_hot_inds(x[:512]))
+        sampled = sample_pfam_features(
+            [{
+                'mod_family_accession': store['mod_family_accession'][rows],
+                'store_row': rows
+            }],
+            samples=max_samples,
+            random_state=random_state)
+
+        features = gather_pfam_token_store_rows(store, sampled['store_row'])
+        features['sample_rank'] = sampled['sample_rank']
+
+    else:
+        if chunk_size is None:
+            chunk_size = 100000
+
+        features = sample_pfam_features(stream_pfam_features(
+            partition,
+            family_accessions=family_accessions,
+            chunk_size=chunk_size,
+            data_partitions_dirpath=data_partitions_dirpath,
+            gcs_bucket=gcs_bucket),
+                                        samples=max_samples,
+                                        random_state=random_state)
+
+    pfam_dfs = {}
+    for samples, sample_features in nested_pfam_samples(
+            features, sample_sizes).items():
+        pfam_dfs[samples] = pfam_features_to_df(sample_features)
+
+    return pfam_dfs
+
+
+def pfam_df_cache_key(family_accessions,
+                      test=False,
+                      samples=None,
+                      random_state=0,
+                      data_partitions_dirpath='random_split/',
+                      gcs_bucket='neuralblast_public',
+                      store_dir=None,
+                      reservoir_sampling=False):
+    """Key of a create_pfam_df call in PFAM_DF_CACHE."""
+
+    key = (tuple(family_accessions), test, data_partitions_dirpath,
+           gcs_bucket, store_dir)
+    if samples is not None:
+        key += (samples, random_state, reservoir_sampling)
+    else:
+        key += (None, None, False)
+
+    return key
+
+
+def cache_nested_pfam_dfs(family_accessions,
+                          sample_sizes,
+                          test=False,
+                          random_state=0,
+                          data_partitions_dirpath='random_split/',
+                          gcs_bucket='neuralblast_public',
+                          store_dir=None,
+                          chunk_size=None):
+    """Caches nested reservoir samples of the given families from a single pass,
+    for later create_pfam_df calls with reservoir_sampling=True.
+    """
+
+    if PFAM_DF_CACHE.max_bytes <= 0:
+        return
+
+    pfam_dfs = sample_pfam_df(family_accessions,
+                              sample_sizes,
+                              test=test,
+                              random_state=random_state,
+                              data_partitions_dirpath=data_partitions_dirpath,
+                              gcs_bucket=gcs_bucket,
+                              store_dir=store_dir,
+                              chunk_size=chunk_size)
+
+    for samples, pfam_df in pfam_dfs.items():
+        key = pfam_df_cache_key(family_accessions,
+                                test=test,
+                                samples=samples,
+                                random_state=random_state,
+                                data_partitions_dirpath=data_partitions_dirpath,
+                                gcs_bucket=gcs_bucket,
+                                store_dir=store_dir,
+                                reservoir_sampling=True)
+        PFAM_DF_CACHE.put(key, pfam_df)
+
+
+def create_pfam_df(family_accessions,
+                   test=False,
+                   samples=None,
+                   random_state=0,
+                   data_partitions_dirpath='random_split/',
+                   gcs_bucket='neuralblast_public',
+                   store_dir=None,
+                   chunk_size=None,
+                   use_cache=True,
+                   reservoir_sampling=False):
+    """Processes Pfam data into a featurized dataframe with samples many entries per family.
+
+    With reservoir_sampling, samples are drawn per family in a single pass
+    over the data (see sample_pfam_features) instead of shuffling the whole
+    filtered dataframe.
+    """
+
+    key = pfam_df_cache_key(family_accessions,
+                            test=test,
+                            samples=samples,
+                            random_state=random_state,
+                            data_partitions_dirpath=data_partitions_dirpath,
+                            gcs_bucket=gcs_bucket,
+                            store_dir=store_dir,
+                            reservoir_sampling=reservoir_sampling)
+    load_key = pfam_df_cache_key(
+        family_accessions,
+        test=test,
+        data_partitions_dirpath=data_partitions_dirpath,
+        gcs_bucket=gcs_bucket,
+        store_dir=store_dir)
+
+    # A disabled cache is skipped, so dataframes are not copied for it.
+    use_cache = use_cache and PFAM_DF_CACHE.max_bytes > 0
+
+    if use_cache:
+        pfam_df = PFAM_DF_CACHE.get(key)
+        if pfam_df is not None:
+            return pfam_df
+
+    if samples is not None and reservoir_sampling:
+        pfam_df = sample_pfam_df(
+            family_accessions, [samples],
+            test=test,
+            random_state=random_state,
+            data_partitions_dirpath=data_partitions_dirpath,
+            gcs_bucket=gcs_bucket,
+            store_dir=store_dir,
+            chunk_size=chunk_size)[samples]
+
+        if use_cache:
+            PFAM_DF_CACHE.put(key, pfam_df)
+            pfam_df = pfam_df.copy()
+
+        return pfam_df
+
+    # Sampled dataframes are derived from the cached unsampled dataframe
+    # of the same families, so each partition is only loaded once.
+    pfam_df = None
+    if use_cache and samples is not None:
+        pfam_df = PFAM_DF_CACHE.get(load_key)
+
+    if pfam_df is None:
+        pfam_df = load_pfam_df(family_accessions,
+                               test=test,
+                               data_partitions_dirpath=data_partitions_dirpath,
+                               gcs_bucket=gcs_bucket,
+                               store_dir=store_dir,
+                               chunk_size=chunk_size)
+        if use_cache and samples is not None:
+            PFAM_DF_CACHE.put(load_key, pfam_df.copy())
 
     if samples is not None:
         pfam_df = pfam_df.sample(frac=1,
@@ -127,6 +902,10 @@ def create_pfam_df(family_accessions,
         pfam_df = pfam_df.groupby('mod_family_accession').head(
             samples).reset_index()
 
+    if use_cache:
+        PFAM_DF_CACHE.put(key, pfam_df)
+        pfam_df = pfam_df.copy()
+
     return pfam_df
 
 
@@ -141,7 +920,10 @@ def create_pfam_seq_batches(family_accessions,
                             sample_random_state=0,
                             data_partitions_dirpath='random_split/',
                             gcs_bucket='neuralblast_public',
-                            as_numpy=False):
+                            as_numpy=False,
+                            store_dir=None,
+                            chunk_size=None,
+                            reservoir_sampling=False):
     """Creates iterable object of Pfam sequences."""
 
     pfam_df = create_pfam_df(family_accessions,
@@ -149,7 +931,10 @@ def create_pfam_seq_batches(family_accessions,
                              samples=samples,
                              random_state=sample_random_state,
                              data_partitions_dirpath=data_partitions_dirpath,
-                             gcs_bucket=gcs_bucket)
+                             gcs_bucket=gcs_bucket,
+                             store_dir=store_dir,
+                             chunk_size=chunk_size,
+                             reservoir_sampling=reservoir_sampling)
 
     pfam_batches = create_data_iterator(df=pfam_df,
                                         input_col='one_hot_inds',
@@ -176,18 +961,38 @@ def create_pfam_batches(family_accessions,
                         sample_random_state=0,
                         data_partitions_dirpath='random_split/',
                         gcs_bucket='neuralblast_public',
-                        as_numpy=True):
-    """Creates iterable object of Pfam data batches."""
+                        as_numpy=True,
+                        store_dir=None,
+                        chunk_size=None,
+                        reservoir_sampling=False,
+                        bucket_boundaries=None,
+                        add_sequence_ids=False):
+    """Creates iterable object of Pfam data batches.
+
+    If bucket_boundaries is specified, batches are grouped by sequence length
+    and shuffled, so they no longer follow the order of the returned indexes.
+    With add_sequence_ids, the encoder cache ids of all sequences are hashed
+    once and batch inputs are {'x': one_hot_inds, 'ids': ids}, as taken by
+    EncoderFeatureBatches.
+    """
 
     pfam_df = create_pfam_df(family_accessions,
                              test=test,
                              samples=samples,
                              random_state=sample_random_state,
                              data_partitions_dirpath=data_partitions_dirpath,
-                             gcs_bucket=gcs_bucket)
+                             gcs_bucket=gcs_bucket,
+                             store_dir=store_dir,
+                             chunk_size=chunk_size,
+                             reservoir_sampling=reservoir_sampling)
 
     pfam_indexes = pfam_df['index'].values
 
+    if add_sequence_ids:
+        one_hot_inds = np.stack(pfam_df['one_hot_inds'].values)
+        pfam_df['sequence_id'] = sequence_ids(
+            one_hot_inds, token_lengths(one_hot_inds, PFAM_NUM_CATEGORIES - 1))
+
     pfam_batches = create_data_iterator(df=pfam_df,
                                         input_col='one_hot_inds',
                                         output_col='index',
@@ -196,20 +1001,77 @@ def create_pfam_batches(family_accessions,
                                         buffer_size=buffer_size,
                                         seed=shuffle_seed,
                                         drop_remainder=drop_remainder,
-                                        as_numpy=as_numpy)
+                                        as_numpy=as_numpy,
+                                        bucket_boundaries=bucket_boundaries,
+                                        length_col='sequence_length',
+                                        id_col='sequence_id'
+                                        if add_sequence_ids else None)
 
     return pfam_batches, pfam_indexes
 
 
 # Model evaluation.
+@functools.partial(jax.jit, static_argnums=(6, 7))
+def evaluate_batch(predict_fn, X, Y, valid_rows, totals, pred_indexes,
+                   num_classes, top_k):
+    """Adds the cross entropy, correct predictions and top_k hits of the first valid_rows rows of a batch to totals.
+
+    Predicted indexes of the batch are written into pred_indexes after
+    those of previous batches, as counted by totals['examples'].
+    """
+
+    if isinstance(X, dict):
+        Y_hat = predict_fn(**X)
+    else:
+        Y_hat = predict_fn(X)
+    Y_hat = Y_hat.astype(jnp.float32)
+
+    # One-hot encodings of padding rows marked -1 are all zeros.
+    valid = jnp.arange(Y.shape[0]) < valid_rows
+    Y = jnp.where(valid, Y, -1)
+
+    preds = jnp.argmax(Y_hat, axis=1).astype(jnp.int32)
+    true_logits = jnp.take_along_axis(Y_hat,
+                                      jnp.maximum(Y, 0)[:, jnp.newaxis],
+                                      axis=1)
+    ranks = jnp.sum(Y_hat > true_logits, axis=1)
+
+    totals = {
+        'cross_entropy':
+        totals['cross_entropy'] +
+        cross_entropy_loss(Y, Y_hat, num_classes=num_classes),
+        'correct':
+        totals['correct'] + jnp.sum(valid & (preds == Y)),
+        'top_k_hits':
+        totals['top_k_hits'] + jnp.sum(valid & (ranks < top_k)),
+        'examples':
+        totals['examples'] + valid_rows
+    }
+    pred_indexes = jax.lax.dynamic_update_slice(
+        pred_indexes, preds, (totals['examples'] - valid_rows, ))
+
+    return totals, pred_indexes
+
+
 def pfam_evaluate(predict_fn,
                   test_family_accessions,
                   title,
                   loss_fn_kwargs,
                   batch_size=512,
                   data_partitions_dirpath='random_split/',
-                  gcs_bucket='neuralblast_public'):
-    """Computes predicted family ids and measures performance in cross entropy and accuracy."""
+                  gcs_bucket='neuralblast_public',
+                  store_dir=None,
+                  chunk_size=None,
+                  prefetch_size=2,
+                  encoder_cache=None,
+                  top_k=5):
+    """Computes predicted family ids and measures performance in cross entropy, accuracy and top_k accuracy.
+
+    With encoder_cache, predict_fn is a cached encoder model and is applied
+    to the cached encoder features of the test sequences. Metrics and
+    predictions are accumulated on device by a compiled evaluate_batch on
+    batches padded to a fixed shape and copied to host once at the end.
+    """
 
     test_batches, test_indexes = create_pfam_batches(
         family_accessions=test_family_accessions,
@@ -217,48 +1079,150 @@ def pfam_evaluate(predict_fn,
         test=True,
         buffer_size=1,
         gcs_bucket=gcs_bucket,
-        data_partitions_dirpath=data_partitions_dirpath)
-
-    pred_indexes = []
-    cross_entropy = 0.
+        data_partitions_dirpath=data_partitions_dirpath,
+        store_dir=store_dir,
+        chunk_size=chunk_size,
+        add_sequence_ids=encoder_cache is not None)
+
+    if encoder_cache is not None:
+        test_batches = EncoderFeatureBatches(test_batches, encoder_cache,
+                                             PFAM_NUM_CATEGORIES - 1)
+
+    test_batches = PaddedBatches(test_batches)
+    prefetched_batches = DevicePrefetcher(test_batches,
+                                          buffer_size=prefetch_size)
+
+    totals = {
+        'cross_entropy': jnp.zeros((), dtype=jnp.float32),
+        'correct': jnp.zeros((), dtype=jnp.int32),
+        'top_k_hits': jnp.zeros((), dtype=jnp.int32),
+        'examples': jnp.zeros((), dtype=jnp.int32)
+    }
+    pred_indexes = None
 
-    for batch in iter(test_batches):
+    for batch in iter(prefetched_batches):
 
         X, Y = batch
 
-        Y_hat = predict_fn(X)
-
-        cross_entropy += cross_entropy_loss(Y, Y_hat, **loss_fn_kwargs)
+        # Room for the padding rows of the last batch.
+        if pred_indexes is None:
+            pred_indexes = jnp.zeros(len(test_indexes) + Y.shape[0],
+                                     dtype=jnp.int32)
 
-        preds = jnp.argmax(Y_hat, axis=1)
-        for pred in preds:
-            pred_indexes.append(pred)
+        totals, pred_indexes = evaluate_batch(predict_fn, X, Y,
+                                              test_batches.valid_rows.popleft(),
+                                              totals, pred_indexes,
+                                              loss_fn_kwargs['num_classes'],
+                                              top_k)
 
-    pred_indexes = np.array(pred_indexes)
-
-    acc = metrics.accuracy_score(test_indexes, pred_indexes)
+    totals, pred_indexes = jax.device_get((totals, pred_indexes))
+    examples = int(totals['examples'])
+    if pred_indexes is None:
+        pred_indexes = np.zeros(0, dtype=np.int32)
+    pred_indexes = np.asarray(pred_indexes)[:examples]
 
     results = {
         'title': title,
-        'cross_entropy': cross_entropy,
-        'accuracy': acc,
+        'cross_entropy': float(totals['cross_entropy']),
+        'accuracy': int(totals['correct']) / max(examples, 1),
+        'top_' + str(top_k) + '_accuracy':
+        int(totals['top_k_hits']) / max(examples, 1),
     }
 
     return results, pred_indexes
 
 
-def compute_embeddings(encoder, data_batches):
-    """Computes sequence embeddings according to a specified encoder."""
+def fill_pfam_encoder_cache(encoder,
+                            encoder_cache,
+                            family_accessions,
+                            test=False,
+                            samples=None,
+                            random_state=0,
+                            data_partitions_dirpath='random_split/',
+                            gcs_bucket='neuralblast_public',
+                            store_dir=None,
+                            chunk_size=None,
+                            reservoir_sampling=False,
+                            batch_size=64):
+    """Adds the encoder outputs of the sequences of a Pfam dataframe to encoder_cache."""
 
-    vectors = []
-    for batch in iter(data_batches):
+    pfam_df = create_pfam_df(family_accessions,
+                             test=test,
+                             samples=samples,
+                             random_state=random_state,
+                             data_partitions_dirpath=data_partitions_dirpath,
+                             gcs_bucket=gcs_bucket,
+                             store_dir=store_dir,
+                             chunk_size=chunk_size,
+                             reservoir_sampling=reservoir_sampling)
+
+    return fill_encoder_cache(encoder,
+                              encoder_cache,
+                              np.stack(pfam_df['one_hot_inds'].values),
+                              pad_ind=PFAM_NUM_CATEGORIES - 1,
+                              batch_size=batch_size)
+
+
+@jax.jit
+def embed_batch(encoder, X):
+    """Float32 embeddings of X, compiled once per encoder module and batch shape."""
+
+    return encoder(X).astype(jnp.float32)
+
+
+def compute_embeddings(encoder,
+                       data_batches,
+                       prefetch_size=2,
+                       num_vectors=None,
+                       out_path=None):
+    """Computes sequence embeddings according to a specified encoder.
+
+    Batches are padded to a fixed shape and embedded by a compiled function
+    taking the encoder parameters as an argument. Each batch is copied to
+    host while the next one is computed, into an array preallocated for
+    num_vectors embeddings (by default an upper bound from the number of
+    batches) and memory-mapped at out_path if specified.
+    """
+
+    data_batches = PaddedBatches(data_batches)
+    prefetched_batches = DevicePrefetcher(data_batches,
+                                          buffer_size=prefetch_size)
+
+    vectors = None
+    start = 0
+
+    def store(X_embedded, valid_rows):
+        nonlocal vectors, start
+        if vectors is None:
+            if num_vectors is None:
+                shape = (len(data_batches) * X_embedded.shape[0],
+                         X_embedded.shape[1])
+            else:
+                shape = (num_vectors, X_embedded.shape[1])
+            if out_path is None:
+                vectors = np.empty(shape, dtype=np.float32)
+            else:
+                vectors = np.lib.format.open_memmap(out_path,
+                                                    mode='w+',
+                                                    dtype=np.float32,
+                                                    shape=shape)
+        vectors[start:start + valid_rows] = np.asarray(X_embedded)[:valid_rows]
+        start += valid_rows
+
+    pending = None
+    for batch in iter(prefetched_batches):
         X, Y = batch
-        X_embedded = encoder(X)
-        for vec in np.array(X_embedded):
-            vectors.append(vec)
-    vectors = np.array(vectors)
+        X_embedded = embed_batch(encoder, X)
+        if pending is not None:
+            store(*pending)
+        pending = (X_embedded, data_batches.valid_rows.popleft())
+    if pending is not None:
+        store(*pending)
+
+    if vectors is None:
+        return np.zeros((0, 0), dtype=np.float32)
 
-    return vectors
+    return vectors[:start]
 
 
 def pfam_nearest_neighbors_classification(
@@ -271,8 +1235,16 @@ def pfam_nearest_neighbors_classification(
         shuffle_seed=0,
         sample_random_state=0,
         data_partitions_dirpath='random_split/',
-        gcs_bucket='neuralblast_public'):
-    """Nearest neighbors classification on Pfam families using specified encoder."""
+        gcs_bucket='neuralblast_public',
+        store_dir=None,
+        chunk_size=None,
+        reservoir_sampling=False,
+        knn_backend='auto'):
+    """Nearest neighbors classification on Pfam families using specified encoder.
+
+    Neighbors are found exactly by blocked matrix multiplication, with
+    knn_backend as in knn.KNeighborsClassifier.
+    """
 
     train_batches, train_indexes = create_pfam_batches(
         family_accessions=family_accessions,
@@ -282,7 +1254,10 @@ def pfam_nearest_neighbors_classification(
         shuffle_seed=shuffle_seed,
         sample_random_state=sample_random_state,
         data_partitions_dirpath=data_partitions_dirpath,
-        gcs_bucket=gcs_bucket)
+        gcs_bucket=gcs_bucket,
+        store_dir=store_dir,
+        chunk_size=chunk_size,
+        reservoir_sampling=reservoir_sampling)
     test_batches, test_indexes = create_pfam_batches(
         family_accessions=family_accessions,
         batch_size=batch_size,
@@ -292,12 +1267,19 @@ def pfam_nearest_neighbors_classification(
         shuffle_seed=shuffle_seed,
         sample_random_state=sample_random_state,
         data_partitions_dirpath=data_partitions_dirpath,
-        gcs_bucket=gcs_bucket)
-
-    train_vectors = compute_embeddings(encoder, train_batches)
-    test_vectors = compute_embeddings(encoder, test_batches)
-
-    knn_classifier = knn(n_neighbors=n_neighbors)
+        gcs_bucket=gcs_bucket,
+        store_dir=store_dir,
+        chunk_size=chunk_size,
+        reservoir_sampling=reservoir_sampling)
+
+    train_vectors = compute_embeddings(encoder,
+                                       train_batches,
+                                       num_vectors=len(train_indexes))
+    test_vectors = compute_embeddings(encoder,
+                                      test_batches,
+                                      num_vectors=len(test_indexes))
+
+    knn_classifier = knn(n_neighbors=n_neighbors, backend=knn_backend)
     knn_classifier.fit(train_vectors, train_indexes)
     knn_predictions = knn_classifier.predict(test_vectors)
 
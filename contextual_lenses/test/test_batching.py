@@ -0,0 +1,239 @@
+"""Tests for batching data into iterators."""
+
+
+import numpy as np
+
+import pandas as pd
+
+from absl.testing import parameterized
+from absl.testing import absltest
+
+from train_utils import create_data_iterator, DevicePrefetcher, PackedBatches, \
+unpack_outputs
+
+
+def generate_random_df(num_rows=100, seq_len=512, pad_ind=26):
+  """Generates a dataframe of num_rows many padded random sequences and their indexes."""
+
+  np.random.seed(0)
+  lengths = np.random.randint(1, seq_len + 1, size=num_rows)
+  inputs = np.full((num_rows, seq_len), pad_ind)
+  for i, length in enumerate(lengths):
+    inputs[i, :length] = np.random.randint(0, pad_ind, size=length)
+
+  df = pd.DataFrame({'index': np.arange(num_rows),
+                     'sequence_length': lengths,
+                     'one_hot_inds': list(inputs)})
+
+  return df
+
+
+class TestBatching(parameterized.TestCase):
+  """Checks that NumPy batches cover every row once per epoch, with and without a remainder."""
+
+  @parameterized.parameters(
+      (8, None, False), (8, 1, True), (7, 10, False), (200, None, False)
+  )
+  def test_batching(self, batch_size, buffer_size, drop_remainder):
+
+    df = generate_random_df(num_rows=100)
+
+    batches = create_data_iterator(df=df, input_col='one_hot_inds', output_col='index',
+                                   batch_size=batch_size, epochs=3, buffer_size=buffer_size,
+                                   drop_remainder=drop_remainder)
+
+    num_batches = 0
+    indexes = []
+    for X, Y in batches:
+      self.assertTrue((np.stack(df['one_hot_inds'].values[Y])==X).all())
+      if drop_remainder:
+        self.assertTrue(len(Y)==batch_size)
+      indexes.append(Y)
+      num_batches += 1
+    indexes = np.concatenate(indexes)
+
+    self.assertTrue(num_batches==len(batches))
+    if not drop_remainder:
+      self.assertTrue(len(indexes)==3*len(df))
+    for epoch in range(len(indexes) // len(df)):
+      epoch_indexes = indexes[epoch*len(df):(epoch + 1)*len(df)]
+      self.assertTrue((np.sort(epoch_indexes)==np.arange(len(df))).all())
+      if buffer_size == 1:
+        self.assertTrue((epoch_indexes==np.arange(len(df))).all())
+
+    # Iterating again with the same seed repeats the same batches.
+    self.assertTrue((np.concatenate([Y for _, Y in batches])==indexes).all())
+
+
+class TestBucketing(parameterized.TestCase):
+  """Checks that bucketed batches are cut to a bucket boundary and cover every row once per epoch."""
+
+  @parameterized.parameters(
+      (8, False), (8, True), (16, False)
+  )
+  def test_bucketing(self, batch_size, drop_remainder):
+
+    df = generate_random_df()
+    bucket_boundaries = [64, 128, 256, 512]
+
+    batches = create_data_iterator(df=df, input_col='one_hot_inds', output_col='index',
+                                   batch_size=batch_size, epochs=2,
+                                   drop_remainder=drop_remainder,
+                                   bucket_boundaries=bucket_boundaries,
+                                   length_col='sequence_length')
+
+    counts = np.zeros(len(df))
+    for X, Y in batches:
+      self.assertTrue(X.shape[1] in bucket_boundaries)
+      self.assertTrue(len(Y) <= batch_size)
+      if drop_remainder:
+        self.assertTrue(len(Y)==batch_size)
+      self.assertTrue((df['sequence_length'].values[Y] <= X.shape[1]).all())
+      self.assertTrue((np.stack(df['one_hot_inds'].values[Y])[:, :X.shape[1]]==X).all())
+      counts[Y] += 1
+
+    if not drop_remainder:
+      self.assertTrue((counts==2).all())
+    else:
+      self.assertTrue((counts <= 2).all())
+
+
+class TestIds(parameterized.TestCase):
+  """Checks that batches built with an id column carry the ids of their rows."""
+
+  @parameterized.parameters(
+      None, [64, 128, 256, 512]
+  )
+  def test_ids(self, bucket_boundaries):
+
+    df = generate_random_df(num_rows=100)
+    df['id'] = 7 * df['index'].values
+
+    batches = create_data_iterator(df=df, input_col='one_hot_inds', output_col='index',
+                                   batch_size=8, epochs=2, bucket_boundaries=bucket_boundaries,
+                                   length_col='sequence_length', id_col='id')
+
+    for X, Y in batches:
+      self.assertTrue((X['ids']==7*Y).all())
+      self.assertTrue((np.stack(df['one_hot_inds'].values[Y])[:, :X['x'].shape[1]]==X['x']).all())
+
+
+class TestResumption(parameterized.TestCase):
+  """Checks that a restored iterator yields exactly the batches after the saved position."""
+
+  @parameterized.parameters(
+      (None, 0), (None, 7), (None, 30), ([64, 128, 256, 512], 5), ([64, 128, 256, 512], 20)
+  )
+  def test_resumption(self, bucket_boundaries, num_batches):
+
+    df = generate_random_df(num_rows=100)
+
+    def create_batches():
+      return create_data_iterator(df=df, input_col='one_hot_inds', output_col='index',
+                                  batch_size=10, epochs=3, seed=1,
+                                  bucket_boundaries=bucket_boundaries,
+                                  length_col='sequence_length')
+
+    batches = create_batches()
+    expected_indexes = [Y for _, Y in batches]
+
+    state = batches.state_dict(num_batches)
+    resumed_batches = create_batches()
+    resumed_batches.load_state_dict(state)
+    resumed_indexes = [Y for _, Y in resumed_batches]
+
+    self.assertTrue(len(resumed_indexes)==len(expected_indexes) - num_batches)
+    for Y, expected_Y in zip(resumed_indexes, expected_indexes[num_batches:]):
+      self.assertTrue((Y==expected_Y).all())
+
+
+class TestDevicePrefetcher(parameterized.TestCase):
+  """Checks that prefetched batches match the wrapped batches in order."""
+
+  @parameterized.parameters(
+      1, 2, 8
+  )
+  def test_prefetcher(self, buffer_size):
+
+    df = generate_random_df(num_rows=100)
+    batches = create_data_iterator(df=df, input_col='one_hot_inds', output_col='index',
+                                   batch_size=8, epochs=2)
+
+    prefetched_batches = DevicePrefetcher(batches, buffer_size=buffer_size)
+
+    num_batches = 0
+    for (X, Y), (expected_X, expected_Y) in zip(prefetched_batches, batches):
+      self.assertTrue((np.array(X)==expected_X).all())
+      self.assertTrue((np.array(Y)==expected_Y).all())
+      num_batches += 1
+
+    self.assertTrue(num_batches==len(batches))
+    self.assertTrue(prefetched_batches.stall_stats()['batches']==len(batches))
+    self.assertTrue(prefetched_batches.stall_stats()['stalls'] <= len(batches))
+
+
+class TestPacking(parameterized.TestCase):
+  """Checks that packed rows hold every sequence once and resume at the saved position."""
+
+  @parameterized.parameters(
+      (1, 4, 0),
+      (3, 4, 0),
+      (8, 2, 5)
+  )
+  def test_packing(self, max_segments, batch_rows, gap):
+
+    df = generate_random_df(num_rows=100, seq_len=64, pad_ind=26)
+    batches = create_data_iterator(df=df, input_col='one_hot_inds', output_col='index',
+                                   batch_size=16, buffer_size=1)
+    packed_batches = list(PackedBatches(batches, max_segments=max_segments,
+                                        batch_rows=batch_rows, pad_ind=26, gap=gap))
+
+    packed_indexes = []
+    for X, Y in packed_batches:
+      self.assertEqual(X['x'].shape, (batch_rows, 64))
+      self.assertEqual(Y.shape, (batch_rows * max_segments,))
+      for row, segment_ids in zip(X['x'], X['segment_ids']):
+        self.assertTrue(((row < 26) == (segment_ids > 0)).all())
+        self.assertTrue(segment_ids.max() <= max_segments)
+      for index in unpack_outputs(Y, Y):
+        row, segment = divmod(list(Y).index(index), max_segments)
+        sequence = X['x'][row][X['segment_ids'][row] == segment + 1]
+        length = df['sequence_length'].values[index]
+        self.assertTrue((sequence == df['one_hot_inds'].values[index][:length]).all())
+        packed_indexes.append(index)
+
+    self.assertEqual(packed_indexes, list(range(100)))
+    if max_segments > 1:
+      self.assertLess(len(packed_batches) * batch_rows, 100)
+
+  @parameterized.parameters(
+      0, 3, 9
+  )
+  def test_packing_resumption(self, num_batches):
+
+    df = generate_random_df(num_rows=100, seq_len=64, pad_ind=26)
+
+    def create_packed_batches():
+      batches = create_data_iterator(df=df, input_col='one_hot_inds', output_col='index',
+                                     batch_size=16, epochs=2, seed=1)
+      return PackedBatches(batches, max_segments=3, batch_rows=4, pad_ind=26)
+
+    packed_batches = create_packed_batches()
+    expected_indexes = [Y for _, Y in packed_batches]
+    self.assertGreater(len(expected_indexes), 9)
+
+    state = packed_batches.state_dict(num_batches)
+    resumed_batches = create_packed_batches()
+    resumed_batches.load_state_dict(state)
+    resumed_indexes = [Y for _, Y in resumed_batches]
+
+    self.assertEqual(len(resumed_indexes), len(expected_indexes) - num_batches)
+    for Y, expected_Y in zip(resumed_indexes, expected_indexes[num_batches:]):
+      self.assertTrue((Y==expected_Y).all())
+
+    unresumable_batches = PackedBatches([], max_segments=3, batch_rows=4, pad_ind=26)
+    self.assertFalse(hasattr(unresumable_batches, 'state_dict'))
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -0,0 +1,137 @@
+"""Tests for encoder_cache.py."""
+
+
+import tempfile
+
+import jax.numpy as jnp
+
+from flax import nn
+
+import numpy as np
+
+from absl.testing import parameterized
+from absl.testing import absltest
+
+from contextual_lenses import linear_max_pool, linear_mean_pool, gated_conv
+
+from encoders import cnn_one_hot_encoder
+
+from train_utils import create_representation_model, \
+create_cached_encoder_representation_model
+
+from encoder_cache import EncoderFeatureCache, EncoderFeatureBatches, \
+fill_encoder_cache, encoder_cache_key, sequence_ids, token_lengths
+
+
+def generate_padded_sequences(batch_size=6, seq_len=12, num_categories=21):
+  """Generates batch_size many random sequences of varying length padded with num_categories-1."""
+
+  np.random.seed(0)
+  input_data = np.random.randint(0, num_categories-1, size=(batch_size, seq_len))
+  lengths = np.random.randint(1, seq_len+1, size=batch_size)
+  for row, length in zip(input_data, lengths):
+    row[length:] = num_categories-1
+
+  return input_data
+
+
+class TestEncoderFeatureCache(parameterized.TestCase):
+  """Checks that cached features round-trip through shards and that sequence ids only depend on tokens."""
+
+  def test_add_and_get(self):
+
+    ids = np.array([7, 3, 5])
+    features = [np.random.normal(size=(length, 4)) for length in [2, 5, 1]]
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+      cache = EncoderFeatureCache(cache_dir, 'key')
+      cache.add(ids, features)
+      cache.add(ids[:1], [np.zeros((2, 4))])
+
+      # Shards are found again by a new cache object.
+      cache = EncoderFeatureCache(cache_dir, 'key')
+      self.assertEqual(len(cache.shards), 1)
+      self.assertEqual(cache.feature_size, 4)
+      self.assertTrue(cache.contains(ids).all())
+      self.assertFalse(cache.contains(np.array([4]))[0])
+
+      cached_features = cache.get(ids[::-1], 3)
+      self.assertEqual(cached_features.shape, (3, 3, 4))
+      for cached, expected in zip(cached_features, features[::-1]):
+        length = min(len(expected), 3)
+        self.assertTrue(np.allclose(cached[:length], expected[:length], atol=1e-2))
+        self.assertTrue((cached[length:]==0).all())
+
+      with self.assertRaises(KeyError):
+        cache.get(np.array([4]), 3)
+
+      self.assertEqual(EncoderFeatureCache(cache_dir, 'other_key').feature_size, None)
+
+  def test_sequence_ids(self):
+
+    one_hot_inds = np.array([[1, 2, 20, 20],
+                             [1, 2, 3, 20],
+                             [1, 2, 20, 20]])
+    lengths = token_lengths(one_hot_inds, pad_ind=20)
+    ids = sequence_ids(one_hot_inds, lengths)
+
+    self.assertTrue((lengths==np.array([2, 3, 2])).all())
+    self.assertEqual(ids[0], ids[2])
+    self.assertNotEqual(ids[0], ids[1])
+    self.assertTrue((sequence_ids(one_hot_inds, lengths, chunk_size=2)==ids).all())
+    self.assertTrue((sequence_ids(one_hot_inds[:, :3], lengths)==ids).all())
+    self.assertNotEqual(encoder_cache_key('cnn_one_hot', {'n_layers': 1}, None),
+                        encoder_cache_key('cnn_one_hot', {'n_layers': 2}, None))
+
+
+class TestCachedEncoderModel(parameterized.TestCase):
+  """Checks that lenses on cached encoder features predict as the full model does."""
+
+  @parameterized.parameters(
+      (linear_max_pool, {'rep_size': 16}, 'Dense'),
+      (linear_mean_pool, {'rep_size': 16}, 'Dense'),
+      (gated_conv, {'rep_size': 16, 'm_layers': 2, 'm_features': [[8, 8]],
+                    'm_kernel_sizes': [[3, 3], [3, 3]], 'conv_rep_size': 8,
+                    'mask_padding': True}, 'GatedConv')
+  )
+  def test_cached_encoder_model(self, reduce_fn, reduce_fn_kwargs, lens_layer):
+
+    input_data = generate_padded_sequences(batch_size=6, seq_len=12, num_categories=21)
+    output_data = np.arange(6)
+
+    model = create_representation_model(encoder_fn=cnn_one_hot_encoder,
+                                        encoder_fn_kwargs={'n_layers': 1, 'n_features': [8],
+                                                           'n_kernel_sizes': [3],
+                                                           'mask_padding': True},
+                                        reduce_fn=reduce_fn,
+                                        reduce_fn_kwargs=reduce_fn_kwargs,
+                                        num_categories=21,
+                                        output_features=4)
+    encoder = nn.Model(model.module.partial(output='encoding'), model.params)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+      cache = EncoderFeatureCache(cache_dir, 'key')
+      fill_encoder_cache(encoder, cache, input_data, pad_ind=20, batch_size=4, shard_size=4)
+      self.assertEqual(len(cache.shards), 2)
+
+      cached_model = create_cached_encoder_representation_model(
+          reduce_fn=reduce_fn,
+          reduce_fn_kwargs=reduce_fn_kwargs,
+          num_categories=21,
+          output_features=4,
+          feature_size=cache.feature_size,
+          reduce_fn_params=model.params[lens_layer + '_1'],
+          predict_fn_params=model.params['Dense_2'])
+      self.assertEqual(set(cached_model.params.keys()), {lens_layer + '_0', 'Dense_1'})
+
+      # Ids are hashed per batch unless the batches carry them.
+      ids = sequence_ids(input_data, token_lengths(input_data, pad_ind=20))
+      for inputs in [input_data, {'x': input_data, 'ids': ids}]:
+        batches = EncoderFeatureBatches([(inputs, output_data)], cache, pad_ind=20)
+        for X, Y in batches:
+          self.assertTrue((Y==output_data).all())
+          self.assertTrue(np.allclose(cached_model(**X), model(input_data), atol=1e-2))
+
+
+if __name__ == '__main__':
+  absltest.main()
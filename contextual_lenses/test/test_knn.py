@@ -0,0 +1,66 @@
+"""Tests for knn.py."""
+
+
+import numpy as np
+
+from sklearn.neighbors import KNeighborsClassifier as SklearnKNeighborsClassifier
+
+from absl.testing import parameterized
+from absl.testing import absltest
+
+from knn import KNeighborsClassifier, knn_vote
+
+
+class TestKNeighborsClassifier(parameterized.TestCase):
+  """Checks the blocked exact kNN against sklearn predictions."""
+
+  @parameterized.parameters(
+      ('l2', 1, 'uniform', 'numpy'),
+      ('l2', 5, 'distance', 'numpy'),
+      ('cosine', 5, 'uniform', 'numpy'),
+      ('l2', 1, 'uniform', 'jax'),
+      ('l2', 5, 'distance', 'jax'),
+      ('cosine', 5, 'uniform', 'jax')
+  )
+  def test_sklearn(self, metric, n_neighbors, weights, backend):
+
+    np.random.seed(0)
+    train_vectors = np.random.normal(size=(700, 64)).astype(np.float32)
+    train_labels = np.random.randint(0, 30, size=700)
+    test_vectors = np.random.normal(size=(300, 64)).astype(np.float32)
+
+    sklearn_knn = SklearnKNeighborsClassifier(n_neighbors=n_neighbors, weights=weights,
+                                              metric='euclidean' if metric=='l2' else metric,
+                                              algorithm='brute')
+    sklearn_knn.fit(train_vectors, train_labels)
+
+    # A small memory budget splits the train vectors into several blocks.
+    blocked_knn = KNeighborsClassifier(n_neighbors=n_neighbors, weights=weights, metric=metric,
+                                       memory_budget_bytes=2**16, backend=backend)
+    blocked_knn.fit(train_vectors, train_labels)
+
+    sklearn_distances, sklearn_indices = sklearn_knn.kneighbors(test_vectors)
+    distances, indices = blocked_knn.kneighbors(test_vectors)
+
+    self.assertTrue((indices==sklearn_indices).all())
+    self.assertTrue(np.allclose(distances, sklearn_distances, atol=1e-4))
+    self.assertTrue((blocked_knn.predict(test_vectors)==sklearn_knn.predict(test_vectors)).all())
+
+  def test_ties(self):
+
+    neighbor_labels = np.array([[3, 1, 2], [2, 2, 1], [4, 4, 1]])
+    neighbor_distances = np.array([[1., 1., 1.], [1., 1., 1.], [2., 2., 0.]])
+
+    self.assertEqual(knn_vote(neighbor_labels, neighbor_distances).tolist(), [1, 2, 4])
+    self.assertEqual(knn_vote(neighbor_labels, neighbor_distances, 'distance').tolist(),
+                     [1, 2, 1])
+
+    # Duplicated train vectors go to the smallest train index.
+    train_vectors = np.repeat(np.random.normal(size=(10, 8)), 3, axis=0)
+    blocked_knn = KNeighborsClassifier(n_neighbors=2, memory_budget_bytes=2**8, backend='numpy')
+    blocked_knn.fit(train_vectors, np.arange(30)[::-1])
+    self.assertEqual(blocked_knn.kneighbors(train_vectors[3:4])[1].tolist(), [[3, 4]])
+
+
+if __name__ == '__main__':
+  absltest.main()
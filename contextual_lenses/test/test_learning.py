@@ -1,11 +1,20 @@
 """End-to-end learning tests using MSE loss for contextual_lenses.py."""
 
 
+import os
+
+# Data-parallel tests need several devices, so CPU is split into four unless
+# jax was already initialized by another test module.
+if '--xla_force_host_platform_device_count' not in os.environ.get('XLA_FLAGS', ''):
+  os.environ['XLA_FLAGS'] = (os.environ.get('XLA_FLAGS', '') +
+                             ' --xla_force_host_platform_device_count=4').strip()
+
 import jax
 import jax.numpy as jnp
 
 import flax
 from flax import nn
+from flax import jax_utils
 
 import numpy as np
 
@@ -16,12 +25,16 @@ from contextual_lenses import mean_pool, max_pool, \
 linear_max_pool, linear_mean_pool, gated_conv 
 
 from train_utils import create_optimizer, train_step, \
-create_representation_model
+create_representation_model, multi_train_step, accumulated_train_step, \
+compute_loss_and_grad, trainable_mask, PackedBatches, create_packed_model, \
+unpack_outputs, packing_gap, train_sweep
+
+import train_utils
 
 from encoders import one_hot_encoder, cnn_one_hot_encoder, \
 one_hot_pos_emb_encoder, cnn_one_hot_pos_emb_encoder
 
-from loss_fns import mse_loss
+from loss_fns import mse_loss, cross_entropy_loss
 
 
 def generate_random_sequences(batch_size=3, seq_len=12, num_categories=21):
@@ -477,5 +490,484 @@ class TestLearning(parameterized.TestCase):
     self.assertTrue(train_loss < loss_threshold)
 
 
+class TestDataParallel(parameterized.TestCase):
+  """Checks that pmapped training ends with the parameters of single-device training."""
+
+  @parameterized.parameters(
+      (mse_loss, {}, 'mean', 1), (cross_entropy_loss, {'num_classes': 5}, 'sum', 5)
+  )
+  def test_data_parallel(self, loss_fn, loss_fn_kwargs, loss_reduction, output_features):
+
+    if jax.local_device_count() < 2:
+      self.skipTest('Data-parallel training needs at least 2 local devices.')
+
+    batch_size = 2*jax.local_device_count()
+    input_data = np.array(generate_random_sequences(batch_size=batch_size, seq_len=12,
+                                                    num_categories=21))
+    if loss_fn is mse_loss:
+      output_data = np.array(generate_random_targets(batch_size=batch_size))
+    else:
+      output_data = np.arange(batch_size) % output_features
+    batches = [(input_data, output_data)]*5
+
+    model = create_representation_model(encoder_fn=one_hot_encoder,
+                                        encoder_fn_kwargs={},
+                                        reduce_fn=linear_max_pool,
+                                        reduce_fn_kwargs={'rep_size': 16},
+                                        num_categories=21,
+                                        output_features=output_features)
+
+    optimizers = [train_utils.train(model, batches, loss_fn, loss_fn_kwargs, learning_rate=1e-2,
+                                    weight_decay=0., use_pmap=use_pmap,
+                                    loss_reduction=loss_reduction)
+                  for use_pmap in [False, True]]
+
+    for param, p_param in zip(jax.tree_leaves(optimizers[0].target.params),
+                              jax.tree_leaves(optimizers[1].target.params)):
+      self.assertTrue(np.allclose(param, p_param, atol=1e-5))
+
+
+class TestMultiTrainStep(parameterized.TestCase):
+  """Checks that multi_train_step gives the losses and parameters of successive train_steps."""
+
+  def test_multi_train_step(self):
+
+    steps = 4
+    input_data = np.array(generate_random_sequences(batch_size=3*steps, seq_len=12,
+                                                    num_categories=21)).reshape((steps, 3, 12))
+    output_data = np.array(generate_random_targets(batch_size=3*steps)).reshape((steps, 3))
+
+    model = create_representation_model(encoder_fn=one_hot_encoder,
+                                        encoder_fn_kwargs={},
+                                        reduce_fn=linear_max_pool,
+                                        reduce_fn_kwargs={'rep_size': 16},
+                                        num_categories=21,
+                                        output_features=1)
+    optimizer = create_optimizer(model, learning_rate=1e-2, weight_decay=0.)
+
+    expected_optimizer = optimizer
+    expected_losses = []
+    for X, Y in zip(input_data, output_data):
+      preds = jnp.squeeze(expected_optimizer.target(X), axis=1)
+      expected_losses.append(jnp.mean(jnp.square(preds-Y)))
+      expected_optimizer = train_step(expected_optimizer, X, Y, mse_loss, {})
+
+    optimizer, losses = multi_train_step(optimizer, input_data, output_data, mse_loss, {})
+
+    self.assertTrue(losses.shape==(steps,))
+    self.assertTrue(np.allclose(losses, expected_losses, atol=1e-5))
+    for param, expected_param in zip(jax.tree_leaves(optimizer.target.params),
+                                     jax.tree_leaves(expected_optimizer.target.params)):
+      self.assertTrue(np.allclose(param, expected_param, atol=1e-5))
+
+
+class TestGradientAccumulation(parameterized.TestCase):
+  """Checks that accumulating micro-batch gradients gives the full-batch update."""
+
+  @parameterized.parameters(
+      (mse_loss, {}, 'mean', 1), (cross_entropy_loss, {'num_classes': 5}, 'sum', 5)
+  )
+  def test_gradient_accumulation(self, loss_fn, loss_fn_kwargs, loss_reduction,
+                                 output_features):
+
+    input_data = generate_random_sequences(batch_size=8, seq_len=12, num_categories=21)
+    if loss_fn is mse_loss:
+      output_data = generate_random_targets(batch_size=8)
+    else:
+      output_data = jnp.arange(8) % output_features
+
+    model = create_representation_model(encoder_fn=one_hot_encoder,
+                                        encoder_fn_kwargs={},
+                                        reduce_fn=linear_max_pool,
+                                        reduce_fn_kwargs={'rep_size': 16},
+                                        num_categories=21,
+                                        output_features=output_features)
+    optimizer = create_optimizer(model, learning_rate=1e-2, weight_decay=0.)
+
+    expected_optimizer = train_step(optimizer, input_data, output_data, loss_fn,
+                                    loss_fn_kwargs)
+    optimizer = accumulated_train_step(optimizer, input_data, output_data, loss_fn,
+                                       loss_fn_kwargs, 4, loss_reduction)
+
+    for param, expected_param in zip(jax.tree_leaves(optimizer.target.params),
+                                     jax.tree_leaves(expected_optimizer.target.params)):
+      self.assertTrue(np.allclose(param, expected_param, atol=1e-5))
+
+
+class TestMixedPrecision(parameterized.TestCase):
+  """Checks that bfloat16 models keep float32 parameters and track float32 outputs."""
+
+  @parameterized.parameters(
+      (one_hot_encoder, {}, linear_max_pool, {'rep_size': 16}),
+      (cnn_one_hot_encoder, {'n_layers': 1, 'n_features': [16], 'n_kernel_sizes': [3]},
+       linear_mean_pool, {'rep_size': 16}),
+      (one_hot_encoder, {}, max_pool, {}),
+      (cnn_one_hot_encoder, {'n_layers': 1, 'n_features': [16], 'n_kernel_sizes': [3]},
+       mean_pool, {})
+  )
+  def test_mixed_precision(self, encoder_fn, encoder_fn_kwargs, reduce_fn, reduce_fn_kwargs):
+
+    input_data = generate_random_sequences(batch_size=3, seq_len=12, num_categories=21)
+    output_data = generate_random_targets(batch_size=3)
+
+    models = [create_representation_model(encoder_fn=encoder_fn,
+                                          encoder_fn_kwargs=encoder_fn_kwargs,
+                                          reduce_fn=reduce_fn,
+                                          reduce_fn_kwargs=reduce_fn_kwargs,
+                                          num_categories=21,
+                                          output_features=1,
+                                          dtype=dtype)
+              for dtype in [jnp.float32, jnp.bfloat16]]
+
+    preds, bf16_preds = [model(input_data) for model in models]
+    self.assertTrue(bf16_preds.dtype==jnp.bfloat16)
+    self.assertTrue(np.allclose(np.array(preds), np.array(bf16_preds, dtype=np.float32),
+                                atol=5e-2, rtol=5e-2))
+
+    optimizer = create_optimizer(models[1], learning_rate=1e-3, weight_decay=0.)
+    optimizer = train_step(optimizer, input_data, output_data, mse_loss, {})
+    for param in jax.tree_leaves(optimizer.target.params):
+      self.assertTrue(param.dtype==jnp.float32)
+
+
+class TestFrozenLayers(parameterized.TestCase):
+  """Checks that layers with learning rate 0 get no backward pass and stay fixed."""
+
+  def test_frozen_layers(self):
+
+    input_data = generate_random_sequences(batch_size=3, seq_len=12, num_categories=21)
+    output_data = generate_random_targets(batch_size=3)
+
+    model = create_representation_model(encoder_fn=cnn_one_hot_encoder,
+                                        encoder_fn_kwargs={'n_layers': 1, 'n_features': [16],
+                                                           'n_kernel_sizes': [3]},
+                                        reduce_fn=linear_max_pool,
+                                        reduce_fn_kwargs={'rep_size': 16},
+                                        num_categories=21,
+                                        output_features=1)
+
+    def count_convs(learning_rate):
+      optimizer = create_optimizer(model, learning_rate=learning_rate, weight_decay=[0., 0., 0.],
+                                   layers=['CNN_0', 'Dense_1', 'Dense_2'])
+      jaxpr = jax.make_jaxpr(lambda optimizer: compute_loss_and_grad(
+          optimizer, input_data, output_data, mse_loss, {}))(optimizer)
+      return str(jaxpr).count('conv_general_dilated'), optimizer
+
+    num_convs, _ = count_convs([1e-3, 1e-3, 1e-3])
+    frozen_num_convs, optimizer = count_convs([0., 1e-3, 1e-3])
+    self.assertEqual(frozen_num_convs, 1)
+    self.assertGreater(num_convs, frozen_num_convs)
+
+    mask = trainable_mask(optimizer)
+    self.assertFalse(any(jax.tree_leaves(mask.params['CNN_0'])))
+    self.assertTrue(all(jax.tree_leaves(mask.params['Dense_2'])))
+
+    _, grad = compute_loss_and_grad(optimizer, input_data, output_data, mse_loss, {})
+    for g in jax.tree_leaves(grad.params['CNN_0']):
+      self.assertTrue((g==0).all())
+
+    trained_optimizer = train_step(optimizer, input_data, output_data, mse_loss, {})
+    for param, initial_param in zip(jax.tree_leaves(trained_optimizer.target.params['CNN_0']),
+                                    jax.tree_leaves(model.params['CNN_0'])):
+      self.assertTrue(np.allclose(param, initial_param))
+
+  def test_data_parallel_frozen_layers(self):
+
+    if jax.local_device_count() < 2:
+      self.skipTest('Data-parallel training needs at least 2 local devices.')
+
+    batch_size = 2*jax.local_device_count()
+    input_data = np.array(generate_random_sequences(batch_size=batch_size, seq_len=12,
+                                                    num_categories=21))
+    output_data = np.array(generate_random_targets(batch_size=batch_size))
+    batches = [(input_data, output_data)]*3
+
+    model = create_representation_model(encoder_fn=cnn_one_hot_encoder,
+                                        encoder_fn_kwargs={'n_layers': 1, 'n_features': [16],
+                                                           'n_kernel_sizes': [3]},
+                                        reduce_fn=linear_max_pool,
+                                        reduce_fn_kwargs={'rep_size': 16},
+                                        num_categories=21,
+                                        output_features=1)
+    layers = ['CNN_0', 'Dense_1', 'Dense_2']
+    learning_rate = [0., 1e-2, 1e-2]
+    weight_decay = [0., 0., 0.]
+
+    optimizer = create_optimizer(model, learning_rate=learning_rate, weight_decay=weight_decay,
+                                 layers=layers)
+    mask = trainable_mask(optimizer.replicate())
+    self.assertFalse(any(jax.tree_leaves(mask.params['CNN_0'])))
+    self.assertTrue(all(jax.tree_leaves(mask.params['Dense_2'])))
+
+    p_train_step = train_utils.get_p_train_step()
+    shard = lambda x: x.reshape((jax.local_device_count(), -1) + x.shape[1:])
+    jaxpr = jax.make_jaxpr(lambda optimizer, X, Y: p_train_step(
+        optimizer, X, Y, mse_loss, {}, 'mean', 1))(jax_utils.replicate(optimizer),
+                                                   shard(input_data), shard(output_data))
+    self.assertEqual(str(jaxpr).count('conv_general_dilated'), 1)
+
+    optimizers = [train_utils.train(model, batches, mse_loss, {}, learning_rate=learning_rate,
+                                    weight_decay=weight_decay, layers=layers,
+                                    use_pmap=use_pmap, loss_reduction='mean')
+                  for use_pmap in [False, True]]
+
+    for param, initial_param in zip(jax.tree_leaves(optimizers[1].target.params['CNN_0']),
+                                    jax.tree_leaves(model.params['CNN_0'])):
+      self.assertTrue(np.allclose(param, initial_param))
+    for param, p_param in zip(jax.tree_leaves(optimizers[0].target.params),
+                              jax.tree_leaves(optimizers[1].target.params)):
+      self.assertTrue(np.allclose(param, p_param, atol=1e-5))
+
+
+class TestPacking(parameterized.TestCase):
+  """Checks that packed models predict each packed sequence as if it were alone."""
+
+  @parameterized.parameters(
+      (cnn_one_hot_encoder, {'n_layers': 2, 'n_features': [8, 8], 'n_kernel_sizes': [5, 3],
+                             'n_kernel_dilations': [1, 2], 'mask_padding': True},
+       linear_max_pool, {'rep_size': 16}),
+      (cnn_one_hot_encoder, {'n_layers': 1, 'n_features': [8], 'n_kernel_sizes': [3],
+                             'mask_padding': True},
+       gated_conv, {'rep_size': 16, 'm_layers': 2, 'm_features': [[8, 8]],
+                    'm_kernel_sizes': [[4, 4], [3, 3]], 'conv_rep_size': 8,
+                    'mask_padding': True}),
+      (one_hot_encoder, {}, mean_pool, {})
+  )
+  def test_packing(self, encoder_fn, encoder_fn_kwargs, reduce_fn, reduce_fn_kwargs):
+
+    np.random.seed(0)
+    lengths = np.random.randint(1, 13, size=10)
+    input_data = np.full((10, 12), 20)
+    for row, length in zip(input_data, lengths):
+      row[:length] = np.random.randint(0, 20, size=length)
+    output_data = np.arange(10)
+
+    model = create_representation_model(encoder_fn=encoder_fn,
+                                        encoder_fn_kwargs=encoder_fn_kwargs,
+                                        reduce_fn=reduce_fn,
+                                        reduce_fn_kwargs=reduce_fn_kwargs,
+                                        num_categories=21,
+                                        output_features=4)
+    packed_model = create_packed_model(model, max_segments=3)
+
+    gap = packing_gap(encoder_fn_kwargs, reduce_fn_kwargs)
+    packed_batches = PackedBatches([(input_data, output_data)], max_segments=3, batch_rows=2,
+                                   pad_ind=20, length=24, gap=gap)
+
+    for X, Y in packed_batches:
+      preds = unpack_outputs(np.array(packed_model(**X)), Y)
+      for pred, index in zip(preds, unpack_outputs(Y, Y)):
+        # The unpacked model masks the padding of its input explicitly.
+        expected_pred = model(input_data[index:index+1])[0]
+        self.assertTrue(np.allclose(pred, expected_pred, atol=1e-4))
+
+
+class BaselineCNN(nn.Module):
+  """CNN of encoders.py before packing support, without padding masks."""
+
+  def apply(self, x, n_layers, n_features, n_kernel_sizes, n_kernel_dilations):
+
+    if n_kernel_dilations is None:
+      n_kernel_dilations = [1] * n_layers
+
+    x = jnp.expand_dims(x, axis=2)
+
+    for layer in range(n_layers):
+      x = nn.Conv(x, features=n_features[layer], kernel_size=(n_kernel_sizes[layer], 1),
+                  kernel_dilation=(n_kernel_dilations[layer], 1))
+      x = nn.relu(x)
+
+    return jnp.squeeze(x, axis=2)
+
+
+def baseline_cnn_one_hot_encoder(batch_inds, num_categories, n_layers, n_features,
+                                 n_kernel_sizes, n_kernel_dilations=None):
+  """cnn_one_hot_encoder before packing support."""
+
+  one_hots = one_hot_encoder(batch_inds, num_categories)
+
+  return BaselineCNN(one_hots, n_layers, n_features, n_kernel_sizes, n_kernel_dilations)
+
+
+class BaselineGatedConv(nn.Module):
+  """GatedConv of contextual_lenses.py before packing support, without padding masks."""
+
+  def apply(self, x, rep_size, m_layers, m_features, m_kernel_sizes, conv_rep_size,
+            padding_mask=None):
+
+    H_0 = nn.relu(nn.Dense(x, conv_rep_size))
+    G_0 = nn.relu(nn.Dense(x, conv_rep_size))
+    H, G = jnp.expand_dims(H_0, axis=2), jnp.expand_dims(G_0, axis=2)
+
+    for layer in range(1, m_layers + 1):
+      if layer < m_layers:
+        H_features, G_features = m_features[layer - 1]
+      else:
+        H_features, G_features = conv_rep_size, conv_rep_size
+      H_kernel_size, G_kernel_size = m_kernel_sizes[layer - 1]
+
+      H = nn.Conv(H, features=H_features, kernel_size=(H_kernel_size, 1))
+      G = nn.Conv(G, features=G_features, kernel_size=(G_kernel_size, 1))
+
+      if layer < m_layers:
+        H, G = nn.relu(H), nn.relu(G)
+      else:
+        H, G = nn.tanh(H), nn.sigmoid(G)
+
+    H, G = jnp.squeeze(H, axis=2), jnp.squeeze(G, axis=2)
+
+    return linear_max_pool(H * G + G_0, padding_mask=padding_mask, rep_size=rep_size)
+
+
+def baseline_gated_conv(x, padding_mask=None, **kwargs):
+  """gated_conv before packing support."""
+
+  return BaselineGatedConv(x, padding_mask=padding_mask, **kwargs)
+
+
+class TestUnpackedBaseline(parameterized.TestCase):
+  """Checks that unpacked models without mask_padding compute what they did before packing support."""
+
+  @parameterized.parameters(
+      (cnn_one_hot_encoder, baseline_cnn_one_hot_encoder,
+       {'n_layers': 2, 'n_features': [8, 8], 'n_kernel_sizes': [5, 3], 'n_kernel_dilations': [1, 2]},
+       linear_max_pool, linear_max_pool, {'rep_size': 16}),
+      (one_hot_encoder, one_hot_encoder, {},
+       gated_conv, baseline_gated_conv, {'rep_size': 16, 'm_layers': 2, 'm_features': [[8, 8]],
+                                         'm_kernel_sizes': [[4, 4], [3, 3]], 'conv_rep_size': 8})
+  )
+  def test_unpacked_baseline(self, encoder_fn, baseline_encoder_fn, encoder_fn_kwargs,
+                             reduce_fn, baseline_reduce_fn, reduce_fn_kwargs):
+
+    np.random.seed(0)
+    lengths = np.random.randint(1, 13, size=6)
+    input_data = np.full((6, 12), 20)
+    for row, length in zip(input_data, lengths):
+      row[:length] = np.random.randint(0, 20, size=length)
+
+    model = create_representation_model(encoder_fn=encoder_fn,
+                                        encoder_fn_kwargs=encoder_fn_kwargs,
+                                        reduce_fn=reduce_fn,
+                                        reduce_fn_kwargs=reduce_fn_kwargs,
+                                        num_categories=21,
+                                        output_features=4)
+    baseline_model = create_representation_model(encoder_fn=baseline_encoder_fn,
+                                                 encoder_fn_kwargs=encoder_fn_kwargs,
+                                                 reduce_fn=baseline_reduce_fn,
+                                                 reduce_fn_kwargs=reduce_fn_kwargs,
+                                                 num_categories=21,
+                                                 output_features=4)
+    baseline_model = baseline_model.replace(params={
+        layer.replace('CNN', 'BaselineCNN').replace('GatedConv', 'BaselineGatedConv'): params
+        for layer, params in model.params.items()})
+
+    self.assertTrue((np.array(model(input_data))==np.array(baseline_model(input_data))).all())
+
+    # Masking padding changes the outputs of padded sequences.
+    masked_model = create_representation_model(
+        encoder_fn=encoder_fn,
+        encoder_fn_kwargs=dict(encoder_fn_kwargs, mask_padding=True)
+        if encoder_fn is cnn_one_hot_encoder else encoder_fn_kwargs,
+        reduce_fn=reduce_fn,
+        reduce_fn_kwargs=dict(reduce_fn_kwargs, mask_padding=True)
+        if reduce_fn is gated_conv else reduce_fn_kwargs,
+        num_categories=21,
+        output_features=4)
+    masked_model = masked_model.replace(params=model.params)
+    self.assertFalse(np.allclose(np.array(model(input_data)), np.array(masked_model(input_data))))
+
+
+class TestRemat(parameterized.TestCase):
+  """Checks that rematerialized layers and modules give the same gradients."""
+
+  @parameterized.parameters(
+      ({'remat': True}, {'remat': True}),
+      ({'remat': True}, {}),
+      ({}, {'remat': True})
+  )
+  def test_remat(self, encoder_remat_kwargs, reduce_remat_kwargs):
+
+    input_data = generate_random_sequences(batch_size=3, seq_len=12, num_categories=21)
+    output_data = generate_random_targets(batch_size=3)
+
+    encoder_fn_kwargs = {'n_layers': 2, 'n_features': [8, 8], 'n_kernel_sizes': [5, 3]}
+    reduce_fn_kwargs = {'rep_size': 16, 'm_layers': 2, 'm_features': [[8, 8]],
+                        'm_kernel_sizes': [[4, 4], [3, 3]], 'conv_rep_size': 8}
+
+    model = create_representation_model(encoder_fn=cnn_one_hot_encoder,
+                                        encoder_fn_kwargs=encoder_fn_kwargs,
+                                        reduce_fn=gated_conv,
+                                        reduce_fn_kwargs=reduce_fn_kwargs,
+                                        num_categories=21,
+                                        output_features=1)
+    remat_model = create_representation_model(
+        encoder_fn=cnn_one_hot_encoder,
+        encoder_fn_kwargs=dict(encoder_fn_kwargs, **encoder_remat_kwargs),
+        reduce_fn=gated_conv,
+        reduce_fn_kwargs=dict(reduce_fn_kwargs, **reduce_remat_kwargs),
+        num_categories=21,
+        output_features=1)
+    self.assertEqual(jax.tree_structure(model.params), jax.tree_structure(remat_model.params))
+
+    grads = []
+    for test_model in [model, remat_model]:
+      optimizer = create_optimizer(test_model, learning_rate=1e-3, weight_decay=0.)
+      grads.append(jax.jit(compute_loss_and_grad, static_argnums=(3, 4))(
+          optimizer, input_data, output_data, mse_loss, {})[1])
+
+    for grad, remat_grad in zip(jax.tree_leaves(grads[0]), jax.tree_leaves(grads[1])):
+      self.assertTrue(np.allclose(grad, remat_grad, atol=1e-5))
+
+  def test_remat_module(self):
+
+    inputs = jax.random.normal(jax.random.PRNGKey(0), (3, 12, 8))
+
+    grads = []
+    for module in [nn.SelfAttention, train_utils.remat_module(nn.SelfAttention)]:
+      _, params = module.init(jax.random.PRNGKey(1), inputs, num_heads=2)
+      grads.append(jax.grad(
+          lambda params: jnp.sum(module.call(params, inputs, num_heads=2)**2))(params))
+    self.assertEqual(jax.tree_structure(grads[0]), jax.tree_structure(grads[1]))
+
+    for grad, remat_grad in zip(jax.tree_leaves(grads[0]), jax.tree_leaves(grads[1])):
+      self.assertTrue(np.allclose(grad, remat_grad, atol=1e-5))
+
+
+class TestSweep(parameterized.TestCase):
+  """Checks that every config of a vectorized sweep trains as it would alone."""
+
+  def test_sweep(self):
+
+    input_data = generate_random_sequences(batch_size=3, seq_len=12, num_categories=21)
+    output_data = generate_random_targets(batch_size=3)
+
+    models = [create_representation_model(encoder_fn=cnn_one_hot_encoder,
+                                          encoder_fn_kwargs={'n_layers': 1, 'n_features': [8],
+                                                             'n_kernel_sizes': [3]},
+                                          reduce_fn=linear_max_pool,
+                                          reduce_fn_kwargs={'rep_size': 16},
+                                          num_categories=21,
+                                          output_features=1,
+                                          key=jax.random.PRNGKey(seed)) for seed in range(3)]
+    layers = ['CNN_0', 'Dense_1', 'Dense_2']
+    learning_rates = [[0., 1e-3, 1e-3], [0., 1e-2, 1e-3], [0., 0., 1e-2]]
+    weight_decays = [[0., 0., 0.], [0., 0.1, 0.], [0., 0., 0.]]
+    batches = [(input_data, output_data)] * 5
+
+    trained_models = train_sweep(models, batches, mse_loss, {}, learning_rates,
+                                 weight_decays, layers)
+    self.assertEqual(len(trained_models), 3)
+
+    for model, trained_model, learning_rate, weight_decay in zip(
+        models, trained_models, learning_rates, weight_decays):
+      optimizer = create_optimizer(model, learning_rate=learning_rate,
+                                   weight_decay=weight_decay, layers=layers)
+      for X, Y in batches:
+        optimizer = train_step(optimizer, X, Y, mse_loss, {})
+      for param, sweep_param in zip(jax.tree_leaves(optimizer.target.params),
+                                    jax.tree_leaves(trained_model.params)):
+        self.assertTrue(np.allclose(param, sweep_param, atol=1e-5))
+
+
 if __name__ == '__main__':
   absltest.main()
@@ -0,0 +1,325 @@
+"""Tests for Pfam data loading utils."""
+
+
+import os
+
+import numpy as np
+
+import pandas as pd
+
+from absl.testing import parameterized
+from absl.testing import absltest
+
+from pfam_utils import read_all_shards, residues_to_one_hot_inds, \
+residues_to_one_hot_inds_matrix, mod_family_accession, mod_family_accessions, \
+get_family_ids, create_pfam_df, PFAM_DF_CACHE, set_pfam_df_cache_max_bytes, sample_pfam_df, \
+compute_embeddings, pfam_evaluate, get_pfam_token_store_rows
+
+from contextual_lenses import mean_pool
+
+from encoders import one_hot_encoder
+
+from train_utils import create_representation_model, NumpyBatchIterator
+
+
+def write_random_shards(partition_dir, num_shards=5, rows_per_shard=7):
+  """Writes num_shards many CSV shards of random Pfam-like rows to partition_dir."""
+
+  np.random.seed(0)
+  os.makedirs(partition_dir)
+  residues = np.array(list('ACDEFGHIKLMNPQRSTVWY'))
+  family_ids = [family_id.replace('\n', '') for family_id in get_family_ids()]
+
+  shards = []
+  for shard_ind in range(num_shards):
+    families = np.random.randint(1, 20, size=rows_per_shard)
+    shard = pd.DataFrame({
+        'family_id': [family_ids[family] for family in families],
+        'sequence_name': ['seq_%d_%d' % (shard_ind, i) for i in range(rows_per_shard)],
+        'family_accession': ['PF%05d.%d' % (family, shard_ind) for family in families],
+        'sequence': [''.join(np.random.choice(residues, size=np.random.randint(1, 600)))
+                     for _ in range(rows_per_shard)]
+    })
+    shard.to_csv(os.path.join(partition_dir, 'data-%05d-of-%05d' % (shard_ind, num_shards)),
+                 index=False)
+    shards.append(shard)
+
+  return pd.concat(shards)
+
+
+class TestReadAllShards(parameterized.TestCase):
+  """Checks that reading CSV shards with any number of workers returns all rows in order."""
+
+  @parameterized.parameters(
+      1, 2, 8
+  )
+  def test_read_all_shards(self, num_workers):
+
+    data_dir = self.create_tempdir().full_path
+    expected_df = write_random_shards(os.path.join(data_dir, 'train'))
+
+    pfam_df = read_all_shards(partition='train', data_dir=data_dir, bucket_name=None,
+                              num_workers=num_workers)
+
+    self.assertTrue(list(pfam_df.columns)==list(expected_df.columns))
+    self.assertTrue((pfam_df.values==expected_df.values).all())
+
+
+class TestFeaturization(parameterized.TestCase):
+  """Checks vectorized featurization against row-wise featurization."""
+
+  @parameterized.parameters(
+      1, 3, 1000
+  )
+  def test_one_hot_inds(self, chunk_size):
+
+    data_dir = self.create_tempdir().full_path
+    pfam_df = write_random_shards(os.path.join(data_dir, 'train'))
+
+    one_hot_inds = residues_to_one_hot_inds_matrix(pfam_df.sequence, chunk_size=chunk_size)
+
+    for row, seq in zip(one_hot_inds, pfam_df.sequence.values):
+      expected_row = residues_to_one_hot_inds(seq[:512])
+      self.assertTrue(row.dtype==expected_row.dtype)
+      self.assertTrue((row==expected_row).all())
+
+  def test_mod_family_accessions(self):
+
+    data_dir = self.create_tempdir().full_path
+    pfam_df = write_random_shards(os.path.join(data_dir, 'train'))
+
+    accessions = mod_family_accessions(pfam_df.family_accession)
+    expected_accessions = pfam_df.family_accession.apply(mod_family_accession)
+
+    self.assertTrue((accessions.values==expected_accessions.values).all())
+
+
+class TestTokenStore(parameterized.TestCase):
+  """Checks that token store reads match CSV reads."""
+
+  @parameterized.parameters(
+      (None, 0), (1, 0), (3, 1)
+  )
+  def test_token_store(self, samples, random_state):
+
+    data_dir = self.create_tempdir().full_path
+    store_dir = self.create_tempdir().full_path
+    write_random_shards(os.path.join(data_dir, 'train'), rows_per_shard=40)
+
+    family_accessions = ['PF%05d' % family for family in range(3, 12)] + ['PF99999']
+
+    expected_df = create_pfam_df(family_accessions, samples=samples, random_state=random_state,
+                                 data_partitions_dirpath=data_dir, gcs_bucket=None)
+
+    # First call creates the store, second call reads it.
+    for _ in range(2):
+      pfam_df = create_pfam_df(family_accessions, samples=samples, random_state=random_state,
+                               data_partitions_dirpath=data_dir, gcs_bucket=None,
+                               store_dir=store_dir)
+
+      self.assertTrue(len(pfam_df)==len(expected_df))
+      self.assertTrue((pfam_df['index'].values==expected_df['index'].values).all())
+      self.assertTrue((pfam_df['mod_family_accession'].values==
+                       expected_df['mod_family_accession'].values).all())
+      self.assertTrue((np.stack(pfam_df['one_hot_inds'].values)==
+                       np.stack(expected_df['one_hot_inds'].values)).all())
+
+  def test_empty_token_store_rows(self):
+
+    empty_store = {'families': np.zeros(0, dtype='S7'),
+                   'family_offsets': np.zeros(1, dtype=np.int64)}
+    store = {'families': np.array([b'PF00003', b'PF00007']),
+             'family_offsets': np.array([0, 4, 6])}
+
+    for rows in [get_pfam_token_store_rows(empty_store, ['PF00003']),
+                 get_pfam_token_store_rows(store, [])]:
+      self.assertEqual(len(rows), 0)
+      self.assertEqual(rows.dtype, np.int64)
+
+    rows = get_pfam_token_store_rows(store, ['PF00007', 'PF99999'])
+    self.assertTrue((rows==np.array([4, 5])).all())
+
+
+class TestStreaming(parameterized.TestCase):
+  """Checks that streamed, chunked reads match full partition reads."""
+
+  @parameterized.parameters(
+      (None, 1), (3, 7), (2, 1000)
+  )
+  def test_streaming(self, samples, chunk_size):
+
+    data_dir = self.create_tempdir().full_path
+    write_random_shards(os.path.join(data_dir, 'train'), rows_per_shard=40)
+
+    family_accessions = ['PF%05d' % family for family in range(3, 12)]
+
+    expected_df = create_pfam_df(family_accessions, samples=samples,
+                                 data_partitions_dirpath=data_dir, gcs_bucket=None,
+                                 use_cache=False)
+    pfam_df = create_pfam_df(family_accessions, samples=samples,
+                             data_partitions_dirpath=data_dir, gcs_bucket=None,
+                             chunk_size=chunk_size, use_cache=False)
+
+    self.assertTrue(len(pfam_df)==len(expected_df))
+    self.assertTrue((pfam_df['index'].values==expected_df['index'].values).all())
+    self.assertTrue((np.stack(pfam_df['one_hot_inds'].values)==
+                     np.stack(expected_df['one_hot_inds'].values)).all())
+
+
+class TestReservoirSampling(parameterized.TestCase):
+  """Checks that per-family samples are capped, nested across sizes and equal for streamed and stored reads."""
+
+  @parameterized.parameters(
+      0, 1, 2
+  )
+  def test_reservoir_sampling(self, random_state):
+
+    data_dir = self.create_tempdir().full_path
+    store_dir = self.create_tempdir().full_path
+    write_random_shards(os.path.join(data_dir, 'train'), rows_per_shard=40)
+
+    family_accessions = ['PF%05d' % family for family in range(3, 12)]
+    sample_sizes = [1, 3, 5]
+
+    family_sizes = create_pfam_df(family_accessions, data_partitions_dirpath=data_dir,
+                                  gcs_bucket=None, use_cache=False).groupby(
+                                      'mod_family_accession').size()
+
+    streamed_dfs = sample_pfam_df(family_accessions, sample_sizes, random_state=random_state,
+                                  data_partitions_dirpath=data_dir, gcs_bucket=None,
+                                  chunk_size=7)
+    stored_dfs = sample_pfam_df(family_accessions, sample_sizes, random_state=random_state,
+                                data_partitions_dirpath=data_dir, gcs_bucket=None,
+                                store_dir=store_dir)
+
+    previous_rows = set()
+    for samples in sample_sizes:
+      streamed_df, stored_df = streamed_dfs[samples], stored_dfs[samples]
+
+      sample_family_sizes = streamed_df.groupby('mod_family_accession').size()
+      self.assertTrue((sample_family_sizes==family_sizes.clip(upper=samples)).all())
+
+      self.assertTrue((streamed_df['index'].values==stored_df['index'].values).all())
+      self.assertTrue((np.stack(streamed_df['one_hot_inds'].values)==
+                       np.stack(stored_df['one_hot_inds'].values)).all())
+
+      rows = set(stored_df['row_id'].values)
+      self.assertTrue(previous_rows <= rows)
+      previous_rows = rows
+
+
+class TestPfamDataFrameCache(absltest.TestCase):
+  """Checks that the dataframe cache is off by default and returns protected copies."""
+
+  def test_disabled_by_default(self):
+
+    data_dir = self.create_tempdir().full_path
+    write_random_shards(os.path.join(data_dir, 'train'), rows_per_shard=40)
+
+    family_accessions = ['PF%05d' % family for family in range(3, 12)]
+
+    PFAM_DF_CACHE.clear()
+    for _ in range(2):
+      pfam_df = create_pfam_df(family_accessions, samples=2, data_partitions_dirpath=data_dir,
+                               gcs_bucket=None)
+
+    self.assertEqual(PFAM_DF_CACHE.max_bytes, 0)
+    self.assertEqual(len(PFAM_DF_CACHE.entries), 0)
+    self.assertTrue(pfam_df['one_hot_inds'].values[0].flags.writeable)
+
+  def test_cache(self):
+
+    data_dir = self.create_tempdir().full_path
+    write_random_shards(os.path.join(data_dir, 'train'), rows_per_shard=40)
+
+    family_accessions = ['PF%05d' % family for family in range(3, 12)]
+
+    set_pfam_df_cache_max_bytes(2**30)
+    self.addCleanup(set_pfam_df_cache_max_bytes, 0)
+    PFAM_DF_CACHE.clear()
+    expected_df = create_pfam_df(family_accessions, samples=2, data_partitions_dirpath=data_dir,
+                                 gcs_bucket=None, use_cache=False)
+    pfam_df = create_pfam_df(family_accessions, samples=2, data_partitions_dirpath=data_dir,
+                             gcs_bucket=None)
+    pfam_df.loc[0, 'index'] = -1
+    cached_df = create_pfam_df(family_accessions, samples=2, data_partitions_dirpath=data_dir,
+                               gcs_bucket=None)
+
+    self.assertTrue(PFAM_DF_CACHE.hits==1)
+    self.assertTrue((cached_df['index'].values==expected_df['index'].values).all())
+    self.assertTrue((np.stack(cached_df['one_hot_inds'].values)==
+                     np.stack(expected_df['one_hot_inds'].values)).all())
+    self.assertFalse(cached_df['one_hot_inds'].values[0].flags.writeable)
+
+
+class TestComputeEmbeddings(parameterized.TestCase):
+  """Checks that compute_embeddings fills preallocated arrays with the model embeddings."""
+
+  @parameterized.parameters(
+      (None, False),
+      (10, False),
+      (10, True)
+  )
+  def test_compute_embeddings(self, num_vectors, memmap):
+
+    np.random.seed(0)
+    input_data = np.random.randint(0, 20, size=(10, 12))
+    batches = NumpyBatchIterator(input_data, np.arange(10), batch_size=4, buffer_size=1)
+
+    encoder = create_representation_model(encoder_fn=one_hot_encoder,
+                                          encoder_fn_kwargs={},
+                                          reduce_fn=mean_pool,
+                                          reduce_fn_kwargs={},
+                                          num_categories=21,
+                                          output_features=1,
+                                          output='embedding')
+
+    out_path = os.path.join(self.create_tempdir().full_path, 'vectors.npy') if memmap else None
+    vectors = compute_embeddings(encoder, batches, num_vectors=num_vectors, out_path=out_path)
+
+    self.assertEqual(vectors.shape, (10, 21))
+    self.assertTrue(np.allclose(vectors, encoder(input_data), atol=1e-5))
+    if memmap:
+      self.assertTrue(np.allclose(np.load(out_path), vectors))
+
+
+class TestPfamEvaluate(absltest.TestCase):
+  """Checks that on-device metric accumulation matches predictions and metrics from host logits."""
+
+  def test_pfam_evaluate(self):
+
+    data_dir = self.create_tempdir().full_path
+    write_random_shards(os.path.join(data_dir, 'test'), rows_per_shard=5)
+
+    family_accessions = ['PF%05d' % family for family in range(1, 20)]
+    num_families = len(get_family_ids())
+    loss_fn_kwargs = {'num_classes': num_families}
+
+    model = create_representation_model(encoder_fn=one_hot_encoder,
+                                        encoder_fn_kwargs={},
+                                        reduce_fn=mean_pool,
+                                        reduce_fn_kwargs={},
+                                        num_categories=21,
+                                        output_features=num_families)
+
+    PFAM_DF_CACHE.clear()
+    results, pred_indexes = pfam_evaluate(model, family_accessions, title=None,
+                                          loss_fn_kwargs=loss_fn_kwargs, batch_size=4,
+                                          data_partitions_dirpath=data_dir, gcs_bucket=None,
+                                          top_k=5)
+
+    test_df = create_pfam_df(family_accessions, test=True, data_partitions_dirpath=data_dir,
+                             gcs_bucket=None)
+    logits = np.array(model(np.stack(test_df['one_hot_inds'].values)))
+    test_indexes = test_df['index'].values
+    true_logits = logits[np.arange(len(logits)), test_indexes]
+
+    self.assertEqual(len(pred_indexes), 25)
+    self.assertTrue((pred_indexes==np.argmax(logits, axis=1)).all())
+    self.assertAlmostEqual(results['accuracy'], np.mean(pred_indexes==test_indexes))
+    self.assertAlmostEqual(results['top_5_accuracy'],
+                           np.mean(np.sum(logits > true_logits[:, np.newaxis], axis=1) < 5))
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -6,8 +6,8 @@ General tools for instantiating and training models.
 import flax
 from flax import nn
 from flax import optim
+from flax import jax_utils
 from flax.training import checkpoints
-from flax.training import common_utils
 
 import jax
 from jax import random
@@ -16,14 +16,22 @@ import jax.numpy as jnp
 from jax.config import config
 config.enable_omnistaging()
 
-import tensorflow as tf
-
 import numpy as np
 
 import functools
 
+import collections
+
+import queue
+
+import threading
+
+import time
+
 import copy
 
+import inspect
+
 from google_research.protein_lm import models
 
 
@@ -37,37 +45,693 @@ def create_data_iterator(df,
                          seed=0,
                          drop_remainder=False,
                          add_outputs=True,
-                         as_numpy=True):
-    """Creates iterator of batches of (inputs) or (inputs, outputs)."""
+                         as_numpy=True,
+                         bucket_boundaries=None,
+                         length_col=None,
+                         id_col=None):
+    """Creates iterator of batches of (inputs) or (inputs, outputs).
+
+    If bucket_boundaries is specified, batches are length-bucketed instead,
+    see create_bucketed_data_iterator. If id_col is specified, inputs are
+    {'x': inputs, 'ids': ids} with the id_col values of their rows.
+    """
+
+    if bucket_boundaries is not None:
+        return create_bucketed_data_iterator(
+            df=df,
+            input_col=input_col,
+            output_col=output_col,
+            length_col=length_col,
+            batch_size=batch_size,
+            bucket_boundaries=bucket_boundaries,
+            epochs=epochs,
+            seed=seed,
+            drop_remainder=drop_remainder,
+            add_outputs=add_outputs,
+            id_col=id_col)
+
+    inputs = np.stack(df[input_col].values)
+
+    if add_outputs:
+        outputs = df[output_col].values
+    else:
+        outputs = None
 
-    if buffer_size is None:
-        buffer_size = len(df)
+    batches = NumpyBatchIterator(
+        inputs=inputs,
+        outputs=outputs,
+        batch_size=batch_size,
+        epochs=epochs,
+        buffer_size=buffer_size,
+        seed=seed,
+        drop_remainder=drop_remainder,
+        ids=df[id_col].values if id_col is not None else None)
 
-    inputs = list(df[input_col].values)
-    inputs = tf.data.Dataset.from_tensor_slices(inputs)
+    if not as_numpy:
+        batches = batches_to_tf_dataset(batches)
 
-    outputs = df[output_col].values
-    outputs = tf.data.Dataset.from_tensor_slices(outputs)
+    return batches
 
-    if add_outputs:
-        batches = tf.data.Dataset.zip(
-            (inputs, outputs)).shuffle(buffer_size=buffer_size,
-                                       seed=seed,
-                                       reshuffle_each_iteration=True)
+
+class NumpyBatchIterator(object):
+    """Iterable of batches gathered from contiguous NumPy arrays.
+
+    Batches are formed over epochs many passes through the data, each pass
+    in the order of a permutation seeded by (seed, epoch), and may span
+    epoch boundaries like a repeated then batched tf.data.Dataset. A
+    buffer_size of None shuffles each epoch fully, a buffer_size of 1 keeps
+    the data in order and other values shuffle within consecutive windows
+    of buffer_size examples. With ids, inputs are yielded as
+    {'x': inputs, 'ids': ids}.
+    """
+    def __init__(self,
+                 inputs,
+                 outputs=None,
+                 batch_size=1,
+                 epochs=1,
+                 buffer_size=None,
+                 seed=0,
+                 drop_remainder=False,
+                 ids=None):
+
+        self.inputs = inputs
+        self.outputs = outputs
+        self.ids = ids
+        self.batch_size = batch_size
+        self.epochs = epochs
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.drop_remainder = drop_remainder
+        self.num_examples = len(inputs)
+        self.start_batch = 0
+
+    def __len__(self):
+
+        total = self.epochs * self.num_examples
+        if self.drop_remainder:
+            return total // self.batch_size
+
+        return -(-total // self.batch_size)
+
+    def state_dict(self, num_batches=0):
+        """Position after num_batches more batches as epoch, seed and example offset."""
+
+        position = (self.start_batch + num_batches) * self.batch_size
+
+        state = {
+            'epoch': position // max(self.num_examples, 1),
+            'seed': self.seed,
+            'offset': position % max(self.num_examples, 1),
+        }
+
+        return state
+
+    def load_state_dict(self, state):
+        """Resumes iteration at the batch following a saved state_dict."""
+
+        position = int(state['epoch']) * self.num_examples + int(
+            state['offset'])
+
+        assert position % self.batch_size == 0, \
+        'Saved offset does not fall on a batch boundary!'
+
+        self.seed = int(state['seed'])
+        self.start_batch = position // self.batch_size
+
+    def epoch_order(self, epoch):
+        """Order in which examples are visited during epoch."""
+
+        order = np.arange(self.num_examples)
+
+        if self.buffer_size == 1:
+            return order
+
+        rng = np.random.RandomState([self.seed, epoch])
+
+        if self.buffer_size is None or self.buffer_size >= self.num_examples:
+            return rng.permutation(order)
+
+        for start in range(0, self.num_examples, self.buffer_size):
+            window = order[start:start + self.buffer_size]
+            order[start:start + self.buffer_size] = rng.permutation(window)
+
+        return order
+
+    def batch_inds(self, position):
+        """Indices of the examples in the batch starting at stream position."""
+
+        total = self.epochs * self.num_examples
+        end = min(position + self.batch_size, total)
+
+        inds = []
+        while position < end:
+            epoch = position // self.num_examples
+            if epoch != self._epoch:
+                self._epoch = epoch
+                self._order = self.epoch_order(epoch)
+            epoch_start = epoch * self.num_examples
+            stop = min(end, epoch_start + self.num_examples)
+            inds.append(self._order[position - epoch_start:stop - epoch_start])
+            position = stop
+
+        return np.concatenate(inds)
+
+    def __iter__(self):
+
+        self._epoch = None
+        self._order = None
+
+        for batch in range(self.start_batch, len(self)):
+            inds = self.batch_inds(batch * self.batch_size)
+            X = self.inputs[inds]
+            if self.ids is not None:
+                X = {'x': X, 'ids': self.ids[inds]}
+            if self.outputs is not None:
+                yield X, self.outputs[inds]
+            else:
+                yield X
+
+
+def batches_to_tf_dataset(batches):
+    """Wraps an iterable of NumPy batches in a tf.data.Dataset."""
+
+    import tensorflow as tf
+
+    first_batch = next(iter(batches))
+    if isinstance(first_batch, tuple):
+        output_types = tuple(tf.as_dtype(x.dtype) for x in first_batch)
+        output_shapes = tuple(
+            tf.TensorShape([None] + list(x.shape[1:])) for x in first_batch)
     else:
-        batches = inputs.shuffle(buffer_size=buffer_size,
-                                 seed=seed,
-                                 reshuffle_each_iteration=True)
+        output_types = tf.as_dtype(first_batch.dtype)
+        output_shapes = tf.TensorShape([None] + list(first_batch.shape[1:]))
+
+    dataset = tf.data.Dataset.from_generator(lambda: iter(batches),
+                                             output_types=output_types,
+                                             output_shapes=output_shapes)
+
+    return dataset
+
+
+def length_to_bucket(lengths, bucket_boundaries):
+    """Index of the smallest bucket boundary at least as large as each length."""
+
+    bucket_boundaries = np.asarray(bucket_boundaries)
 
-    batches = batches.repeat(epochs).batch(batch_size=batch_size,
-                                           drop_remainder=drop_remainder)
+    assert (np.max(lengths) <= bucket_boundaries[-1]
+            ), 'Largest bucket boundary must cover the longest sequence!'
 
-    if as_numpy:
-        batches = batches.as_numpy_iterator()
+    return np.searchsorted(bucket_boundaries, lengths, side='left')
+
+
+class BucketedBatchIterator(object):
+    """Iterable of batches whose inputs are cut to the boundary of their length bucket.
+
+    Every epoch the data is shuffled, split into buckets by length, batched
+    within each bucket, and the batches of all buckets are shuffled together,
+    using a random state seeded by (seed, epoch). With ids, inputs are
+    yielded as {'x': inputs, 'ids': ids}.
+    """
+    def __init__(self,
+                 inputs,
+                 outputs,
+                 lengths,
+                 batch_size,
+                 bucket_boundaries,
+                 epochs=1,
+                 seed=0,
+                 drop_remainder=False,
+                 add_outputs=True,
+                 ids=None):
+
+        self.inputs = inputs
+        self.outputs = outputs
+        self.ids = ids
+        self.buckets = length_to_bucket(lengths, bucket_boundaries)
+        self.batch_size = batch_size
+        self.bucket_boundaries = bucket_boundaries
+        self.epochs = epochs
+        self.seed = seed
+        self.drop_remainder = drop_remainder
+        self.add_outputs = add_outputs
+        self.start_batch = 0
+
+        bucket_sizes = np.bincount(self.buckets,
+                                   minlength=len(bucket_boundaries))
+        if drop_remainder:
+            self.epoch_batches = int(np.sum(bucket_sizes // batch_size))
+        else:
+            self.epoch_batches = int(np.sum(-(-bucket_sizes // batch_size)))
+
+    def __len__(self):
+
+        return self.epochs * self.epoch_batches
+
+    def state_dict(self, num_batches=0):
+        """Position after num_batches more batches as epoch, seed and batch offset."""
+
+        position = self.start_batch + num_batches
+
+        state = {
+            'epoch': position // max(self.epoch_batches, 1),
+            'seed': self.seed,
+            'offset': position % max(self.epoch_batches, 1),
+        }
+
+        return state
+
+    def load_state_dict(self, state):
+        """Resumes iteration at the batch following a saved state_dict."""
+
+        self.seed = int(state['seed'])
+        self.start_batch = int(state['epoch']) * self.epoch_batches + int(
+            state['offset'])
+
+    def epoch_batch_inds(self, epoch):
+        """Bucket and example indices of each batch of epoch, in order."""
+
+        rng = np.random.RandomState([self.seed, epoch])
+        permutation = rng.permutation(len(self.inputs))
+
+        batch_inds = []
+        for bucket in range(len(self.bucket_boundaries)):
+            bucket_inds = permutation[self.buckets[permutation] == bucket]
+            for start in range(0, len(bucket_inds), self.batch_size):
+                inds = bucket_inds[start:start + self.batch_size]
+                if self.drop_remainder and len(inds) < self.batch_size:
+                    continue
+                batch_inds.append((bucket, inds))
+
+        return [batch_inds[batch] for batch in rng.permutation(len(batch_inds))]
+
+    def __iter__(self):
+
+        if self.epoch_batches == 0:
+            return
+
+        start_epoch = self.start_batch // self.epoch_batches
+        for epoch in range(start_epoch, self.epochs):
+            batch_inds = self.epoch_batch_inds(epoch)
+            if epoch == start_epoch:
+                batch_inds = batch_inds[self.start_batch % self.epoch_batches:]
+
+            for bucket, inds in batch_inds:
+                X = self.inputs[inds, :self.bucket_boundaries[bucket]]
+                if self.ids is not None:
+                    X = {'x': X, 'ids': self.ids[inds]}
+                if self.add_outputs:
+                    yield X, self.outputs[inds]
+                else:
+                    yield X
+
+
+def create_bucketed_data_iterator(df,
+                                  input_col,
+                                  output_col,
+                                  length_col,
+                                  batch_size,
+                                  bucket_boundaries=(64, 128, 256, 512),
+                                  epochs=1,
+                                  seed=0,
+                                  drop_remainder=False,
+                                  add_outputs=True,
+                                  id_col=None):
+    """Creates iterator of length-bucketed batches of (inputs) or (inputs, outputs).
+
+    Inputs are padded only up to the bucket boundary of their batch, so a
+    jitted step is specialized once per bucket instead of always running on
+    the full padded length. Padding beyond that boundary is dropped, which
+    changes what convolutions or attention see past the end of a sequence.
+    """
+
+    inputs = np.stack(df[input_col].values)
+    outputs = df[output_col].values
+    lengths = df[length_col].values
+
+    batches = BucketedBatchIterator(inputs=inputs,
+                                    outputs=outputs,
+                                    lengths=lengths,
+                                    batch_size=batch_size,
+                                    bucket_boundaries=bucket_boundaries,
+                                    epochs=epochs,
+                                    seed=seed,
+                                    drop_remainder=drop_remainder,
+                                    add_outputs=add_outputs,
+                                    ids=df[id_col].values
+                                    if id_col is not None else None)
 
     return batches
 
 
+class PackedBatches(object):
+    """Iterable packing the sequences of padded batches several to a row.
+
+    The sequences of every (X, Y) of batches are placed in order into rows
+    of length tokens (by default the width of the first X), at most
+    max_segments to a row and followed by gap padding tokens, and batch_rows
+    rows are yielded at a time as ({'x': X, 'segment_ids': segment_ids}, Y).
+    segment_ids numbers the sequences of a row from 1 and is 0 at padding.
+    Y has one entry per segment slot of the batch (batch_rows *
+    max_segments), pad_label for empty slots, in the order of the
+    per-slot outputs of a model from create_packed_model. Convolutions
+    only see zeros outside of segments, so a gap of at least packing_gap
+    tokens keeps segments independent.
+
+    If batches are resumable (see NumpyBatchIterator), so are packed
+    batches. Their saved state is that of batches at the batch holding the
+    first sequence of the next packed batch, plus the number of sequences
+    of that batch already packed.
+    """
+    def __init__(self,
+                 batches,
+                 max_segments,
+                 batch_rows,
+                 pad_ind,
+                 length=None,
+                 gap=0,
+                 pad_label=-1,
+                 drop_remainder=False):
+
+        self.batches = batches
+        self.max_segments = max_segments
+        self.batch_rows = batch_rows
+        self.pad_ind = pad_ind
+        self.length = length
+        self.gap = gap
+        self.pad_label = pad_label
+        self.drop_remainder = drop_remainder
+        self.start_offset = 0
+        # Position in batches, as (batches, sequences), of the first sequence
+        # of every packed batch yielded by the current iteration.
+        self.positions = {0: (0, 0)}
+
+    def __getattr__(self, name):
+
+        # Only resumable if batches are.
+        if name in ['state_dict', 'load_state_dict'] and hasattr(
+                self.batches, name):
+            return getattr(self, '_' + name)
+
+        raise AttributeError(name)
+
+    def _state_dict(self, num_batches=0):
+        """Position after num_batches more packed batches as the state of batches and a sequence offset."""
+
+        num_inner_batches, offset = self.positions[num_batches]
+        # Positions before num_batches are no longer needed.
+        for packed_batches in list(self.positions):
+            if packed_batches < num_batches:
+                del self.positions[packed_batches]
+
+        state = dict(self.batches.state_dict(num_inner_batches))
+        state['packed_offset'] = offset
+
+        return state
+
+    def _load_state_dict(self, state):
+        """Resumes packing at the sequence following a saved state_dict."""
+
+        state = dict(state)
+        self.start_offset = int(state.pop('packed_offset'))
+        self.batches.load_state_dict(state)
+
+    def sequences(self):
+        """Unpadded token sequences and outputs of batches, with their position in batches."""
+
+        for batch, (X, Y) in enumerate(iter(self.batches)):
+            X, Y = np.asarray(X), np.asarray(Y)
+            lengths = np.sum(X < self.pad_ind, axis=1)
+            start = self.start_offset if batch == 0 else 0
+            for ind in range(start, len(X)):
+                yield X[ind, :lengths[ind]], Y[ind], X.shape[1], (batch, ind)
+
+    def __iter__(self):
+
+        X, segment_ids, Y = None, None, None
+        row, position, segment = 0, 0, 0
+        num_batches = 0
+        self.positions = {0: (0, self.start_offset)}
+
+        for x, y, width, sequence_position in self.sequences():
+            if X is None:
+                length = self.length if self.length is not None else width
+                X = np.full((self.batch_rows, length),
+                            self.pad_ind,
+                            dtype=x.dtype)
+                segment_ids = np.zeros((self.batch_rows, length),
+                                       dtype=np.int32)
+                Y = np.full(self.batch_rows * self.max_segments,
+                            self.pad_label,
+                            dtype=np.asarray(y).dtype)
+
+            if len(x) > length:
+                raise ValueError('Sequence of length %d does not fit into '
+                                 'packed rows of length %d!' %
+                                 (len(x), length))
+
+            if segment == self.max_segments or position + len(x) > length:
+                row, position, segment = row + 1, 0, 0
+                if row == self.batch_rows:
+                    num_batches += 1
+                    self.positions[num_batches] = sequence_position
+                    yield {'x': X, 'segment_ids': segment_ids}, Y
+                    X = np.full_like(X, self.pad_ind)
+                    segment_ids = np.zeros_like(segment_ids)
+                    Y = np.full_like(Y, self.pad_label)
+                    row = 0
+
+            X[row, position:position + len(x)] = x
+            segment_ids[row, position:position + len(x)] = segment + 1
+            Y[row * self.max_segments + segment] = y
+            position += len(x) + self.gap
+            segment += 1
+
+        if X is not None and segment > 0 and not self.drop_remainder:
+            self.positions[num_batches + 1] = (sequence_position[0] + 1, 0)
+            yield {'x': X, 'segment_ids': segment_ids}, Y
+
+
+def unpack_outputs(outputs, Y, pad_label=-1):
+    """Per-sequence outputs of a packed model, in the order PackedBatches read the sequences."""
+
+    return outputs[np.asarray(Y) != pad_label]
+
+
+def packing_gap(encoder_fn_kwargs, reduce_fn_kwargs):
+    """Largest number of positions a CNN encoder or GatedConv lens convolution reaches to either side."""
+
+    gap = 0
+
+    n_kernel_sizes = encoder_fn_kwargs.get('n_kernel_sizes', [])
+    n_kernel_dilations = encoder_fn_kwargs.get('n_kernel_dilations')
+    if n_kernel_dilations is None:
+        n_kernel_dilations = [1] * len(n_kernel_sizes)
+    for kernel_size, kernel_dilation in zip(n_kernel_sizes,
+                                            n_kernel_dilations):
+        gap = max(gap, (kernel_dilation * (kernel_size - 1) + 1) // 2)
+
+    for kernel_sizes in reduce_fn_kwargs.get('m_kernel_sizes', []):
+        gap = max(gap, max(kernel_sizes) // 2)
+
+    return gap
+
+
+def pad_rows(x, rows):
+    """Pads the leading axis of x to rows entries by repeating its last entry."""
+
+    if len(x) == rows:
+        return x
+
+    return np.concatenate([x, np.repeat(x[-1:], rows - len(x), axis=0)])
+
+
+class PaddedBatches(object):
+    """Iterable padding every batch of batches to the number of rows of the first.
+
+    Keeps batch shapes fixed, so that a final partial batch does not
+    retrace compiled functions. The number of valid rows of every batch is
+    appended to valid_rows as it is produced, so consumers can pop them in
+    order even if batches are prefetched in another thread.
+    """
+    def __init__(self, batches):
+
+        self.batches = batches
+        self.valid_rows = collections.deque()
+
+    def __len__(self):
+
+        return len(self.batches)
+
+    def __iter__(self):
+
+        rows = None
+        for batch in iter(self.batches):
+            batch_rows = len(jax.tree_leaves(batch)[0])
+            if rows is None:
+                rows = batch_rows
+            assert batch_rows <= rows, 'Batches may not grow after the first!'
+            self.valid_rows.append(batch_rows)
+            yield jax.tree_map(functools.partial(pad_rows, rows=rows), batch)
+
+
+# Device prefetching.
+@functools.lru_cache(maxsize=None)
+def get_put_sharded(devices=None):
+    """Returns a function placing each shard of a sharded batch onto its device."""
+
+    put_sharded = jax.pmap(lambda batch: batch, devices=devices)
+
+    return put_sharded
+
+
+def shard_batch(batch, num_devices, axis=0):
+    """Splits the batch axis of every array in batch into a leading axis of num_devices shards."""
+
+    def shard(x):
+        if x.shape[axis] % num_devices != 0:
+            raise ValueError(
+                'Batch size %d is not divisible by the %d devices used for '
+                'data-parallel training!' % (x.shape[axis], num_devices))
+        x = x.reshape(x.shape[:axis] + (num_devices, -1) + x.shape[axis + 1:])
+        return np.moveaxis(x, axis, 0)
+
+    return jax.tree_map(shard, batch)
+
+
+class DevicePrefetcher(object):
+    """Iterable staging the next buffer_size batches onto device in a background thread.
+
+    If shard is True, batches are split across devices (by default all
+    local devices) for pmap. If steps_per_call is larger than 1, every
+    steps_per_call consecutive batches of equal shapes are stacked along a
+    new leading axis for multi_train_step, and any other batch is staged
+    alone with a leading axis of size 1. Counts how often the consumer found
+    no staged batch and had to wait, along with the total time spent waiting.
+    """
+    def __init__(self,
+                 batches,
+                 buffer_size=2,
+                 shard=False,
+                 devices=None,
+                 steps_per_call=1):
+
+        self.batches = batches
+        self.buffer_size = buffer_size
+        self.shard = shard
+        self.devices = devices
+        self.steps_per_call = steps_per_call
+        self.num_batches = 0
+        self.stalls = 0
+        self.stall_time = 0.
+
+    def put(self, batch):
+        """Stages a single batch onto device(s)."""
+
+        if self.shard:
+            if self.devices is None:
+                num_devices = jax.local_device_count()
+                put_sharded = get_put_sharded()
+            else:
+                num_devices = len(self.devices)
+                put_sharded = get_put_sharded(tuple(self.devices))
+            axis = 1 if self.steps_per_call > 1 else 0
+            return put_sharded(shard_batch(batch, num_devices, axis=axis))
+
+        return jax.device_put(batch)
+
+    def stack_group(self, group):
+        """Stacks a group of steps_per_call equally shaped batches, else each batch alone."""
+
+        shapes = [tuple(x.shape for x in jax.tree_leaves(batch)) for batch in group]
+
+        if len(group) == self.steps_per_call and len(set(shapes)) == 1:
+            yield jax.tree_multimap(lambda *xs: np.stack(xs), *group)
+        else:
+            for batch in group:
+                yield jax.tree_map(lambda x: x[np.newaxis], batch)
+
+    def host_batches(self):
+        """Batches, stacked into groups of steps_per_call if larger than 1."""
+
+        if self.steps_per_call == 1:
+            yield from iter(self.batches)
+            return
+
+        group = []
+        for batch in iter(self.batches):
+            group.append(batch)
+            if len(group) == self.steps_per_call:
+                yield from self.stack_group(group)
+                group = []
+        yield from self.stack_group(group)
+
+    def stage(self, staged, stop, item):
+        """Puts item into the staged queue, returns False if stopped first."""
+
+        while not stop.is_set():
+            try:
+                staged.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def produce(self, staged, stop):
+        """Stages batches into the staged queue until exhausted or stopped."""
+
+        try:
+            for batch in self.host_batches():
+                if not self.stage(staged, stop, (self.put(batch), None)):
+                    return
+            self.stage(staged, stop, (None, StopIteration()))
+        except Exception as e:
+            self.stage(staged, stop, (None, e))
+
+    def __iter__(self):
+
+        staged = queue.Queue(maxsize=self.buffer_size)
+        stop = threading.Event()
+        producer = threading.Thread(target=self.produce,
+                                    args=(staged, stop),
+                                    daemon=True)
+        producer.start()
+
+        try:
+            while True:
+                stall_time = None
+                try:
+                    batch, error = staged.get_nowait()
+                except queue.Empty:
+                    start = time.time()
+                    batch, error = staged.get()
+                    stall_time = time.time() - start
+
+                if isinstance(error, StopIteration):
+                    return
+                if error is not None:
+                    raise error
+
+                if stall_time is not None:
+                    self.stalls += 1
+                    self.stall_time += stall_time
+                self.num_batches += 1
+                yield batch
+        finally:
+            stop.set()
+
+    def stall_stats(self):
+        """Returns number of batches consumed, stalls and seconds spent stalled."""
+
+        stats = {
+            'batches': self.num_batches,
+            'stalls': self.stalls,
+            'stall_time': self.stall_time,
+        }
+
+        return stats
+
+
 def path_inclusion_filter_fn(path, param, layer):
     """Returns whether or not layer name is contained in path."""
 
@@ -104,31 +768,378 @@ def create_optimizer(model, learning_rate, weight_decay, layers=None):
     return optimizer
 
 
-@functools.partial(jax.jit, static_argnums=(3, 4))
-def train_step(optimizer, X, Y, loss_fn, loss_fn_kwargs):
-    """Trains model (optimizer.target) using specified loss function."""
+def trainable_mask(optimizer):
+    """Tree of booleans over optimizer.target, True for parameters optimizer updates.
+
+    Layers given a learning rate of 0 in create_optimizer get no
+    sub-optimizer and are marked False, also for optimizers replicated
+    with optimizer.replicate.
+    """
+
+    optimizer_def = optimizer.optimizer_def
+    if isinstance(optimizer_def, optim.base.ReplicatedOptimizer):
+        optimizer_def = optimizer_def.optimizer_def
+
+    if not isinstance(optimizer_def, optim.MultiOptimizer):
+        return jax.tree_map(lambda _: True, optimizer.target)
+
+    # Traversals are applied to leaf indices, as they drop empty subtrees.
+    leaves, treedef = jax.tree_flatten(optimizer.target)
+    leaf_inds = jax.tree_unflatten(treedef, list(range(len(leaves))))
+    trainable_inds = set()
+    for traversal in optimizer_def.traversals:
+        trainable_inds.update(traversal.iterate(leaf_inds))
+
+    mask = [ind in trainable_inds for ind in range(len(leaves))]
+
+    return jax.tree_unflatten(treedef, mask)
+
+
+def compute_loss_and_grad(optimizer,
+                          X,
+                          Y,
+                          loss_fn,
+                          loss_fn_kwargs,
+                          accumulation_steps=1,
+                          loss_reduction='sum'):
+    """Loss of model (optimizer.target) on a batch and its gradient.
+
+    If accumulation_steps is larger than 1, the batch is split into that
+    many micro-batches whose losses and gradients are accumulated inside
+    lax.scan, summed or averaged according to loss_reduction, which must
+    match how loss_fn reduces over the batch. Only one micro-batch of
+    activations is then held in memory at a time.
+
+    Parameters not updated by optimizer (see trainable_mask) are wrapped in
+    stop_gradient and get zero gradients, so no backward pass is compiled
+    for layers that only depend on them, such as a frozen encoder.
+    """
+    trainable = trainable_mask(optimizer)
+
     def compute_loss_fn(model, X, Y, loss_fn, loss_fn_kwargs):
-        Y_hat = model(X)
+        model = jax.tree_multimap(
+            lambda param, trainable: param
+            if trainable else jax.lax.stop_gradient(param), model, trainable)
+        Y_hat = model(**X) if isinstance(X, dict) else model(X)
         loss = loss_fn(Y, Y_hat, **loss_fn_kwargs)
         return loss
 
     grad_fn = jax.value_and_grad(compute_loss_fn)
-    _, grad = grad_fn(optimizer.target, X, Y, loss_fn, loss_fn_kwargs)
+
+    if accumulation_steps == 1:
+        loss, grad = grad_fn(optimizer.target, X, Y, loss_fn, loss_fn_kwargs)
+        return loss, grad
+
+    batch_size = jax.tree_leaves(X)[0].shape[0]
+    if batch_size % accumulation_steps != 0:
+        raise ValueError(
+            'Batch size %d is not divisible by %d accumulation steps!' %
+            (batch_size, accumulation_steps))
+
+    def accumulate(carry, micro_batch):
+        loss, grad = carry
+        micro_X, micro_Y = micro_batch
+        micro_loss, micro_grad = grad_fn(optimizer.target, micro_X, micro_Y,
+                                         loss_fn, loss_fn_kwargs)
+        loss = loss + micro_loss.astype(loss.dtype)
+        grad = jax.tree_multimap(lambda g, m: g + m.astype(g.dtype), grad,
+                                 micro_grad)
+        return (loss, grad), None
+
+    micro_batches = jax.tree_map(
+        lambda x: x.reshape((accumulation_steps, -1) + x.shape[1:]), (X, Y))
+    init = (jnp.zeros((), dtype=jnp.float32),
+            jax.tree_map(jnp.zeros_like, optimizer.target))
+    (loss, grad), _ = jax.lax.scan(accumulate, init, micro_batches)
+
+    if loss_reduction == 'mean':
+        loss, grad = jax.tree_map(lambda x: x / accumulation_steps,
+                                  (loss, grad))
+    elif loss_reduction != 'sum':
+        raise ValueError('Unknown loss reduction %s!' % loss_reduction)
+
+    return loss, grad
+
+
+def all_reduce(tree, loss_reduction, mask=None):
+    """Sums or averages tree across the 'batch' axis according to loss_reduction.
+
+    Gradients are summed for losses summed over the batch (cross_entropy_loss)
+    and averaged for losses averaged over the batch (mse_loss), so every
+    replica applies the same update as a single device on the whole batch.
+    If mask is given, only leaves of tree where mask is True are reduced.
+    """
+
+    if mask is not None:
+        leaves, treedef = jax.tree_flatten(tree)
+        reduce = jax.tree_leaves(mask)
+        reduced = iter(
+            all_reduce([
+                leaf for leaf, reduce_leaf in zip(leaves, reduce)
+                if reduce_leaf
+            ], loss_reduction))
+        return jax.tree_unflatten(treedef, [
+            next(reduced) if reduce_leaf else leaf
+            for leaf, reduce_leaf in zip(leaves, reduce)
+        ])
+
+    if loss_reduction == 'sum':
+        return jax.lax.psum(tree, axis_name='batch')
+    elif loss_reduction == 'mean':
+        return jax.lax.pmean(tree, axis_name='batch')
+    else:
+        raise ValueError('Unknown loss reduction %s!' % loss_reduction)
+
+
+@functools.partial(jax.jit, static_argnums=(3, 4))
+def train_step(optimizer, X, Y, loss_fn, loss_fn_kwargs):
+    """Trains model (optimizer.target) using specified loss function."""
+
+    _, grad = compute_loss_and_grad(optimizer, X, Y, loss_fn, loss_fn_kwargs)
     optimizer = optimizer.apply_gradient(grad)
 
     return optimizer
 
 
-def get_p_train_step():
-    """Wraps train_step with jax.pmap."""
+@functools.partial(jax.jit, static_argnums=(3, 4, 5, 6))
+def accumulated_train_step(optimizer, X, Y, loss_fn, loss_fn_kwargs,
+                           accumulation_steps, loss_reduction):
+    """train_step accumulating gradients over accumulation_steps micro-batches of X, Y."""
+
+    _, grad = compute_loss_and_grad(optimizer, X, Y, loss_fn, loss_fn_kwargs,
+                                    accumulation_steps, loss_reduction)
+    optimizer = optimizer.apply_gradient(grad)
+
+    return optimizer
+
 
-    p_train_step = jax.pmap(train_step,
+def data_parallel_train_step(optimizer, X, Y, loss_fn, loss_fn_kwargs,
+                             loss_reduction, accumulation_steps):
+    """train_step on one shard of a batch, all-reducing gradients across the 'batch' axis."""
+
+    _, grad = compute_loss_and_grad(optimizer, X, Y, loss_fn, loss_fn_kwargs,
+                                    accumulation_steps, loss_reduction)
+    grad = all_reduce(grad, loss_reduction, trainable_mask(optimizer))
+    optimizer = optimizer.apply_gradient(grad)
+
+    return optimizer
+
+
+def get_p_train_step(devices=None):
+    """Wraps data_parallel_train_step with jax.pmap."""
+
+    p_train_step = jax.pmap(data_parallel_train_step,
                             axis_name='batch',
-                            static_broadcasted_argnums=(3, 4))
+                            static_broadcasted_argnums=(3, 4, 5, 6),
+                            devices=devices)
 
     return p_train_step
 
 
+def scan_train_steps(optimizer,
+                     X,
+                     Y,
+                     loss_fn,
+                     loss_fn_kwargs,
+                     accumulation_steps=1,
+                     loss_reduction='sum',
+                     all_reduce_grads=False):
+    """Applies one update per slice of X and Y along their leading axis in lax.scan.
+
+    Returns the updated optimizer and the loss of every step. If
+    all_reduce_grads is True, gradients and losses are all-reduced across
+    the 'batch' axis as in data_parallel_train_step.
+    """
+    def step(optimizer, batch):
+        X, Y = batch
+        loss, grad = compute_loss_and_grad(optimizer, X, Y, loss_fn,
+                                           loss_fn_kwargs, accumulation_steps,
+                                           loss_reduction)
+        if all_reduce_grads:
+            loss = all_reduce(loss, loss_reduction)
+            grad = all_reduce(grad, loss_reduction, trainable_mask(optimizer))
+        optimizer = optimizer.apply_gradient(grad)
+        return optimizer, loss
+
+    optimizer, losses = jax.lax.scan(step, optimizer, (X, Y))
+
+    return optimizer, losses
+
+
+@functools.partial(jax.jit, static_argnums=(3, 4))
+def multi_train_step(optimizer, X, Y, loss_fn, loss_fn_kwargs):
+    """Applies train_step once per batch of stacked batches X, Y in one compiled call.
+
+    Returns the updated optimizer and the array of per-step losses.
+    """
+
+    return scan_train_steps(optimizer, X, Y, loss_fn, loss_fn_kwargs)
+
+
+@functools.partial(jax.jit, static_argnums=(3, 4, 5, 6))
+def accumulated_multi_train_step(optimizer, X, Y, loss_fn, loss_fn_kwargs,
+                                 accumulation_steps, loss_reduction):
+    """multi_train_step accumulating gradients over accumulation_steps micro-batches per step."""
+
+    return scan_train_steps(optimizer, X, Y, loss_fn, loss_fn_kwargs,
+                            accumulation_steps, loss_reduction)
+
+
+def data_parallel_multi_train_step(optimizer, X, Y, loss_fn, loss_fn_kwargs,
+                                   loss_reduction, accumulation_steps):
+    """multi_train_step on one shard of stacked batches, all-reducing across the 'batch' axis."""
+
+    return scan_train_steps(optimizer,
+                            X,
+                            Y,
+                            loss_fn,
+                            loss_fn_kwargs,
+                            accumulation_steps,
+                            loss_reduction,
+                            all_reduce_grads=True)
+
+
+def get_p_multi_train_step(devices=None):
+    """Wraps data_parallel_multi_train_step with jax.pmap."""
+
+    p_multi_train_step = jax.pmap(data_parallel_multi_train_step,
+                                  axis_name='batch',
+                                  static_broadcasted_argnums=(3, 4, 5, 6),
+                                  devices=devices)
+
+    return p_multi_train_step
+
+
+def stack_trees(trees):
+    """Stacks equally structured pytrees along a new leading axis of their leaves."""
+
+    return jax.tree_multimap(lambda *xs: jnp.stack(xs), *trees)
+
+
+def unstack_tree(tree, num_trees):
+    """Splits a pytree stacked by stack_trees into a list of num_trees pytrees."""
+
+    return [jax.tree_map(lambda x: x[i], tree) for i in range(num_trees)]
+
+
+def create_sweep_optimizer(models, learning_rates, weight_decays, layers):
+    """Instantiates one Adam multi-optimizer per model, stacked for sweep_train_step.
+
+    models share an architecture and learning_rates and weight_decays hold
+    one list per model, aligned with layers as in create_optimizer. All
+    optimizers share the sub-optimizers of the layers with a positive
+    learning rate for any model, so that they can be stacked. Returns the
+    stacked optimizer and the (num_models, num_sub_optimizers) learning
+    rates and weight decays of these sub-optimizers.
+    """
+
+    learning_rates = np.asarray(learning_rates, dtype=np.float32)
+    weight_decays = np.asarray(weight_decays, dtype=np.float32)
+    trainable = np.max(learning_rates, axis=0) > 0
+
+    optimizer_def = create_optimizer(
+        models[0],
+        learning_rate=[float(lr) for lr in np.max(learning_rates, axis=0)],
+        weight_decay=[0.] * len(layers),
+        layers=layers).optimizer_def
+    # Models share the module of the first model, as stacking compares modules.
+    optimizer = stack_trees([
+        optimizer_def.create(models[0].replace(params=model.params))
+        for model in models
+    ])
+
+    return optimizer, learning_rates[:, trainable], weight_decays[:, trainable]
+
+
+def sweep_update(optimizer, X, Y, loss_fn, loss_fn_kwargs, learning_rates,
+                 weight_decays):
+    """train_step of a single model of a sweep with its own sub-optimizer hyperparameters."""
+
+    _, grad = compute_loss_and_grad(optimizer, X, Y, loss_fn, loss_fn_kwargs)
+    hyper_params = [
+        hyper_param.replace(learning_rate=learning_rate,
+                            weight_decay=weight_decay)
+        for hyper_param, learning_rate, weight_decay in zip(
+            optimizer.optimizer_def.hyper_params, learning_rates,
+            weight_decays)
+    ]
+    optimizer = optimizer.apply_gradient(grad, hyper_params=hyper_params)
+
+    return optimizer
+
+
+@functools.partial(jax.jit, static_argnums=(3, 4))
+def sweep_train_step(optimizer, X, Y, loss_fn, loss_fn_kwargs, learning_rates,
+                     weight_decays):
+    """Applies train_step to every model of a stacked sweep optimizer on the same batch.
+
+    The models, their optimizer states and hyperparameters are vectorized
+    with jax.vmap, so the sweep compiles and runs as a single program.
+    """
+
+    return jax.vmap(sweep_update,
+                    in_axes=(0, None, None, None, None, 0, 0))(
+                        optimizer, X, Y, loss_fn, loss_fn_kwargs,
+                        learning_rates, weight_decays)
+
+
+def get_optimizer_step(optimizer):
+    """Step of an (unreplicated) optimizer, one per sub-optimizer if several."""
+
+    state = optimizer.state
+    if type(state) == list:
+        step = [int(sub_state.step) for sub_state in state]
+    else:
+        step = int(state.step)
+
+    return step
+
+
+def save_train_checkpoint(save_dir, optimizer, data_iterator=None,
+                          num_batches=0):
+    """Saves optimizer and, if resumable, the position of its data iterator.
+
+    The data iterator state is saved first under the optimizer's step, so a
+    restored optimizer always finds the position its training stopped at.
+    """
+
+    step = get_optimizer_step(optimizer)
+
+    if hasattr(data_iterator, 'state_dict'):
+        checkpoints.save_checkpoint(
+            ckpt_dir=save_dir,
+            target=data_iterator.state_dict(num_batches),
+            step=step,
+            prefix='data_iterator_',
+            keep=2)
+
+    checkpoints.save_checkpoint(ckpt_dir=save_dir,
+                                target=optimizer,
+                                step=step)
+
+
+def restore_train_checkpoint(restore_dir, optimizer, data_iterator=None):
+    """Restores optimizer and, if resumable, the position of its data iterator."""
+
+    optimizer = checkpoints.restore_checkpoint(ckpt_dir=restore_dir,
+                                               target=optimizer)
+
+    if hasattr(data_iterator, 'load_state_dict'):
+        # Checkpoints saved without a data iterator position restart the data.
+        try:
+            data_state = checkpoints.restore_checkpoint(
+                ckpt_dir=restore_dir,
+                target=None,
+                step=get_optimizer_step(optimizer),
+                prefix='data_iterator_')
+        except ValueError:
+            data_state = None
+        if data_state is not None:
+            data_iterator.load_state_dict(data_state)
+
+    return optimizer
+
+
 def train(model,
           train_data,
           loss_fn,
@@ -138,47 +1149,141 @@ def train(model,
           layers=None,
           restore_dir=None,
           save_dir=None,
-          use_pmap=False):
-    """Instantiates optimizer, applies train_step/p_train_step over training data."""
+          use_pmap=False,
+          prefetch_size=2,
+          save_every=None,
+          loss_reduction='sum',
+          devices=None,
+          steps_per_call=1,
+          accumulation_steps=1):
+    """Instantiates optimizer, applies train_step/p_train_step over training data.
+
+    Batches are staged onto device ahead of the step consuming them, unless
+    train_data is already a DevicePrefetcher. If train_data can report its
+    position (see NumpyBatchIterator), it is checkpointed alongside the
+    optimizer every save_every steps and at the end of training, and
+    restoring from restore_dir resumes at the next unseen batch.
+
+    With use_pmap, every batch is split across devices (by default all
+    local devices) and gradients are all-reduced according to
+    loss_reduction, which must match how loss_fn reduces over the batch.
+
+    With steps_per_call larger than 1, that many batches are stacked and
+    trained on in one compiled call to multi_train_step. With
+    accumulation_steps larger than 1, every batch (or shard of a batch) is
+    split into that many micro-batches whose gradients are accumulated
+    before a single optimizer update, see compute_loss_and_grad.
+    """
 
     optimizer = create_optimizer(model,
                                  learning_rate=learning_rate,
                                  weight_decay=weight_decay,
                                  layers=layers)
 
+    if isinstance(train_data, DevicePrefetcher):
+        assert train_data.shard == use_pmap, \
+        'DevicePrefetcher must shard batches if and only if use_pmap is set!'
+        data_iterator = train_data.batches
+        steps_per_call = train_data.steps_per_call
+    else:
+        data_iterator = train_data
+        train_data = DevicePrefetcher(train_data,
+                                      buffer_size=prefetch_size,
+                                      shard=use_pmap,
+                                      devices=devices,
+                                      steps_per_call=steps_per_call)
+
     if restore_dir is not None:
-        optimizer = checkpoints.restore_checkpoint(ckpt_dir=restore_dir,
-                                                   target=optimizer)
+        optimizer = restore_train_checkpoint(restore_dir, optimizer,
+                                             data_iterator)
 
     if use_pmap:
-        p_train_step = get_p_train_step()
-        optimizer = optimizer.replicate()
-
-        for batch in iter(train_data):
-            X, Y = batch
-            X, Y = common_utils.shard(X), common_utils.shard(Y)
-            optimizer = p_train_step(optimizer, X, Y, loss_fn, loss_fn_kwargs)
+        # Not optimizer.replicate, whose ReplicatedOptimizer would pmean
+        # gradients again after all_reduce.
+        optimizer = jax_utils.replicate(optimizer, devices=devices)
+        if steps_per_call > 1:
+            p_step = get_p_multi_train_step(devices=devices)
+        else:
+            p_step = get_p_train_step(devices=devices)
+        step_fn = lambda optimizer, X, Y: p_step(
+            optimizer, X, Y, loss_fn, loss_fn_kwargs, loss_reduction,
+            accumulation_steps)
+    elif accumulation_steps > 1:
+        if steps_per_call > 1:
+            step = accumulated_multi_train_step
+        else:
+            step = accumulated_train_step
+        step_fn = lambda optimizer, X, Y: step(
+            optimizer, X, Y, loss_fn, loss_fn_kwargs, accumulation_steps,
+            loss_reduction)
+    elif steps_per_call > 1:
+        step_fn = lambda optimizer, X, Y: multi_train_step(
+            optimizer, X, Y, loss_fn, loss_fn_kwargs)
+    else:
+        step_fn = lambda optimizer, X, Y: train_step(
+            optimizer, X, Y, loss_fn, loss_fn_kwargs)
 
-        optimizer = optimizer.unreplicate()
+    num_batches = 0
+    saved_batches = None
 
-    else:
-        for batch in iter(train_data):
-            X, Y = batch
-            optimizer = train_step(optimizer, X, Y, loss_fn, loss_fn_kwargs)
-
-    if save_dir is not None:
-        state = optimizer.state
-        if type(state) == list:
-            step = [sub_state.step for sub_state in state]
+    for batch in iter(train_data):
+        X, Y = batch
+        if steps_per_call > 1:
+            optimizer, losses = step_fn(optimizer, X, Y)
+            steps = losses.shape[-1]
         else:
-            step = state.step
-        checkpoints.save_checkpoint(ckpt_dir=save_dir,
-                                    target=optimizer,
-                                    step=step)
+            optimizer = step_fn(optimizer, X, Y)
+            steps = 1
+
+        if save_dir is not None and save_every is not None and \
+        (num_batches + steps) // save_every > num_batches // save_every:
+            save_train_checkpoint(
+                save_dir,
+                jax_utils.unreplicate(optimizer) if use_pmap else optimizer,
+                data_iterator, num_batches + steps)
+            saved_batches = num_batches + steps
+        num_batches += steps
+
+    if use_pmap:
+        optimizer = jax_utils.unreplicate(optimizer)
+
+    if save_dir is not None and saved_batches != num_batches:
+        save_train_checkpoint(save_dir, optimizer, data_iterator, num_batches)
 
     return optimizer
 
 
+def train_sweep(models,
+                train_data,
+                loss_fn,
+                loss_fn_kwargs,
+                learning_rates,
+                weight_decays,
+                layers,
+                prefetch_size=2):
+    """Trains several models of the same architecture on the same batches at once.
+
+    learning_rates and weight_decays hold one list per model, as passed to
+    train for that model alone. Every batch is staged once and applied to
+    all models in one compiled sweep_train_step. Returns the trained models.
+    """
+
+    optimizer, learning_rates, weight_decays = create_sweep_optimizer(
+        models, learning_rates, weight_decays, layers)
+
+    if not isinstance(train_data, DevicePrefetcher):
+        train_data = DevicePrefetcher(train_data, buffer_size=prefetch_size)
+    assert not train_data.shard and train_data.steps_per_call == 1, \
+    'Sweeps are trained one unsharded batch at a time!'
+
+    for batch in iter(train_data):
+        X, Y = batch
+        optimizer = sweep_train_step(optimizer, X, Y, loss_fn, loss_fn_kwargs,
+                                     learning_rates, weight_decays)
+
+    return unstack_tree(optimizer.target, len(models))
+
+
 def load_params(params,
                 encoder_fn_params=None,
                 reduce_fn_params=None,
@@ -257,24 +1362,64 @@ class RepresentationModel(nn.Module):
               output_features,
               output='prediction',
               use_transformer=False,
-              padding_mask=None):
+              padding_mask=None,
+              dtype=jnp.float32,
+              segment_ids=None,
+              max_segments=None):
         """Computes padding mask, encodes indices using embeddings, 
        applies lensing operation, predicts scalar value.
+
+       Parameters are always stored in float32. With a lower precision dtype
+       (e.g. jnp.bfloat16), encoder_fn and reduce_fn are passed dtype and
+       compute in it. Transformer encoders take no dtype, so their parameters
+       are instead cast to dtype where the encoder is applied.
+
+       With segment_ids, x holds packed sequences (see PackedBatches) and
+       embeddings and predictions are computed for each of the max_segments
+       segments of every row.
     """
 
         outputs = dict()
 
+        if segment_ids is not None:
+            if use_transformer:
+                raise ValueError(
+                    'Packed sequences are not supported by transformer encoders!'
+                )
+            # Position-wise encoders such as one_hot_encoder ignore segments.
+            if 'segment_ids' in inspect.signature(encoder_fn).parameters:
+                encoder_fn_kwargs = dict(encoder_fn_kwargs,
+                                         segment_ids=segment_ids)
+            reduce_fn_kwargs = dict(reduce_fn_kwargs,
+                                    segment_ids=segment_ids,
+                                    max_segments=max_segments)
+
         if padding_mask is None:
             padding_mask = jnp.expand_dims(jnp.where(x < num_categories - 1, 1,
                                                      0),
                                            axis=2)
 
+        if dtype != jnp.float32:
+            encoder_fn_kwargs = dict(encoder_fn_kwargs, dtype=dtype)
+            reduce_fn_kwargs = dict(reduce_fn_kwargs, dtype=dtype)
+
         if not use_transformer:
             x = encoder_fn(x,
                            num_categories=num_categories,
                            **encoder_fn_kwargs)
-        else:
+        elif dtype == jnp.float32:
             x = encoder_fn(x)
+        else:
+            # Stored under the name encoder_fn(x) gets, so float32 and
+            # lower precision models load the same parameters.
+            transformer_params = self.param(
+                'Transformer_0', None,
+                lambda key, _: encoder_fn.init(key, x)[1])
+            x = encoder_fn.call(
+                jax.tree_map(lambda param: param.astype(dtype),
+                             transformer_params), x)
+
+        outputs['encoding'] = x
 
         rep = reduce_fn(x, padding_mask=padding_mask, **reduce_fn_kwargs)
 
@@ -283,7 +1428,8 @@ class RepresentationModel(nn.Module):
         out = nn.Dense(rep,
                        output_features,
                        kernel_init=nn.initializers.xavier_uniform(),
-                       bias_init=nn.initializers.normal(stddev=1e-6))
+                       bias_init=nn.initializers.normal(stddev=1e-6),
+                       dtype=dtype)
 
         outputs['prediction'] = out
 
@@ -300,7 +1446,8 @@ def create_representation_model(encoder_fn,
                                 key=random.PRNGKey(0),
                                 encoder_fn_params=None,
                                 reduce_fn_params=None,
-                                predict_fn_params=None):
+                                predict_fn_params=None,
+                                dtype=jnp.float32):
     """Instantiates a RepresentationModel object."""
 
     module = RepresentationModel.partial(encoder_fn=encoder_fn,
@@ -310,7 +1457,8 @@ def create_representation_model(encoder_fn,
                                          num_categories=num_categories,
                                          output_features=output_features,
                                          output=output,
-                                         use_transformer=False)
+                                         use_transformer=False,
+                                         dtype=dtype)
 
     _, initial_params = RepresentationModel.init_by_shape(
         key,
@@ -322,7 +1470,8 @@ def create_representation_model(encoder_fn,
         num_categories=num_categories,
         output_features=output_features,
         output=output,
-        use_transformer=False)
+        use_transformer=False,
+        dtype=dtype)
 
     loaded_params = load_params(initial_params, encoder_fn_params,
                                 reduce_fn_params, predict_fn_params)
@@ -332,6 +1481,110 @@ def create_representation_model(encoder_fn,
     return model
 
 
+def cached_encoder_fn(x, num_categories, dtype=jnp.float32):
+    """Stands in for a frozen encoder whose outputs x are precomputed."""
+
+    return x.astype(dtype)
+
+
+def create_cached_encoder_representation_model(reduce_fn,
+                                               reduce_fn_kwargs,
+                                               num_categories,
+                                               output_features,
+                                               feature_size,
+                                               output='prediction',
+                                               key=random.PRNGKey(0),
+                                               reduce_fn_params=None,
+                                               predict_fn_params=None,
+                                               dtype=jnp.float32):
+    """Instantiates a RepresentationModel object on precomputed encoder features.
+
+    The model is called as model(x=features, padding_mask=padding_mask).
+    Having no encoder parameters, its layers are named as those of a model
+    with one_hot encoder (see architecture_to_layers).
+    """
+
+    module = RepresentationModel.partial(encoder_fn=cached_encoder_fn,
+                                         encoder_fn_kwargs={},
+                                         reduce_fn=reduce_fn,
+                                         reduce_fn_kwargs=reduce_fn_kwargs,
+                                         num_categories=num_categories,
+                                         output_features=output_features,
+                                         output=output,
+                                         use_transformer=False,
+                                         dtype=dtype)
+
+    _, initial_params = RepresentationModel.init_by_shape(
+        key,
+        input_specs=[((1, 1, feature_size), jnp.float32)],
+        padding_mask=jnp.ones((1, 1, 1), dtype=jnp.int32),
+        encoder_fn=cached_encoder_fn,
+        encoder_fn_kwargs={},
+        reduce_fn=reduce_fn,
+        reduce_fn_kwargs=reduce_fn_kwargs,
+        num_categories=num_categories,
+        output_features=output_features,
+        output=output,
+        use_transformer=False,
+        dtype=dtype)
+
+    loaded_params = load_params(initial_params,
+                                reduce_fn_params=reduce_fn_params,
+                                predict_fn_params=predict_fn_params)
+
+    model = nn.Model(module, loaded_params)
+
+    return model
+
+
+def create_packed_model(model, max_segments):
+    """RepresentationModel sharing model's parameters, applied to batches of PackedBatches.
+
+    The packed model is called as model(x=X, segment_ids=segment_ids) and
+    outputs one row per segment slot of the batch, see unpack_outputs. Its
+    segments match model on the same sequences unpacked if model's CNN
+    encoder and GatedConv lens are built with mask_padding=True.
+    """
+
+    packed_model = nn.Model(model.module.partial(max_segments=max_segments),
+                            model.params)
+
+    return packed_model
+
+
+def merge_params(params, new_params):
+    """Copy of params with its layers that also appear in new_params replaced."""
+
+    merged_params = {
+        layer: new_params.get(layer, layer_params)
+        for layer, layer_params in params.items()
+    }
+
+    return merged_params
+
+
+def remat_module(module):
+    """Subclass of module whose positional inputs are rematerialized with jax.checkpoint.
+
+    As in CNN, parameters are created outside of jax.checkpoint during
+    initialization. The subclass keeps module's name, so its parameters are
+    named as module's.
+    """
+
+    class RematModule(module):
+
+        def apply(self, *args, **kwargs):
+            apply_fn = functools.partial(super(RematModule, self).apply,
+                                         **kwargs)
+            if self.is_initializing():
+                return apply_fn(*args)
+            return jax.checkpoint(apply_fn)(*args)
+
+    RematModule.__name__ = module.__name__
+
+    return RematModule
+
+
 def create_transformer_representation_model(transformer_kwargs,
                                             reduce_fn,
                                             reduce_fn_kwargs,
@@ -342,8 +1595,24 @@ def create_transformer_representation_model(transformer_kwargs,
                                             key=random.PRNGKey(0),
                                             encoder_fn_params=None,
                                             reduce_fn_params=None,
-                                            predict_fn_params=None):
-    """Instantiates a RepresentationModel object with Transformer encoder."""
+                                            predict_fn_params=None,
+                                            dtype=jnp.float32,
+                                            remat=False):
+    """Instantiates a RepresentationModel object with Transformer encoder.
+
+    With remat, the self-attention of each transformer layer, whose attention
+    weights dominate its activation memory, is recomputed in the backward
+    pass instead of stored.
+    """
+
+    if remat:
+        # protein_lm builds the transformer layers itself and only exposes
+        # the self-attention module each of them applies.
+        self_attention_module = transformer_kwargs.get('self_attention_module',
+                                                       nn.SelfAttention)
+        transformer_kwargs = dict(
+            transformer_kwargs,
+            self_attention_module=remat_module(self_attention_module))
 
     if not bidirectional:
         transformer = models.FlaxLM(**transformer_kwargs)
@@ -362,7 +1631,8 @@ def create_transformer_representation_model(transformer_kwargs,
                                          num_categories=num_categories,
                                          output_features=output_features,
                                          output=output,
-                                         use_transformer=True)
+                                         use_transformer=True,
+                                         dtype=dtype)
 
     _, initial_params = RepresentationModel.init_by_shape(
         key,
@@ -374,7 +1644,8 @@ def create_transformer_representation_model(transformer_kwargs,
         num_categories=num_categories,
         output_features=output_features,
         output=output,
-        use_transformer=True)
+        use_transformer=True,
+        dtype=dtype)
 
     loaded_params = load_params(initial_params, encoder_fn_params,
                                 reduce_fn_params, predict_fn_params)
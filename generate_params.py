@@ -10,6 +10,12 @@ import numpy as np
 
 from frozendict import frozendict
 
+# Parameters that may differ between configs trained in a single vectorized sweep.
+SWEEP_PARAMS = [
+    'label', 'encoder_lr', 'lens_lr', 'predictor_lr', 'encoder_wd', 'lens_wd',
+    'predictor_wd', 'model_random_key'
+]
+
 
 def create_params(encoder_lrs,
                   lens_lrs,
@@ -98,6 +104,28 @@ def create_params(encoder_lrs,
     return params
 
 
+def create_sweeps(params, max_sweep_size=16):
+    """Groups labeled params differing only in SWEEP_PARAMS into sweeps of at most max_sweep_size."""
+
+    groups = {}
+    for param_dict in params:
+        shared_params = frozendict({
+            key: value
+            for key, value in param_dict.items() if key not in SWEEP_PARAMS
+        })
+        groups.setdefault(shared_params, []).append(param_dict['label'])
+
+    sweeps = []
+    for labels in groups.values():
+        for start in range(0, len(labels), max_sweep_size):
+            sweeps.append({
+                'sweep_labels': ','.join(labels[start:start + max_sweep_size]),
+                'sweep_params_path': 'label_to_params.json'
+            })
+
+    return sweeps
+
+
 # Generate parameters from different sets of parameter combinations.
 def main(load_gcs_bucket, save_gcs_bucket):
 
@@ -1161,6 +1189,10 @@ def main(load_gcs_bucket, save_gcs_bucket):
     with open('label_to_params.json', 'w') as f:
         json.dump(label_to_params, f)
 
+    # Configs sharing an architecture and data are trained together by pfam_experiment.
+    with open('sweep_combinations.json', 'w') as f:
+        json.dump(create_sweeps(unique_params), f)
+
 
 if __name__ == '__main__':
     main(load_gcs_bucket='neuralblast_public',
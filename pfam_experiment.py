@@ -25,27 +25,41 @@ import copy
 
 import time
 
+import hashlib
+
 from pkg_resources import resource_filename
 
 from fs_gcsfs import GCSFS
 
 from google_research.protein_lm import domains, models
 
-from contextual_lenses.contextual_lenses import reduce_fn_name_to_fn
+from contextual_lenses.contextual_lenses import reduce_fn_name_to_fn, \
+gated_conv
 
 from contextual_lenses.train_utils import create_optimizer, train, \
 create_representation_model, create_transformer_representation_model, \
-architecture_to_layers
+architecture_to_layers, DevicePrefetcher, \
+create_cached_encoder_representation_model, merge_params, PackedBatches, \
+create_packed_model, packing_gap, train_sweep
 
-from contextual_lenses.encoders import encoder_fn_name_to_fn
+from contextual_lenses.encoders import encoder_fn_name_to_fn, \
+cnn_one_hot_encoder
 
 from contextual_lenses.loss_fns import cross_entropy_loss
 
 from contextual_lenses.pfam_utils import get_family_ids, PFAM_NUM_CATEGORIES, \
-pfam_evaluate, create_pfam_batches, pfam_nearest_neighbors_classification
+pfam_evaluate, create_pfam_batches, pfam_nearest_neighbors_classification, \
+set_pfam_df_cache_max_bytes, cache_nested_pfam_dfs, fill_pfam_encoder_cache
+
+from contextual_lenses.encoder_cache import encoder_cache_key, \
+EncoderFeatureCache, EncoderFeatureBatches
+
+from contextual_lenses.knn import resolve_knn_backend
 
 from contextual_lenses.load_transformer import load_transformer_params
 
+from generate_params import SWEEP_PARAMS
+
 from absl import app, flags
 
 # Define flags.
@@ -68,6 +82,34 @@ flags.DEFINE_integer(
 flags.DEFINE_integer('lens_batch_size', 64, 'Batch size for lens training.')
 flags.DEFINE_integer('knn_batch_size', 64,
                      'Batch size for KNN vector computation.')
+flags.DEFINE_list(
+    'lens_bucket_boundaries', None,
+    'Sequence length bucket boundaries for lens training batches, e.g. 64,128,256,512 (None = no bucketing).'
+)
+flags.DEFINE_integer(
+    'lens_steps_per_call', 1,
+    'Number of lens training batches stacked into one compiled call (1 = one call per batch).'
+)
+flags.DEFINE_integer(
+    'lens_accumulation_steps', 1,
+    'Number of micro-batches each lens training batch is split into for gradient accumulation (must divide lens_batch_size).'
+)
+flags.DEFINE_integer(
+    'lens_max_segments', None,
+    'Maximum number of sequences packed into each row of a lens training batch, lens_batch_size then counting rows (None = one sequence per row). CNN encoders and GatedConv lenses of the run then mask padding in their convolutions.'
+)
+flags.DEFINE_enum(
+    'precision', 'float32', ['float32', 'bfloat16'],
+    'Compute dtype of encoder, lens and predictor (parameters, optimizer state, pooling and loss stay float32).'
+)
+flags.DEFINE_enum(
+    'remat', 'none', ['none', 'blocks'],
+    'Activations recomputed in the backward pass instead of stored: blocks recomputes each CNN encoder and GatedConv lens layer and the self-attention of each transformer encoder layer.'
+)
+flags.DEFINE_boolean(
+    'use_pmap', False,
+    'Whether to train the lens data-parallel across all local devices (lens_batch_size must be divisible by their number).'
+)
 
 flags.DEFINE_float('encoder_lr', 0.0, 'Encoder learning rate.')
 flags.DEFINE_float('lens_lr', 1e-5, 'Lens learning rate.')
@@ -106,6 +148,25 @@ flags.DEFINE_string('load_gcs_bucket', 'neuralblast_public',
                     'GCS bucket to load from.')
 flags.DEFINE_string('data_partitions_dirpath', 'random_split/',
                     'Location of Pfam data in load GCS bucket.')
+flags.DEFINE_string(
+    'pfam_store_dir', None,
+    'Local directory of memory-mapped Pfam token stores (None = parse CSVs).')
+flags.DEFINE_integer(
+    'pfam_chunk_size', None,
+    'Number of CSV rows streamed at a time when featurizing Pfam data (None = load whole partition).'
+)
+flags.DEFINE_boolean(
+    'reservoir_sampling', False,
+    'Whether or not to sample Pfam families in one pass with nested per-family samples instead of shuffling.'
+)
+flags.DEFINE_string(
+    'encoder_cache_dir', None,
+    'Local directory of cached frozen encoder outputs shared across runs, used if encoder_lr and encoder_wd are 0 (None = no cache).'
+)
+flags.DEFINE_float(
+    'pfam_df_cache_gb', 4.0,
+    'Memory budget in GB for caching featurized Pfam dataframes (0 = no cache).'
+)
 
 flags.DEFINE_string('save_gcs_bucket', 'sequin-public',
                     'GCS bucket to save to.')
@@ -127,6 +188,35 @@ flags.DEFINE_string('save_model_dir', '',
 
 flags.DEFINE_string('label', '', 'Label used to save experiment results.')
 
+flags.DEFINE_list(
+    'sweep_labels', None,
+    'Labels of configs in sweep_params_path differing only in learning rates, weight decays and model_random_key to train together (None = train the config given by flags).'
+)
+flags.DEFINE_string('sweep_params_path', 'label_to_params.json',
+                    'JSON file mapping labels to configs.')
+
+flags.DEFINE_string(
+    'baseline_cache_dir', '',
+    'Directory in save GCS bucket to share untrained lens kNN accuracies across runs in (empty = no cache).'
+)
+
+# Bumped whenever encoder, lens or kNN changes alter untrained lens kNN
+# accuracies, so that shared baselines of older code are not reused.
+BASELINE_CACHE_VERSION = 1
+
+# Untrained lens kNN accuracies only depend on these flags, the model kwargs
+# and model_random_key.
+BASELINE_PARAMS = [
+    'encoder_fn_name', 'reduce_fn_name', 'use_transformer', 'use_bert',
+    'restore_transformer_dir', 'precision', 'train_families',
+    'first_test_family', 'last_test_family', 'knn_shuffle_seed',
+    'knn_sample_random_state', 'reservoir_sampling', 'load_gcs_bucket',
+    'data_partitions_dirpath'
+]
+
+# Untrained lens kNN accuracies measured by this process by baseline key.
+_untrained_lens_accuracies = {}
+
 
 def get_model_kwargs(encoder_fn_name, encoder_fn_kwargs_path, reduce_fn_name,
                      reduce_fn_kwargs_path):
@@ -154,6 +244,26 @@ def get_model_kwargs(encoder_fn_name, encoder_fn_kwargs_path, reduce_fn_name,
     return encoder_fn, encoder_fn_kwargs, reduce_fn, reduce_fn_kwargs, layers
 
 
+def layer_values(encoder_fn_name, reduce_fn_name, encoder_value, lens_value,
+                 predictor_value):
+    """Aligns encoder, lens and predictor values with architecture_to_layers.
+
+    Values of parameterless encoders (one_hot) and lenses (max_pool,
+    mean_pool) are dropped, as these have no layer.
+    """
+
+    layers, trainable_encoder = architecture_to_layers(encoder_fn_name,
+                                                       reduce_fn_name)
+
+    values = [predictor_value]
+    if len(layers) > 1 + trainable_encoder:
+        values.insert(0, lens_value)
+    if trainable_encoder:
+        values.insert(0, encoder_value)
+
+    return values
+
+
 def create_model(encoder_fn,
                  encoder_fn_kwargs,
                  reduce_fn,
@@ -166,12 +276,20 @@ def create_model(encoder_fn,
                  encoder_fn_params=None,
                  reduce_fn_params=None,
                  predict_fn_params=None,
-                 random_key=0):
+                 random_key=0,
+                 dtype=jnp.float32,
+                 remat='none'):
     """Creates representation model (encoder --> lens --> predictor) architecture."""
 
     family_ids = get_family_ids()
     num_families = len(family_ids)
 
+    if remat == 'blocks':
+        if encoder_fn is cnn_one_hot_encoder:
+            encoder_fn_kwargs = dict(encoder_fn_kwargs, remat=True)
+        if reduce_fn is gated_conv:
+            reduce_fn_kwargs = dict(reduce_fn_kwargs, remat=True)
+
     if use_transformer:
 
         if use_bert:
@@ -199,7 +317,9 @@ def create_model(encoder_fn,
             key=random.PRNGKey(random_key),
             encoder_fn_params=pretrained_transformer_params,
             reduce_fn_params=reduce_fn_params,
-            predict_fn_params=predict_fn_params)
+            predict_fn_params=predict_fn_params,
+            dtype=dtype,
+            remat=remat == 'blocks')
 
     else:
         model = create_representation_model(
@@ -213,7 +333,8 @@ def create_model(encoder_fn,
             key=random.PRNGKey(random_key),
             encoder_fn_params=encoder_fn_params,
             reduce_fn_params=reduce_fn_params,
-            predict_fn_params=predict_fn_params)
+            predict_fn_params=predict_fn_params,
+            dtype=dtype)
 
     return model
 
@@ -246,7 +367,10 @@ def measure_nearest_neighbor_performance(accuracy_label, encoder,
         shuffle_seed=shuffle_seed,
         sample_random_state=sample_random_state,
         data_partitions_dirpath=FLAGS.data_partitions_dirpath,
-        gcs_bucket=FLAGS.load_gcs_bucket)[0]
+        gcs_bucket=FLAGS.load_gcs_bucket,
+        store_dir=FLAGS.pfam_store_dir,
+        chunk_size=FLAGS.pfam_chunk_size,
+        reservoir_sampling=FLAGS.reservoir_sampling)[0]
 
     accuracy = results['1-nn accuracy']
 
@@ -255,8 +379,113 @@ def measure_nearest_neighbor_performance(accuracy_label, encoder,
     return accuracy_dict
 
 
+def untrained_lens_baseline_key(encoder_fn_kwargs, reduce_fn_kwargs,
+                                model_random_key):
+    """Hash of everything untrained lens kNN accuracies depend on.
+
+    This includes the kNN backend, since float32 JAX and float64 NumPy
+    distances can order near ties differently.
+    """
+
+    baseline_params = {key: getattr(FLAGS, key) for key in BASELINE_PARAMS}
+    baseline_params.update({
+        'version': BASELINE_CACHE_VERSION,
+        'encoder_fn_kwargs': encoder_fn_kwargs,
+        'reduce_fn_kwargs': reduce_fn_kwargs,
+        'model_random_key': model_random_key,
+        'knn_backend': resolve_knn_backend()
+    })
+
+    return hashlib.sha1(
+        json.dumps(baseline_params, sort_keys=True).encode()).hexdigest()
+
+
+def measure_untrained_lens_performance(embedding_model, encoder_fn_kwargs,
+                                       reduce_fn_kwargs, model_random_key,
+                                       lens_knn_train_family_accessions,
+                                       knn_test_family_accessions,
+                                       knn_train_samples_):
+    """Untrained lens kNN accuracies, measured once per baseline key across runs.
+
+    Accuracies are memoized in this process and, unless baseline_cache_dir
+    is empty, stored as JSON in the save GCS bucket for other runs.
+    """
+
+    key = untrained_lens_baseline_key(encoder_fn_kwargs, reduce_fn_kwargs,
+                                      model_random_key)
+    if key in _untrained_lens_accuracies:
+        return _untrained_lens_accuracies[key]
+
+    if FLAGS.baseline_cache_dir != '':
+        gcsfs = GCSFS(FLAGS.save_gcs_bucket)
+        path = os.path.join(FLAGS.baseline_cache_dir, key + '.json')
+        if gcsfs.exists(path):
+            with gcsfs.open(path, 'r') as gcs_file:
+                accuracy_dict = json.load(gcs_file)
+            _untrained_lens_accuracies[key] = accuracy_dict
+            return accuracy_dict
+
+    accuracy_dict = measure_nearest_neighbor_performance(
+        accuracy_label='train_knn_accuracy_untrained_lens_1_knn_train_samples',
+        encoder=embedding_model,
+        family_accessions=lens_knn_train_family_accessions,
+        batch_size=FLAGS.knn_batch_size,
+        train_samples=1,
+        shuffle_seed=FLAGS.knn_shuffle_seed,
+        sample_random_state=FLAGS.knn_sample_random_state)
+
+    for knn_train_samples in knn_train_samples_:
+
+        accuracy_dict.update(
+            measure_nearest_neighbor_performance(
+                accuracy_label='test_knn_accuracy_untrained_lens_' +
+                str(knn_train_samples) + '_knn_train_samples',
+                encoder=embedding_model,
+                family_accessions=knn_test_family_accessions,
+                batch_size=FLAGS.knn_batch_size,
+                train_samples=knn_train_samples,
+                shuffle_seed=FLAGS.knn_shuffle_seed,
+                sample_random_state=FLAGS.knn_sample_random_state))
+
+    accuracy_dict = {
+        label: float(accuracy)
+        for label, accuracy in accuracy_dict.items()
+    }
+    _untrained_lens_accuracies[key] = accuracy_dict
+
+    if FLAGS.baseline_cache_dir != '':
+        gcsfs.makedirs(FLAGS.baseline_cache_dir, recreate=True)
+        with gcsfs.open(path, 'w') as gcs_file:
+            json.dump(accuracy_dict, gcs_file)
+
+    return accuracy_dict
+
+
 # Train lens and measure performance of lens and nearest neighbors classifier.
-def main(_):
+def run_experiment(sweep_params):
+    """Runs the configs of sweep_params, training them together if there are several.
+
+    Configs are dictionaries of flag values as written by generate_params and
+    may only differ in SWEEP_PARAMS. Flags they set stay set afterwards.
+    """
+
+    shared_params = {
+        key: value
+        for key, value in sweep_params[0].items() if key not in SWEEP_PARAMS
+    }
+    for param_dict in sweep_params[1:]:
+        assert {
+            key: value
+            for key, value in param_dict.items() if key not in SWEEP_PARAMS
+        } == shared_params, 'Swept configs may only differ in %s!' % SWEEP_PARAMS
+    for key, value in sweep_params[0].items():
+        setattr(FLAGS, key, value)
+
+    if len(sweep_params) > 1:
+        assert not FLAGS.use_pmap and FLAGS.lens_steps_per_call == 1 and FLAGS.lens_accumulation_steps == 1, \
+        'Sweeps are trained one unsharded batch at a time!'
+        assert FLAGS.encoder_cache_dir is None, 'Sweeps do not support encoder_cache_dir!'
+        assert not FLAGS.load_model and not FLAGS.save_model, 'Sweeps do not load or save models!'
 
     if FLAGS.use_transformer:
         assert (
@@ -267,6 +496,20 @@ def main(_):
             ), 'Number of measurements must divide number of epochs!'
     measurement_epochs = FLAGS.epochs // FLAGS.measurements
 
+    if FLAGS.use_pmap:
+        assert (
+            FLAGS.lens_batch_size % jax.local_device_count() == 0
+        ), 'Number of local devices must divide lens_batch_size if use_pmap is True!'
+        lens_shard_size = FLAGS.lens_batch_size // jax.local_device_count()
+    else:
+        lens_shard_size = FLAGS.lens_batch_size
+    assert (lens_shard_size % FLAGS.lens_accumulation_steps == 0
+            ), 'lens_accumulation_steps must divide the per-device lens batch size!'
+
+    if FLAGS.lens_max_segments is not None:
+        assert not FLAGS.use_transformer, 'Transformer encoders do not support packed sequences!'
+        assert FLAGS.encoder_cache_dir is None, 'Packed sequences do not support encoder_cache_dir!'
+
     assert FLAGS.results_save_dir != '', 'Specify results_save_dir!'
 
     assert FLAGS.label != '', 'Specify label!'
@@ -278,6 +521,20 @@ def main(_):
     if FLAGS.save_model:
         assert FLAGS.save_model_dir != '', 'Specify save_model_dir!'
 
+    set_pfam_df_cache_max_bytes(int(FLAGS.pfam_df_cache_gb * 2**30))
+
+    compute_dtype = {
+        'float32': jnp.float32,
+        'bfloat16': jnp.bfloat16
+    }[FLAGS.precision]
+
+    if FLAGS.lens_bucket_boundaries is not None:
+        lens_bucket_boundaries = [
+            int(boundary) for boundary in FLAGS.lens_bucket_boundaries
+        ]
+    else:
+        lens_bucket_boundaries = None
+
     datum = {
         'label': FLAGS.label,
         'encoder_fn_name': FLAGS.encoder_fn_name,
@@ -287,6 +544,13 @@ def main(_):
         'epochs': FLAGS.epochs,
         'measurements': FLAGS.measurements,
         'lens_batch_size': FLAGS.lens_batch_size,
+        'lens_bucket_boundaries': lens_bucket_boundaries,
+        'lens_steps_per_call': FLAGS.lens_steps_per_call,
+        'lens_accumulation_steps': FLAGS.lens_accumulation_steps,
+        'lens_max_segments': FLAGS.lens_max_segments,
+        'precision': FLAGS.precision,
+        'remat': FLAGS.remat,
+        'use_pmap': FLAGS.use_pmap,
         'knn_batch_size': FLAGS.knn_batch_size,
         'encoder_lr': FLAGS.encoder_lr,
         'lens_lr': FLAGS.lens_lr,
@@ -308,6 +572,8 @@ def main(_):
         'restore_transformer_dir': FLAGS.restore_transformer_dir,
         'load_gcs_bucket': FLAGS.load_gcs_bucket,
         'data_partitions_dirpath': FLAGS.data_partitions_dirpath,
+        'reservoir_sampling': FLAGS.reservoir_sampling,
+        'encoder_cache_dir': FLAGS.encoder_cache_dir,
         'save_gcs_bucket': FLAGS.save_gcs_bucket,
         'results_save_dir': FLAGS.results_save_dir,
         'load_model': FLAGS.load_model,
@@ -317,13 +583,17 @@ def main(_):
         'save_model_dir': FLAGS.save_model_dir
     }
 
+    data = [dict(datum, **param_dict) for param_dict in sweep_params]
+
     gcsfs = GCSFS(FLAGS.save_gcs_bucket)
 
-    print(datum)
-    df = pd.DataFrame([datum])
-    with gcsfs.open(os.path.join(FLAGS.results_save_dir, FLAGS.label + '.csv'),
-                    'w') as gcs_file:
-        df.to_csv(gcs_file, index=False)
+    for datum in data:
+        print(datum)
+        df = pd.DataFrame([datum])
+        with gcsfs.open(
+                os.path.join(FLAGS.results_save_dir, datum['label'] + '.csv'),
+                'w') as gcs_file:
+            df.to_csv(gcs_file, index=False)
 
     knn_train_samples_ = [1, 5, 10, 50]
 
@@ -341,49 +611,68 @@ def main(_):
         family_name = 'PF%05d' % _
         knn_test_family_accessions.append(family_name)
 
+    # Nested kNN train samples of the test families come from a single pass.
+    if FLAGS.reservoir_sampling:
+        cache_nested_pfam_dfs(
+            family_accessions=knn_test_family_accessions,
+            sample_sizes=knn_train_samples_,
+            random_state=FLAGS.knn_sample_random_state,
+            data_partitions_dirpath=FLAGS.data_partitions_dirpath,
+            gcs_bucket=FLAGS.load_gcs_bucket,
+            store_dir=FLAGS.pfam_store_dir,
+            chunk_size=FLAGS.pfam_chunk_size)
+
     encoder_fn, encoder_fn_kwargs, reduce_fn, reduce_fn_kwargs, layers = get_model_kwargs(
         encoder_fn_name=FLAGS.encoder_fn_name,
         encoder_fn_kwargs_path=FLAGS.encoder_fn_kwargs_path,
         reduce_fn_name=FLAGS.reduce_fn_name,
         reduce_fn_kwargs_path=FLAGS.reduce_fn_kwargs_path)
 
-    embedding_model = create_model(
-        encoder_fn=encoder_fn,
-        encoder_fn_kwargs=encoder_fn_kwargs,
-        reduce_fn=reduce_fn,
-        reduce_fn_kwargs=reduce_fn_kwargs,
-        layers=layers,
-        output='embedding',
-        use_transformer=FLAGS.use_transformer,
-        use_bert=FLAGS.use_bert,
-        restore_transformer_dir=FLAGS.restore_transformer_dir,
-        random_key=FLAGS.model_random_key)
-
-    datum.update(
-        measure_nearest_neighbor_performance(
-            accuracy_label=
-            'train_knn_accuracy_untrained_lens_1_knn_train_samples',
-            encoder=embedding_model,
-            family_accessions=lens_knn_train_family_accessions,
-            batch_size=FLAGS.knn_batch_size,
-            train_samples=1,
-            shuffle_seed=FLAGS.knn_shuffle_seed,
-            sample_random_state=FLAGS.knn_sample_random_state))
-
-    for knn_train_samples in knn_train_samples_:
+    # A frozen encoder is run once per sequence across measurements and runs.
+    use_encoder_cache = (FLAGS.encoder_cache_dir is not None and
+                         FLAGS.encoder_fn_name != 'one_hot' and
+                         FLAGS.encoder_lr == 0 and FLAGS.encoder_wd == 0)
+
+    # Packed training masks padding in convolutions, so every model of the
+    # run, including evaluation and kNN models, does too. So does training
+    # on cached encoder features, which are only stored within sequences.
+    if FLAGS.lens_max_segments is not None or use_encoder_cache:
+        if encoder_fn is cnn_one_hot_encoder:
+            encoder_fn_kwargs = dict(encoder_fn_kwargs, mask_padding=True)
+        if reduce_fn is gated_conv:
+            reduce_fn_kwargs = dict(reduce_fn_kwargs, mask_padding=True)
+
+    embedding_models = []
+    models = []
+    for datum in data:
+
+        embedding_model = create_model(
+            encoder_fn=encoder_fn,
+            encoder_fn_kwargs=encoder_fn_kwargs,
+            reduce_fn=reduce_fn,
+            reduce_fn_kwargs=reduce_fn_kwargs,
+            layers=layers,
+            output='embedding',
+            use_transformer=FLAGS.use_transformer,
+            use_bert=FLAGS.use_bert,
+            restore_transformer_dir=FLAGS.restore_transformer_dir,
+            random_key=datum['model_random_key'],
+            dtype=compute_dtype)
+        embedding_models.append(embedding_model)
 
         datum.update(
-            measure_nearest_neighbor_performance(
-                accuracy_label='test_knn_accuracy_untrained_lens_' +
-                str(knn_train_samples) + '_knn_train_samples',
-                encoder=embedding_model,
-                family_accessions=knn_test_family_accessions,
-                batch_size=FLAGS.knn_batch_size,
-                train_samples=knn_train_samples,
-                shuffle_seed=FLAGS.knn_shuffle_seed,
-                sample_random_state=FLAGS.knn_sample_random_state))
-
-    model = create_model(encoder_fn=encoder_fn,
+            measure_untrained_lens_performance(
+                embedding_model=embedding_model,
+                encoder_fn_kwargs=encoder_fn_kwargs,
+                reduce_fn_kwargs=reduce_fn_kwargs,
+                model_random_key=datum['model_random_key'],
+                lens_knn_train_family_accessions=
+                lens_knn_train_family_accessions,
+                knn_test_family_accessions=knn_test_family_accessions,
+                knn_train_samples_=knn_train_samples_))
+
+        models.append(
+            create_model(encoder_fn=encoder_fn,
                          encoder_fn_kwargs=encoder_fn_kwargs,
                          reduce_fn=reduce_fn,
                          reduce_fn_kwargs=reduce_fn_kwargs,
@@ -392,13 +681,25 @@ def main(_):
                          use_transformer=FLAGS.use_transformer,
                          use_bert=FLAGS.use_bert,
                          restore_transformer_dir=FLAGS.restore_transformer_dir,
-                         random_key=FLAGS.model_random_key)
-
-    optimizer = create_optimizer(
-        model=model,
-        learning_rate=[FLAGS.encoder_lr, FLAGS.lens_lr, FLAGS.predictor_lr],
-        weight_decay=[FLAGS.encoder_wd, FLAGS.lens_wd, FLAGS.predictor_wd],
-        layers=layers)
+                         random_key=datum['model_random_key'],
+                         dtype=compute_dtype,
+                         remat=FLAGS.remat))
+
+    learning_rates = [
+        layer_values(FLAGS.encoder_fn_name, FLAGS.reduce_fn_name,
+                     datum['encoder_lr'], datum['lens_lr'],
+                     datum['predictor_lr']) for datum in data
+    ]
+    weight_decays = [
+        layer_values(FLAGS.encoder_fn_name, FLAGS.reduce_fn_name,
+                     datum['encoder_wd'], datum['lens_wd'],
+                     datum['predictor_wd']) for datum in data
+    ]
+
+    optimizer = create_optimizer(model=models[0],
+                                 learning_rate=learning_rates[0],
+                                 weight_decay=weight_decays[0],
+                                 layers=layers)
 
     if FLAGS.load_model:
         optimizer = checkpoints.restore_checkpoint(ckpt_dir=os.path.join(
@@ -407,8 +708,8 @@ def main(_):
                                                    step=FLAGS.load_model_step)
 
         trained_params = optimizer.target.params
-        embedding_model = set_model_parameters(model=embedding_model,
-                                               params=trained_params)
+        embedding_models[0] = set_model_parameters(model=embedding_models[0],
+                                                   params=trained_params)
 
     if FLAGS.save_model:
         checkpoints.save_checkpoint(ckpt_dir=os.path.join(
@@ -416,6 +717,42 @@ def main(_):
                                     target=optimizer,
                                     step=FLAGS.load_model_step)
 
+    if use_encoder_cache:
+        encoder_cache = EncoderFeatureCache(
+            FLAGS.encoder_cache_dir,
+            encoder_cache_key(
+                FLAGS.encoder_fn_name,
+                dict(encoder_fn_kwargs,
+                     use_bert=FLAGS.use_bert,
+                     precision=FLAGS.precision),
+                optimizer.target.params[layers[0]]))
+        encoder = nn.Model(optimizer.target.module.partial(output='encoding'),
+                           optimizer.target.params)
+        fill_pfam_encoder_cache(
+            encoder=encoder,
+            encoder_cache=encoder_cache,
+            family_accessions=lens_knn_train_family_accessions,
+            samples=FLAGS.lens_train_samples,
+            random_state=FLAGS.lens_sample_random_state,
+            data_partitions_dirpath=FLAGS.data_partitions_dirpath,
+            gcs_bucket=FLAGS.load_gcs_bucket,
+            store_dir=FLAGS.pfam_store_dir,
+            chunk_size=FLAGS.pfam_chunk_size,
+            reservoir_sampling=FLAGS.reservoir_sampling,
+            batch_size=FLAGS.knn_batch_size)
+        fill_pfam_encoder_cache(
+            encoder=encoder,
+            encoder_cache=encoder_cache,
+            family_accessions=lens_knn_train_family_accessions,
+            test=True,
+            data_partitions_dirpath=FLAGS.data_partitions_dirpath,
+            gcs_bucket=FLAGS.load_gcs_bucket,
+            store_dir=FLAGS.pfam_store_dir,
+            chunk_size=FLAGS.pfam_chunk_size,
+            batch_size=FLAGS.knn_batch_size)
+    else:
+        encoder_cache = None
+
     for i in range(FLAGS.measurements):
 
         train_batches, train_indexes = create_pfam_batches(
@@ -425,70 +762,189 @@ def main(_):
             epochs=measurement_epochs,
             drop_remainder=True,
             shuffle_seed=FLAGS.lens_shuffle_seed + i,
-            sample_random_state=FLAGS.lens_sample_random_state)
-
-        optimizer = train(
-            model=optimizer.target,
-            train_data=train_batches,
-            loss_fn=cross_entropy_loss,
-            loss_fn_kwargs=loss_fn_kwargs,
-            learning_rate=[
-                FLAGS.encoder_lr, FLAGS.lens_lr, FLAGS.predictor_lr
-            ],
-            weight_decay=[FLAGS.encoder_wd, FLAGS.lens_wd, FLAGS.predictor_wd],
-            layers=layers)
-
-        results, preds = pfam_evaluate(
-            predict_fn=optimizer.target,
-            test_family_accessions=lens_knn_train_family_accessions,
-            title=None,
-            loss_fn_kwargs=loss_fn_kwargs,
-            batch_size=FLAGS.lens_batch_size,
+            sample_random_state=FLAGS.lens_sample_random_state,
             data_partitions_dirpath=FLAGS.data_partitions_dirpath,
-            gcs_bucket=FLAGS.load_gcs_bucket)
-
-        lens_accuracy = results['accuracy']
-        datum['lens_accuracy' + '_measurement_' + str(i)] = lens_accuracy
-
-        lens_cross_entropy = float(results['cross_entropy'])
-        datum['lens_cross_entropy' + '_measurement_' +
-              str(i)] = lens_cross_entropy
-
-        trained_params = optimizer.target.params
-        embedding_model = set_model_parameters(model=embedding_model,
-                                               params=trained_params)
-
-        datum.update(
-            measure_nearest_neighbor_performance(
-                accuracy_label=
-                'train_knn_accuracy_trained_lens_1_knn_train_samples' +
-                '_measurement_' + str(i),
-                encoder=embedding_model,
-                family_accessions=lens_knn_train_family_accessions,
-                batch_size=FLAGS.knn_batch_size,
-                train_samples=1,
-                shuffle_seed=FLAGS.knn_shuffle_seed,
-                sample_random_state=FLAGS.knn_sample_random_state))
-
-        for knn_train_samples in knn_train_samples_:
+            gcs_bucket=FLAGS.load_gcs_bucket,
+            store_dir=FLAGS.pfam_store_dir,
+            chunk_size=FLAGS.pfam_chunk_size,
+            reservoir_sampling=FLAGS.reservoir_sampling,
+            bucket_boundaries=lens_bucket_boundaries,
+            add_sequence_ids=encoder_cache is not None)
+        if encoder_cache is not None:
+            train_batches = EncoderFeatureBatches(train_batches, encoder_cache,
+                                                  PFAM_NUM_CATEGORIES - 1)
+        if FLAGS.lens_max_segments is not None:
+            # Rows fit the longest bucket, not just the first batch.
+            train_batches = PackedBatches(
+                train_batches,
+                max_segments=FLAGS.lens_max_segments,
+                batch_rows=FLAGS.lens_batch_size,
+                pad_ind=PFAM_NUM_CATEGORIES - 1,
+                length=max(lens_bucket_boundaries)
+                if lens_bucket_boundaries is not None else None,
+                gap=packing_gap(encoder_fn_kwargs, reduce_fn_kwargs),
+                drop_remainder=True)
+        train_batches = DevicePrefetcher(
+            train_batches,
+            shard=FLAGS.use_pmap,
+            steps_per_call=FLAGS.lens_steps_per_call)
+
+        if len(models) > 1:
+            if FLAGS.lens_max_segments is not None:
+                lens_models = [
+                    create_packed_model(model, FLAGS.lens_max_segments)
+                    for model in models
+                ]
+            else:
+                lens_models = models
+            models = train_sweep(models=lens_models,
+                                 train_data=train_batches,
+                                 loss_fn=cross_entropy_loss,
+                                 loss_fn_kwargs=loss_fn_kwargs,
+                                 learning_rates=learning_rates,
+                                 weight_decays=weight_decays,
+                                 layers=layers)
+            predict_fns = models
+        elif encoder_cache is not None:
+            # The cached encoder model names its layers as a one_hot model.
+            # Parameterless lenses have no lens layer in either model.
+            cached_encoder_layers, _ = architecture_to_layers(
+                'one_hot', FLAGS.reduce_fn_name)
+            trained_params = optimizer.target.params
+            cached_encoder_model = create_cached_encoder_representation_model(
+                reduce_fn=reduce_fn,
+                reduce_fn_kwargs=reduce_fn_kwargs,
+                num_categories=PFAM_NUM_CATEGORIES,
+                output_features=num_families,
+                feature_size=encoder_cache.feature_size,
+                reduce_fn_params=trained_params[layers[1]]
+                if len(cached_encoder_layers) > 1 else None,
+                predict_fn_params=trained_params[layers[-1]],
+                dtype=compute_dtype)
+            cached_encoder_optimizer = train(
+                model=cached_encoder_model,
+                train_data=train_batches,
+                loss_fn=cross_entropy_loss,
+                loss_fn_kwargs=loss_fn_kwargs,
+                learning_rate=layer_values('one_hot', FLAGS.reduce_fn_name,
+                                           FLAGS.encoder_lr, FLAGS.lens_lr,
+                                           FLAGS.predictor_lr),
+                weight_decay=layer_values('one_hot', FLAGS.reduce_fn_name,
+                                          FLAGS.encoder_wd, FLAGS.lens_wd,
+                                          FLAGS.predictor_wd),
+                layers=cached_encoder_layers,
+                use_pmap=FLAGS.use_pmap,
+                accumulation_steps=FLAGS.lens_accumulation_steps)
+            optimizer = create_optimizer(
+                model=optimizer.target.replace(params=merge_params(
+                    trained_params, {
+                        layer: cached_encoder_optimizer.target.params[
+                            cached_encoder_layer]
+                        for layer, cached_encoder_layer in zip(
+                            layers[1:], cached_encoder_layers)
+                    })),
+                learning_rate=layer_values(FLAGS.encoder_fn_name,
+                                           FLAGS.reduce_fn_name,
+                                           FLAGS.encoder_lr, FLAGS.lens_lr,
+                                           FLAGS.predictor_lr),
+                weight_decay=layer_values(FLAGS.encoder_fn_name,
+                                          FLAGS.reduce_fn_name,
+                                          FLAGS.encoder_wd, FLAGS.lens_wd,
+                                          FLAGS.predictor_wd),
+                layers=layers)
+            models = [optimizer.target]
+            predict_fns = [cached_encoder_optimizer.target]
+        else:
+            if FLAGS.lens_max_segments is not None:
+                lens_model = create_packed_model(optimizer.target,
+                                                 FLAGS.lens_max_segments)
+            else:
+                lens_model = optimizer.target
+            optimizer = train(
+                model=lens_model,
+                train_data=train_batches,
+                loss_fn=cross_entropy_loss,
+                loss_fn_kwargs=loss_fn_kwargs,
+                learning_rate=layer_values(FLAGS.encoder_fn_name,
+                                           FLAGS.reduce_fn_name,
+                                           FLAGS.encoder_lr, FLAGS.lens_lr,
+                                           FLAGS.predictor_lr),
+                weight_decay=layer_values(FLAGS.encoder_fn_name,
+                                          FLAGS.reduce_fn_name,
+                                          FLAGS.encoder_wd, FLAGS.lens_wd,
+                                          FLAGS.predictor_wd),
+                layers=layers,
+                use_pmap=FLAGS.use_pmap,
+                accumulation_steps=FLAGS.lens_accumulation_steps)
+            models = [optimizer.target]
+            predict_fns = [optimizer.target]
+
+        # Every config of a sweep is evaluated and written out on its own.
+        for j, (datum, model,
+                predict_fn) in enumerate(zip(data, models, predict_fns)):
+
+            datum['lens_train_data_stalls' + '_measurement_' +
+                  str(i)] = train_batches.stall_stats()['stalls']
+
+            results, preds = pfam_evaluate(
+                predict_fn=predict_fn,
+                test_family_accessions=lens_knn_train_family_accessions,
+                title=None,
+                loss_fn_kwargs=loss_fn_kwargs,
+                batch_size=FLAGS.lens_batch_size,
+                data_partitions_dirpath=FLAGS.data_partitions_dirpath,
+                gcs_bucket=FLAGS.load_gcs_bucket,
+                store_dir=FLAGS.pfam_store_dir,
+                chunk_size=FLAGS.pfam_chunk_size,
+                encoder_cache=encoder_cache)
+
+            lens_accuracy = results['accuracy']
+            datum['lens_accuracy' + '_measurement_' + str(i)] = lens_accuracy
+
+            datum['lens_top_5_accuracy' + '_measurement_' +
+                  str(i)] = results['top_5_accuracy']
+
+            lens_cross_entropy = float(results['cross_entropy'])
+            datum['lens_cross_entropy' + '_measurement_' +
+                  str(i)] = lens_cross_entropy
+
+            trained_params = model.params
+            embedding_models[j] = set_model_parameters(
+                model=embedding_models[j], params=trained_params)
 
             datum.update(
                 measure_nearest_neighbor_performance(
-                    accuracy_label='test_knn_accuracy_trained_lens_' +
-                    str(knn_train_samples) + '_knn_train_samples' +
+                    accuracy_label=
+                    'train_knn_accuracy_trained_lens_1_knn_train_samples' +
                     '_measurement_' + str(i),
-                    encoder=embedding_model,
-                    family_accessions=knn_test_family_accessions,
+                    encoder=embedding_models[j],
+                    family_accessions=lens_knn_train_family_accessions,
                     batch_size=FLAGS.knn_batch_size,
-                    train_samples=knn_train_samples,
+                    train_samples=1,
                     shuffle_seed=FLAGS.knn_shuffle_seed,
                     sample_random_state=FLAGS.knn_sample_random_state))
 
-    print(datum)
-    df = pd.DataFrame([datum])
-    with gcsfs.open(os.path.join(FLAGS.results_save_dir, FLAGS.label + '.csv'),
-                    'w') as gcs_file:
-        df.to_csv(gcs_file, index=False)
+            for knn_train_samples in knn_train_samples_:
+
+                datum.update(
+                    measure_nearest_neighbor_performance(
+                        accuracy_label='test_knn_accuracy_trained_lens_' +
+                        str(knn_train_samples) + '_knn_train_samples' +
+                        '_measurement_' + str(i),
+                        encoder=embedding_models[j],
+                        family_accessions=knn_test_family_accessions,
+                        batch_size=FLAGS.knn_batch_size,
+                        train_samples=knn_train_samples,
+                        shuffle_seed=FLAGS.knn_shuffle_seed,
+                        sample_random_state=FLAGS.knn_sample_random_state))
+
+    for datum in data:
+        print(datum)
+        df = pd.DataFrame([datum])
+        with gcsfs.open(
+                os.path.join(FLAGS.results_save_dir, datum['label'] + '.csv'),
+                'w') as gcs_file:
+            df.to_csv(gcs_file, index=False)
 
     if FLAGS.save_model:
         checkpoints.save_checkpoint(ckpt_dir=os.path.join(
@@ -497,5 +953,17 @@ def main(_):
                                     step=FLAGS.load_model_step + FLAGS.epochs)
 
 
+def main(_):
+
+    if FLAGS.sweep_labels is not None:
+        with open(FLAGS.sweep_params_path, 'r') as f:
+            label_to_params = json.load(f)
+        sweep_params = [label_to_params[label] for label in FLAGS.sweep_labels]
+    else:
+        sweep_params = [{key: getattr(FLAGS, key) for key in SWEEP_PARAMS}]
+
+    run_experiment(sweep_params)
+
+
 if __name__ == '__main__':
     app.run(main)
@@ -0,0 +1,349 @@
+"""Runs generate_params configs locally in a pool of long-lived worker processes.
+
+Each worker is pinned to its own cores, which also bounds its XLA thread
+pool, caps its BLAS thread pools and keeps its Pfam dataframes, encoder
+caches and compiled functions warm across configs. Configs sharing an encoder checkpoint and dataset are
+run on the same worker where possible, and configs whose label already has
+results are skipped.
+
+Example usage:
+python pfam_sweep.py \
+--params_path=params_combinations.json \
+--threads_per_worker=8 \
+--max_sweep_size=8 \
+--pfam_store_dir=pfam_store
+"""
+
+import os
+
+import sys
+
+import json
+
+import time
+
+import collections
+
+import multiprocessing
+
+import queue
+
+import traceback
+
+import pandas as pd
+
+from fs_gcsfs import GCSFS
+
+from absl import app, flags
+
+from generate_params import create_sweeps
+
+# Defines the flags of pfam_experiment, which are passed on to workers.
+import pfam_experiment
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('params_path', 'params_combinations.json',
+                    'JSON list of configs written by generate_params.')
+flags.DEFINE_list('sweep_config_labels', None,
+                  'Labels of configs to run (None = all configs).')
+flags.DEFINE_integer(
+    'num_workers', None,
+    'Number of worker processes (None = available cores // threads_per_worker).'
+)
+flags.DEFINE_integer('threads_per_worker', 8,
+                     'Number of cores each worker is pinned to.')
+flags.DEFINE_integer(
+    'max_sweep_size', 1,
+    'Maximum number of configs differing only in learning rates, weight decays and model_random_key trained together by a worker.'
+)
+flags.DEFINE_boolean('skip_done', True,
+                     'Whether or not to skip configs that have results.')
+flags.DEFINE_string('log_path', None,
+                    'Optional CSV file to write the status of each config to.')
+
+# Configs agreeing on these params load the same encoder and data.
+WARM_PARAMS = [
+    'encoder_fn_name', 'encoder_fn_kwargs_path', 'use_transformer',
+    'use_bert', 'restore_transformer_dir', 'load_model', 'load_model_dir',
+    'load_gcs_bucket', 'data_partitions_dirpath', 'train_families',
+    'lens_train_samples', 'lens_sample_random_state', 'first_test_family',
+    'last_test_family', 'knn_sample_random_state'
+]
+
+# Seconds between checks that workers with running tasks are alive.
+WORKER_POLL_SECONDS = 10
+
+# GCS file systems of result buckets by bucket name.
+_results_gcsfs = {}
+
+
+def worker_env(threads):
+    """Environment variables capping the BLAS thread pools of a worker.
+
+    XLA has no flag for its CPU thread count. It sizes its thread pool by
+    the cores the process may run on, which start_worker restricts from the
+    start, so only single-threaded workers also turn off multi-threaded
+    Eigen.
+    """
+
+    env = {}
+    if threads == 1:
+        xla_flags = os.environ.get('XLA_FLAGS', '')
+        env['XLA_FLAGS'] = (xla_flags +
+                            ' --xla_cpu_multi_thread_eigen=false').strip()
+    for name in [
+            'OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+            'NUMEXPR_NUM_THREADS'
+    ]:
+        env[name] = str(threads)
+
+    return env
+
+
+def pin_to_cores(cores):
+    """Pins every thread of the current process to cores."""
+
+    if not hasattr(os, 'sched_setaffinity'):
+        return
+
+    # Thread pools started on import are pinned too.
+    task_dir = '/proc/self/task'
+    tids = [int(tid) for tid in os.listdir(task_dir)
+            ] if os.path.exists(task_dir) else [0]
+    for tid in tids:
+        try:
+            os.sched_setaffinity(tid, cores)
+        except OSError:
+            pass
+
+
+def worker_main(worker_id, cores, argv, task_queue, result_queue):
+    """Runs tasks of task_queue with pfam_experiment.run_experiment until it gets None."""
+
+    pin_to_cores(cores)
+    FLAGS(argv)
+    flag_values = FLAGS.flag_values_dict()
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        # Every task starts from the command line flags.
+        for key, value in flag_values.items():
+            setattr(FLAGS, key, value)
+
+        start = time.time()
+        try:
+            pfam_experiment.run_experiment(task)
+            error = None
+        except Exception:
+            error = traceback.format_exc()
+
+        result_queue.put((worker_id, [param_dict['label'] for param_dict in task],
+                          time.time() - start, error))
+
+
+def start_worker(context, worker_id, cores, argv, result_queue):
+    """Starts a worker process on cores and returns it with its task queue."""
+
+    task_queue = context.Queue()
+    worker = context.Process(target=worker_main,
+                             args=(worker_id, cores, argv, task_queue,
+                                   result_queue))
+
+    # Spawned processes inherit the affinity of the starting thread, so the
+    # XLA backend started while importing a worker's modules sees its cores.
+    affinity = None
+    if hasattr(os, 'sched_setaffinity'):
+        affinity = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, cores)
+    try:
+        worker.start()
+    finally:
+        if affinity is not None:
+            os.sched_setaffinity(0, affinity)
+
+    return worker, task_queue
+
+
+def has_results(param_dict):
+    """Whether or not pfam_experiment has written the final results of a config."""
+
+    bucket = param_dict['save_gcs_bucket']
+    if bucket not in _results_gcsfs:
+        _results_gcsfs[bucket] = GCSFS(bucket)
+    gcsfs = _results_gcsfs[bucket]
+
+    path = os.path.join(param_dict['results_save_dir'],
+                        param_dict['label'] + '.csv')
+    if not gcsfs.exists(path):
+        return False
+
+    # Results are written once before and once after training.
+    with gcsfs.open(path, 'r') as f:
+        columns = pd.read_csv(f, nrows=0).columns
+
+    return 'lens_accuracy_measurement_%d' % (param_dict['measurements'] -
+                                             1) in columns
+
+
+def group_tasks(params, max_sweep_size):
+    """Tasks of at most max_sweep_size configs, grouped by WARM_PARAMS in order of first appearance."""
+
+    groups = collections.OrderedDict()
+    for param_dict in params:
+        warm_params = tuple(param_dict.get(key) for key in WARM_PARAMS)
+        groups.setdefault(warm_params, []).append(param_dict)
+
+    label_to_params = {param_dict['label']: param_dict for param_dict in params}
+    tasks = collections.OrderedDict()
+    for warm_params, group_params in groups.items():
+        tasks[warm_params] = collections.deque([[
+            label_to_params[label] for label in sweep['sweep_labels'].split(',')
+        ] for sweep in create_sweeps(group_params, max_sweep_size)])
+
+    return tasks
+
+
+def next_task(tasks, worker_groups, worker_id):
+    """Next task of the group of a worker, else of the largest group no other worker is warm for."""
+
+    group = worker_groups[worker_id]
+    if group not in tasks or len(tasks[group]) == 0:
+        remaining = [group for group in tasks if len(tasks[group]) > 0]
+        if len(remaining) == 0:
+            return None
+        cold = [group for group in remaining if group not in worker_groups]
+        group = max(cold if len(cold) > 0 else remaining,
+                    key=lambda group: len(tasks[group]))
+        worker_groups[worker_id] = group
+
+    return tasks[group].popleft()
+
+
+def main(_):
+
+    assert FLAGS.max_sweep_size == 1 or FLAGS.encoder_cache_dir is None, \
+    'Sweeps do not support encoder_cache_dir!'
+
+    with open(FLAGS.params_path, 'r') as f:
+        params = json.load(f)
+    if FLAGS.sweep_config_labels is not None:
+        sweep_config_labels = set(FLAGS.sweep_config_labels)
+        params = [
+            param_dict for param_dict in params
+            if param_dict['label'] in sweep_config_labels
+        ]
+
+    statuses = []
+    if FLAGS.skip_done:
+        done = [param_dict for param_dict in params if has_results(param_dict)]
+        done_labels = set(param_dict['label'] for param_dict in done)
+        statuses += [{
+            'label': label,
+            'status': 'skipped'
+        } for label in sorted(done_labels)]
+        params = [
+            param_dict for param_dict in params
+            if param_dict['label'] not in done_labels
+        ]
+    print('Running %d configs, skipped %d with results.' %
+          (len(params), len(statuses)))
+
+    tasks = group_tasks(params, FLAGS.max_sweep_size)
+
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(
+        os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    threads = min(FLAGS.threads_per_worker, len(cores))
+    num_workers = FLAGS.num_workers
+    if num_workers is None:
+        num_workers = max(len(cores) // threads, 1)
+    num_workers = min(num_workers, sum(len(group) for group in tasks.values()))
+
+    # Spawned workers inherit the environment, so their imports see the caps.
+    os.environ.update(worker_env(threads))
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.Queue()
+    worker_cores = [[
+        cores[(worker_id * threads + i) % len(cores)] for i in range(threads)
+    ] for worker_id in range(num_workers)]
+    workers, task_queues = zip(*[
+        start_worker(context, worker_id, worker_cores[worker_id], sys.argv,
+                     result_queue) for worker_id in range(num_workers)
+    ])
+    workers, task_queues = list(workers), list(task_queues)
+
+    def record(worker_id, labels, seconds, error):
+        for label in labels:
+            statuses.append({
+                'label': label,
+                'status': 'failed' if error is not None else 'done',
+                'worker': worker_id,
+                'seconds': seconds
+            })
+        print('Worker %d %s %s in %.1f seconds.' %
+              (worker_id, 'failed' if error is not None else 'finished',
+               ','.join(labels), seconds))
+        if error is not None:
+            print(error)
+
+    # Labels and start time of the task each busy worker is running.
+    running = {}
+    worker_groups = [None] * num_workers
+
+    def assign(worker_id):
+        task = next_task(tasks, worker_groups, worker_id)
+        if task is not None:
+            task_queues[worker_id].put(task)
+            running[worker_id] = ([param_dict['label'] for param_dict in task],
+                                  time.time())
+
+    for worker_id in range(num_workers):
+        assign(worker_id)
+
+    while len(running) > 0:
+        try:
+            worker_id, labels, seconds, error = result_queue.get(
+                timeout=WORKER_POLL_SECONDS)
+        except queue.Empty:
+            # Tasks of workers that died (e.g. killed for running out of
+            # memory) fail, and the workers are replaced.
+            for worker_id in list(running):
+                if workers[worker_id].is_alive():
+                    continue
+                labels, start = running.pop(worker_id)
+                record(
+                    worker_id, labels,
+                    time.time() - start, 'Worker exited with code %s.' %
+                    workers[worker_id].exitcode)
+                worker_groups[worker_id] = None
+                workers[worker_id], task_queues[worker_id] = start_worker(
+                    context, worker_id, worker_cores[worker_id], sys.argv,
+                    result_queue)
+                assign(worker_id)
+            continue
+
+        # Results of a replaced worker are not those of its successor.
+        if worker_id not in running or running[worker_id][0] != labels:
+            continue
+        del running[worker_id]
+        record(worker_id, labels, seconds, error)
+        assign(worker_id)
+
+    for task_queue in task_queues:
+        task_queue.put(None)
+    for worker in workers:
+        worker.join()
+
+    statuses_df = pd.DataFrame(statuses)
+    print(statuses_df['status'].value_counts().to_string()
+          if len(statuses_df) > 0 else 'No configs to run.')
+
+    if FLAGS.log_path is not None:
+        statuses_df.to_csv(FLAGS.log_path, index=False)
+
+
+if __name__ == '__main__':
+    app.run(main)